@@ -0,0 +1,102 @@
+"""
+Cache principal (user da xac thuc) cho get_current_user.
+
+get_current_user luon kiem tra lai user trong DB (user bi xoa / doi quyen thi token cu
+mat hieu luc). Cache nay giu nguyen dam bao do bang 2 co che:
+    - Invalidate tuong minh: UserDB goi invalidate_principal(email) khi user bi xoa,
+      doi quyen admin hoac cap nhat profile -> request sau trong cung process doc lai DB.
+    - Do tre toi da: moi entry chi song PRINCIPAL_CACHE_TTL_SECONDS (mac dinh 30s), gioi han
+      thoi gian cac worker uvicorn khac (khong nhan duoc invalidate) con dung ban cu.
+PRINCIPAL_CACHE_TTL_SECONDS=0 -> tat cache, moi request deu truy van DB nhu truoc.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class PrincipalCache:
+    """
+    LRU co TTL, key = email cua user (1 user co nhieu token van dung chung 1 entry,
+    invalidate theo email la du).
+
+    Args:
+        ttl_seconds: Do tre toi da so voi DB (env PRINCIPAL_CACHE_TTL_SECONDS).
+        max_entries: So user toi da giu trong cache (env PRINCIPAL_CACHE_MAX_ENTRIES).
+    """
+
+    def __init__(self, ttl_seconds: float = None, max_entries: int = None):
+        self.ttl_seconds = float(
+            os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30") if ttl_seconds is None else ttl_seconds
+        )
+        self.max_entries = max_entries or int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = Lock()
+        # Tang moi lan invalidate: ket qua DB doc truoc khi invalidate se khong duoc ghi vao cache
+        self._generation = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def get(self, email: str) -> dict | None:
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[email]
+                return None
+            self._entries.move_to_end(email)
+            return dict(user)
+
+    def set(self, email: str, user: dict, generation: int) -> None:
+        """
+        Luu user vua doc tu DB.
+
+        Args:
+            generation: Gia tri generation() lay TRUOC khi truy van DB.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[email] = (time.monotonic() + self.ttl_seconds, dict(user))
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(email, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+def invalidate_principal(email: str) -> None:
+    """Hook cho tang DB: goi sau khi user bi xoa / doi quyen / doi thong tin."""
+    if email:
+        principal_cache.invalidate(email)
+        logger.debug(f"Da xoa cache principal cua {email}")
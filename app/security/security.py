@@ -23,6 +23,7 @@ from passlib.context import CryptContext
 
 from chatbot.utils.jwt_utils import verify_jwt_token
 from chatbot.utils.base_db import UserDB
+from app.security.principal_cache import principal_cache
 from app.models.schemas import ApiError
 from app.logger import get_logger
 
@@ -79,7 +80,8 @@ def get_current_user(
 
     Luong xu ly:
         1. Giai ma JWT token tu Authorization header.
-        2. Truy van lai DB de dam bao user chua bi xoa hoac doi quyen.
+        2. Truy van lai DB de dam bao user chua bi xoa hoac doi quyen
+           (qua principal_cache: bi xoa khi user doi/xoa, tre toi da PRINCIPAL_CACHE_TTL_SECONDS).
         3. Tra ve dict chua thong tin user.
 
     Args:
@@ -122,9 +124,15 @@ def get_current_user(
             ).model_dump()
         )
 
-    # Luon truy van lai DB de dam bao user chua bi xoa hoac doi quyen
-    with UserDB() as db:
-        user = db.get_user_by_email(email)
+    # Luon kiem tra lai DB de dam bao user chua bi xoa hoac doi quyen; cache chi giu ket qua
+    # trong thoi gian ngan va bi xoa ngay khi UserDB xoa user / doi quyen (invalidate_principal)
+    user = principal_cache.get(email)
+    if user is None:
+        generation = principal_cache.generation()
+        with UserDB() as db:
+            user = db.get_user_by_email(email)
+        if user:
+            principal_cache.set(email, user, generation)
 
     if not user:
         raise HTTPException(
@@ -22,6 +22,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from chatbot.utils.llm import LLM
 from chatbot.services.files_rag_chat_agent import FilesChatAgent
 from chatbot.utils.graph_state import GraphState
+from chatbot.utils.semantic_cache import SemanticAnswerCache
 from app.logger import get_logger
 
 logger = get_logger(__name__)
@@ -57,6 +58,16 @@ class ChatbotRunner:
         # Xây dựng workflow
         self.workflow = self.agent.get_workflow()
         self.compiled_workflow = self.workflow.compile()
+        # Workflow retrieve + grade cho endpoint streaming (generate chạy riêng bằng astream)
+        self.retrieval_workflow = self.agent.get_retrieval_workflow().compile()
+
+        # Cache câu trả lời theo ngữ nghĩa (tự xóa khi ingest làm đổi version vector store)
+        self.semantic_cache = None
+        if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+            self.semantic_cache = SemanticAnswerCache(
+                self.agent.embeddings,
+                version_fn=self.agent.db_manager.get_manifest_version,
+            )
 
     def answer_question(self, question: str, prompt: str = None) -> str:
         """
@@ -13,15 +13,25 @@ Quy trình:
 """
 
 import os
-import re
-from typing import Dict, Any
+from typing import Any, AsyncIterator, Dict
 
+from ingestion.cluster_index import CorpusClusterIndex
 from ingestion.energy_kmeans import EnergyRetriever
-from ingestion.query_splitter import LLMQuerySplitter, SplitQueryEnergyRetriever
+from ingestion.query_splitter import (
+    LLMQuerySplitter,
+    LocalQuerySplitter,
+    QuerySplitRouter,
+    SplitQueryEnergyRetriever,
+)
+from ingestion.term_index import QueryTermIndex
 from ingestion.model_embedding import vn_embedder
 from ingestion.chunks_document import ChromaDBManager
 from chatbot.utils.document_grader import DocumentGrader
-from chatbot.utils.answer_generator import AnswerGeneratorDocs
+from chatbot.utils.reranker import CrossEncoderReranker
+from chatbot.utils.context_builder import ContextPacker
+from chatbot.utils.answer_generator import AnswerGeneratorDocs, ThinkTagFilter, strip_think_tags
+from chatbot.utils.cpu_executor import run_cpu_bound
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, StateGraph, START
 from chatbot.utils.graph_state import GraphState
 from app.logger import get_logger
@@ -59,7 +69,14 @@ class FilesChatAgent:
         # Các thành phần xử lý chính
         self.llm = llm_model
         self.document_grader = DocumentGrader(self.llm)
+        # llm: LLM chấm toàn bộ | rerank: chỉ cross-encoder local | hybrid: cross-encoder trước, LLM chấm phần lưng chừng
+        self.grading_mode = os.getenv("GRADING_MODE", "llm").strip().lower()
+        if self.grading_mode not in ("llm", "rerank", "hybrid"):
+            logger.warning(f"GRADING_MODE '{self.grading_mode}' không hợp lệ, dùng 'llm'.")
+            self.grading_mode = "llm"
+        self.reranker = CrossEncoderReranker() if self.grading_mode != "llm" else None
         self.answer_generator = AnswerGeneratorDocs(self.llm)
+        self.context_packer = ContextPacker()
         
         # Khởi tạo ChromaDB manager để lấy retriever
         self.embeddings = vn_embedder.get_model()
@@ -88,16 +105,31 @@ class FilesChatAgent:
 
         # Pipeline chính mới: dùng LLM tách câu hỏi thành nhiều query con,
         # rồi tính Energy Distance giữa phân phối query vectors và từng cụm docs.
-        self.query_splitter = LLMQuerySplitter(
-            llm=self.llm,
-            max_parts=int(os.getenv("QUERY_SPLITTER_MAX_PARTS", "4")),
-            include_original=True,
-            min_query_vectors=int(os.getenv("QUERY_SPLITTER_MIN_QUERY_VECTORS", "2")),
+        max_parts = int(os.getenv("QUERY_SPLITTER_MAX_PARTS", "4"))
+        min_query_vectors = int(os.getenv("QUERY_SPLITTER_MIN_QUERY_VECTORS", "2"))
+        # Tách câu hỏi bằng LLM hoặc local (từ nối + từ khóa + term index), chọn theo QUERY_SPLIT_MODE / request
+        self.query_splitter = QuerySplitRouter(
+            llm_splitter=LLMQuerySplitter(
+                llm=self.llm,
+                max_parts=max_parts,
+                include_original=True,
+                min_query_vectors=min_query_vectors,
+            ),
+            local_splitter=LocalQuerySplitter(
+                embeddings=self.embeddings,
+                term_index=QueryTermIndex.load(path_vector_store),
+                max_parts=max_parts,
+                include_original=True,
+                min_query_vectors=min_query_vectors,
+            ),
         )
+        # Cluster index toàn corpus (nếu đã build bằng ingestion/vector_data_builder.py)
+        self.cluster_index = CorpusClusterIndex.load(path_vector_store)
         self.split_query_retriever = SplitQueryEnergyRetriever(
             energy_retriever=self.energy_retriever,
             query_splitter=self.query_splitter,
             max_final_docs=int(os.getenv("QUERY_SPLIT_MAX_FINAL_DOCS", "0")),
+            cluster_index=self.cluster_index,
         )
 
     def handle_no_answer(self, state: GraphState) -> Dict[str, Any]:
@@ -115,7 +147,7 @@ class FilesChatAgent:
     def grade_documents(self, state: GraphState) -> Dict[str, Any]:
         """
         Đánh giá mức độ liên quan của các tài liệu với câu hỏi.
-        Đã tối ưu: Sử dụng Batching gộp N tài liệu vào 1 prompt.
+        Đã tối ưu: Batching gộp tài liệu vào prompt theo shard, chấm các shard song song.
 
         Args:
             state (GraphState): Trạng thái chứa documents và question.
@@ -126,17 +158,51 @@ class FilesChatAgent:
         question = state["question"]
         documents = state["documents"]
 
-        logger.info(f"Đang chấm điểm hàng loạt {len(documents)} tài liệu...")
+        logger.info(f"Đang chấm điểm hàng loạt {len(documents)} tài liệu ({self.grading_mode})...")
 
-        # Gọi hàm grade_batch (chỉ tốn 1 API call duy nhất)
-        filtered_docs = self.document_grader.grade_batch(
-            question=question, 
-            retrieved_docs=documents
-        )
+        if self.grading_mode == "rerank":
+            filtered_docs = self.reranker.rerank(question, documents)
+        elif self.grading_mode == "hybrid":
+            accepted, ambiguous = self.reranker.triage(question, documents)
+            logger.info(f"Reranker: giữ {len(accepted)}, gửi LLM chấm {len(ambiguous)} tài liệu lưng chừng.")
+            filtered_docs = accepted + self.document_grader.grade_batch(
+                question=question,
+                retrieved_docs=ambiguous
+            )
+        else:
+            # Gọi hàm grade_batch (mỗi shard tài liệu 1 API call, các shard chạy song song)
+            filtered_docs = self.document_grader.grade_batch(
+                question=question,
+                retrieved_docs=documents
+            )
 
         logger.info(f"Đã giữ lại {len(filtered_docs)}/{len(documents)} tài liệu liên quan.")
 
         return {"documents": filtered_docs, "question": question}
+
+    async def agrade_documents(self, state: GraphState) -> Dict[str, Any]:
+        """Phiên bản async của grade_documents (LLM gọi bằng abatch, cross-encoder chạy trên executor)."""
+        question = state["question"]
+        documents = state["documents"]
+
+        logger.info(f"Đang chấm điểm hàng loạt {len(documents)} tài liệu ({self.grading_mode})...")
+        if self.grading_mode == "rerank":
+            filtered_docs = await run_cpu_bound(self.reranker.rerank, question, documents)
+        elif self.grading_mode == "hybrid":
+            accepted, ambiguous = await run_cpu_bound(self.reranker.triage, question, documents)
+            logger.info(f"Reranker: giữ {len(accepted)}, gửi LLM chấm {len(ambiguous)} tài liệu lưng chừng.")
+            filtered_docs = accepted + await self.document_grader.agrade_batch(
+                question=question,
+                retrieved_docs=ambiguous
+            )
+        else:
+            filtered_docs = await self.document_grader.agrade_batch(
+                question=question,
+                retrieved_docs=documents
+            )
+        logger.info(f"Đã giữ lại {len(filtered_docs)}/{len(documents)} tài liệu liên quan.")
+
+        return {"documents": filtered_docs, "question": question}
         
     def decide_to_generate(self, state: GraphState) -> str:
         """
@@ -157,6 +223,19 @@ class FilesChatAgent:
             logger.info("Có tài liệu liên quan, tiến hành sinh câu trả lời")
             return "generate"
 
+    def build_answer_input(self, state: GraphState) -> Dict[str, Any]:
+        """Chuẩn bị input (question, context, prompt) cho chain sinh câu trả lời."""
+        documents = state["documents"]
+
+        # Ghép tài liệu thành context: gộp overlap, sắp theo độ liên quan, giới hạn token
+        context = self.context_packer.pack(state["question"], documents)
+
+        return {
+            "question": state["question"],
+            "context": context,
+            "prompt": state.get("prompt") or "Bạn là một chuyên gia tư vấn kinh tế.",
+        }
+
     def generate(self, state: GraphState) -> Dict[str, Any]:
         """
         Sinh câu trả lời từ câu hỏi + các tài liệu đã lọc.
@@ -167,24 +246,36 @@ class FilesChatAgent:
         Returns:
             Dict[str, Any]: Trả về câu trả lời (generation).
         """
-        question = state["question"]
-        documents = state["documents"]
-        prompt = state.get("prompt", "Bạn là một chuyên gia tư vấn kinh tế.")
-
-        # Ghép nội dung các tài liệu thành context
-        context = "\n\n".join(doc.page_content for doc in documents)
-
         # Sinh câu trả lời từ AnswerGenerator
-        generation = self.answer_generator.get_chain().invoke(
-            {"question": question, "context": context, "prompt": prompt}
-        )
+        generation = self.answer_generator.get_chain().invoke(self.build_answer_input(state))
 
         # Xóa tag <think> nếu có
-        generation = re.sub(
-            r"<think>.*?</think>", "", generation, flags=re.DOTALL
-        ).strip()
+        return {"generation": strip_think_tags(generation)}
 
-        return {"generation": generation}
+    async def agenerate(self, state: GraphState) -> Dict[str, Any]:
+        """Phiên bản async của generate (LLM gọi bằng ainvoke)."""
+        generation = await self.answer_generator.get_chain().ainvoke(self.build_answer_input(state))
+        return {"generation": strip_think_tags(generation)}
+
+    async def astream_answer(self, state: GraphState) -> AsyncIterator[str]:
+        """
+        Stream câu trả lời từng chunk (dùng cho endpoint SSE).
+
+        state là output của workflow retrieval (get_retrieval_workflow);
+        nếu không còn tài liệu nào thì trả về câu báo không tìm thấy.
+        """
+        if not state.get("documents"):
+            yield self.handle_no_answer(state)["generation"]
+            return
+
+        think_filter = ThinkTagFilter()
+        async for chunk in self.answer_generator.get_chain().astream(self.build_answer_input(state)):
+            text = think_filter.feed(chunk)
+            if text:
+                yield text
+        rest = think_filter.flush()
+        if rest:
+            yield rest
 
     def retrieve(self, state: GraphState) -> Dict[str, Any]:
         """
@@ -198,15 +289,26 @@ class FilesChatAgent:
         """
         question = state["question"]
 
-        documents = self.split_query_retriever.retrieve(query=question)
+        # Kết quả riêng của lần gọi này (không đọc last_* dùng chung giữa các request)
+        result = self.split_query_retriever.retrieve_result(
+            query=question, split_mode=state.get("split_mode")
+        )
 
-        return {
-            "documents": documents,
-            "question": question,
-            "query_parts": self.split_query_retriever.last_query_parts,
-            "retrieval_debug": self.split_query_retriever.last_retrieval_debug,
-            "algorithm": self.split_query_retriever.last_algorithm,
-        }
+        return {"question": question, **result}
+
+    async def aretrieve(self, state: GraphState) -> Dict[str, Any]:
+        """
+        Phiên bản async của retrieve: tách query bằng LLM async, phần embedding /
+        Chroma / K-Means chạy trên executor giới hạn để không chặn event loop.
+        Tìm kiếm cho câu hỏi gốc chạy song song với LLM tách câu hỏi (speculative).
+        """
+        question = state["question"]
+
+        result = await self.split_query_retriever.aretrieve_result(
+            question, run_blocking=run_cpu_bound, split_mode=state.get("split_mode")
+        )
+
+        return {"question": question, **result}
 
     def get_workflow(self):
         """
@@ -222,9 +324,10 @@ class FilesChatAgent:
         workflow = StateGraph(GraphState)
 
         # Định nghĩa các node
-        workflow.add_node("retrieve", self.retrieve)
-        workflow.add_node("grade_documents", self.grade_documents)
-        workflow.add_node("generate", self.generate)
+        # Mỗi node có cả bản sync (invoke) và async (ainvoke)
+        workflow.add_node("retrieve", RunnableLambda(self.retrieve, afunc=self.aretrieve))
+        workflow.add_node("grade_documents", RunnableLambda(self.grade_documents, afunc=self.agrade_documents))
+        workflow.add_node("generate", RunnableLambda(self.generate, afunc=self.agenerate))
         workflow.add_node("no_document", self.handle_no_answer)
 
         # Xây dựng luồng
@@ -245,3 +348,20 @@ class FilesChatAgent:
         workflow.add_edge("no_document", END)
 
         return workflow
+
+    def get_retrieval_workflow(self):
+        """
+        Workflow chỉ gồm bước truy xuất + chấm điểm (không sinh câu trả lời).
+
+        Dùng cho endpoint streaming: câu trả lời được sinh riêng qua astream_answer().
+
+        Luồng xử lý:
+            START -> retrieve -> grade_documents -> END
+        """
+        workflow = StateGraph(GraphState)
+        workflow.add_node("retrieve", RunnableLambda(self.retrieve, afunc=self.aretrieve))
+        workflow.add_node("grade_documents", RunnableLambda(self.grade_documents, afunc=self.agrade_documents))
+        workflow.add_edge(START, "retrieve")
+        workflow.add_edge("retrieve", "grade_documents")
+        workflow.add_edge("grade_documents", END)
+        return workflow
@@ -0,0 +1,267 @@
+"""
+Ghi lịch sử chat kiểu write-behind, gom nhiều exchange vào 1 transaction SQLite.
+
+Luồng chat (server.py):
+    1. UserDB.debit_chat_exchange: trừ balance + ghi ledger + giữ trước id messages
+       trong 1 transaction đồng bộ — balance luôn chính xác ngay khi trả response.
+    2. ChatHistoryWriter.enqueue(records): ghi records vào journal (JSONL) rồi đưa vào hàng đợi.
+    3. Thread nền flush hàng đợi mỗi HISTORY_FLUSH_INTERVAL_MS hoặc khi đủ
+       HISTORY_FLUSH_MAX_RECORDS records: 1 transaction cho cả lô (UserDB.write_history_batch).
+
+Journal (crash-safe):
+    - Mỗi lần start() ghi vào segment riêng <journal_dir>/<run_id>-<n>.jsonl (run_id = uuid4 sinh
+      mỗi lần khởi động, không dùng pid: container chạy python là PID 1 nên pid lặp lại sau restart).
+      Khi flush, segment hiện tại được chuyển sang danh sách chờ và mở segment mới; segment cũ
+      chỉ bị xóa sau khi lô của nó đã commit.
+    - Segment còn giữ (đang ghi hoặc chờ commit) luôn bị khóa độc quyền (flock). Khóa tự nhả
+      khi process chết, kể cả bị kill -9.
+    - Khởi động: replay mọi segment không phải của chính writer này mà khóa được (chủ đã chết)
+      rồi xóa; segment đang bị khóa thuộc worker khác còn sống -> bỏ qua.
+      write_history_batch idempotent (id đã giữ trước) nên replay lại nhiều lần vẫn an toàn.
+    - HISTORY_JOURNAL_FSYNC=true: fsync mỗi lần ghi journal (chống mất điện, chậm hơn);
+      mặc định chỉ flush xuống OS — đủ an toàn khi process crash.
+
+Đọc lịch sử ngay sau khi chat (read-your-writes): gọi flush_user(email) trước khi đọc.
+Records còn chờ ở worker khác: UserDB đọc lịch sử dừng trước id chờ ghi nhỏ nhất của user
+(bảng pending_chat_messages) nên since_id / cursor của client không vượt qua message chưa ghi.
+"""
+
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from app.logger import get_logger
+from chatbot.utils.base_db import DB_DIR, UserDB
+
+logger = get_logger(__name__)
+
+
+def _try_lock(f) -> bool:
+    """Khóa độc quyền, không chờ. False nếu file đang bị process khác khóa."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class ChatHistoryWriter:
+    """
+    Args:
+        db_path: File SQLite. Mặc định: như UserDB.
+        journal_dir: Thư mục journal (env HISTORY_JOURNAL_DIR, mặc định chatbot/data/history_journal).
+        flush_interval_ms: Chu kỳ flush (env HISTORY_FLUSH_INTERVAL_MS).
+        max_records: Flush sớm khi hàng đợi đủ số records này (env HISTORY_FLUSH_MAX_RECORDS).
+        fsync: fsync journal mỗi lần ghi (env HISTORY_JOURNAL_FSYNC).
+    """
+
+    def __init__(
+        self,
+        db_path: str = None,
+        journal_dir: str = None,
+        flush_interval_ms: int = None,
+        max_records: int = None,
+        fsync: bool = None,
+    ):
+        self.db_path = db_path
+        self.journal_dir = Path(journal_dir or os.getenv("HISTORY_JOURNAL_DIR", "") or DB_DIR / "history_journal")
+        self.flush_interval = (flush_interval_ms or int(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "200"))) / 1000
+        self.max_records = max_records or int(os.getenv("HISTORY_FLUSH_MAX_RECORDS", "200"))
+        self.fsync = (
+            os.getenv("HISTORY_JOURNAL_FSYNC", "false").lower() == "true" if fsync is None else fsync
+        )
+
+        self._lock = threading.Lock()
+        # Chỉ 1 lần flush tại 1 thời điểm (thread nền hoặc flush_user từ request)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pending: list[dict] = []
+        self._run_id: str | None = None
+        self._segment_index = 0
+        self._segment_path: Path | None = None
+        self._segment_file = None
+        # Segment đã thôi ghi nhưng lô của nó chưa commit (vẫn mở để giữ khóa)
+        self._unflushed_segments: list[tuple[Path, object]] = []
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # ------------------------------------------------------------------
+    # Vòng đời
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Replay journal của các process đã chết, mở segment mới và chạy thread flush."""
+        if self.running:
+            return
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+
+        self._stopping.clear()
+        with self._lock:
+            self._run_id = uuid.uuid4().hex
+            self._segment_index = 0
+            self._open_segment()
+        self._replay_orphaned_segments()
+        self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"ChatHistoryWriter đã chạy (flush mỗi {self.flush_interval * 1000:.0f}ms "
+            f"hoặc {self.max_records} records)."
+        )
+
+    def stop(self):
+        """Dừng thread và flush nốt hàng đợi (gọi khi tắt server)."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+        with self._lock:
+            if self._segment_file is not None:
+                if not self._pending and not self._unflushed_segments:
+                    self._segment_path.unlink(missing_ok=True)
+                self._segment_file.close()
+                self._segment_file = None
+            # Lô flush lỗi: để lại segment (đã nhả khóa) cho lần khởi động sau replay
+            for _, f in self._unflushed_segments:
+                f.close()
+            self._unflushed_segments = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Records vẫn nằm trong hàng đợi + journal, lần flush sau thử lại
+                logger.error(f"Lỗi flush lịch sử chat: {e}", exc_info=True)
+
+    # ------------------------------------------------------------------
+    # Journal
+    # ------------------------------------------------------------------
+
+    def _open_segment(self):
+        self._segment_index += 1
+        self._segment_path = self.journal_dir / f"{self._run_id}-{self._segment_index}.jsonl"
+        self._segment_file = open(self._segment_path, "a", encoding="utf-8")
+        if not _try_lock(self._segment_file):
+            raise RuntimeError(f"Không khóa được journal {self._segment_path}")
+
+    def _owned_segments(self) -> set[Path]:
+        with self._lock:
+            owned = {path for path, _ in self._unflushed_segments}
+            if self._segment_path is not None:
+                owned.add(self._segment_path)
+        return owned
+
+    def _replay_orphaned_segments(self):
+        owned = self._owned_segments()
+        for path in sorted(self.journal_dir.glob("*.jsonl")):
+            if path in owned:
+                continue
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                # Worker khác vừa replay / flush xong
+                continue
+
+            with f:
+                if not _try_lock(f):
+                    # Chủ segment còn sống (worker khác)
+                    continue
+
+                records = []
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Dòng cuối bị cắt dở khi crash
+                        logger.warning(f"Bỏ qua dòng journal hỏng trong {path.name}")
+                if records:
+                    with UserDB(self.db_path) as db:
+                        inserted = db.write_history_batch(records)
+                    logger.info(f"Đã replay journal {path.name}: {inserted}/{len(records)} records mới.")
+                # Xóa khi còn giữ khóa: worker khác không thể replay song song cùng segment
+                path.unlink(missing_ok=True)
+
+    # ------------------------------------------------------------------
+    # Ghi / flush
+    # ------------------------------------------------------------------
+
+    def enqueue(self, records: list[dict]):
+        """
+        Ghi records vào journal rồi đưa vào hàng đợi. Writer chưa chạy (script, test)
+        thì ghi thẳng vào DB.
+        """
+        if not records:
+            return
+        if not self.running:
+            with UserDB(self.db_path) as db:
+                db.write_history_batch(records)
+            return
+
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with self._lock:
+            self._segment_file.write(lines)
+            self._segment_file.flush()
+            if self.fsync:
+                os.fsync(self._segment_file.fileno())
+            self._pending.extend(records)
+            pending = len(self._pending)
+        if pending >= self.max_records:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Ghi toàn bộ hàng đợi trong 1 transaction. Trả về số records đã ghi."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, []
+                if self._segment_file is not None:
+                    # Giữ file mở (và khóa) tới khi lô commit xong
+                    self._segment_file.flush()
+                    self._unflushed_segments.append((self._segment_path, self._segment_file))
+                    self._open_segment()
+
+            try:
+                with UserDB(self.db_path) as db:
+                    db.write_history_batch(batch)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = batch
+                raise
+
+            with self._lock:
+                segments, self._unflushed_segments = self._unflushed_segments, []
+            for path, f in segments:
+                path.unlink(missing_ok=True)
+                f.close()
+            return len(batch)
+
+    def flush_user(self, user_email: str) -> int:
+        """Flush nếu hàng đợi còn records của user (trước khi đọc / xóa lịch sử của user)."""
+        with self._lock:
+            has_pending = any(record.get("user_email") == user_email for record in self._pending)
+        return self.flush() if has_pending else 0
+
+
+history_writer = ChatHistoryWriter()
@@ -12,12 +12,13 @@ Tham chiếu:
     - docs/DOCS-main/skill_coding_conventions.md
 """
 
+import json
 import os
 import sys
 import time
 from pathlib import Path
 from threading import RLock
-from typing import Optional
+from typing import Awaitable, Callable, Literal, Optional
 from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
@@ -27,17 +28,19 @@ PROJECT_ROOT = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 load_dotenv(PROJECT_ROOT / ".env")
 
-import uuid
-
-from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from chatbot.main import ChatbotRunner
-from chatbot.utils.base_db import UserDB
-from chatbot.utils.token_counter import count_tokens
+from chatbot.services.task_queue import ChatTaskQueue, TaskFailed, TaskQueueFull
+from chatbot.utils.cpu_executor import run_cpu_bound
+from chatbot.utils.base_db import UserDB, close_db_pools, decode_cursor, init_db, next_page_cursor
+from chatbot.services.history_writer import history_writer
+from chatbot.utils.token_counter import UsageTracker, count_tokens_batch
 from app.models.schemas import ApiSuccess, ApiError
 from app.security.security import get_current_user
 from app.logger import get_logger
@@ -48,11 +51,16 @@ logger = get_logger(__name__)
 # ------------------------------------------------------------------
 # Pydantic Models (Request/Response)
 # ------------------------------------------------------------------
+# Cách tách câu hỏi cho retrieval (None = theo env QUERY_SPLIT_MODE)
+SplitMode = Optional[Literal["auto", "llm", "local"]]
+
+
 class ChatRequest(BaseModel):
     """Schema cho yêu cầu chat từ Frontend."""
     question: str
     llm_provider: Optional[str] = None
     conversation_id: Optional[str] = None
+    split_mode: SplitMode = None
 
 
 class ConversationCreateRequest(BaseModel):
@@ -66,6 +74,7 @@ class ConversationUpdateRequest(BaseModel):
 class ConversationMessageRequest(BaseModel):
     question: str
     prompt: Optional[str] = None
+    split_mode: SplitMode = None
 
 
 class ChatResponseData(BaseModel):
@@ -96,6 +105,7 @@ class HealthData(BaseModel):
 VECTOR_STORE_PATH = str(PROJECT_ROOT / "chroma_economy_db")
 DEFAULT_LLM = os.getenv("DEFAULT_LLM", "openai")
 MAX_QUESTION_CHARS = int(os.getenv("MAX_QUESTION_CHARS", "4000"))
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "true").lower() == "true"
 
 chatbot_instance: ChatbotRunner = None
 is_ready = False
@@ -164,27 +174,121 @@ def validate_question(question: str) -> str:
     return clean_question
 
 
-def get_chat_token_count(text: str) -> int:
-    return max(1, count_tokens(text, os.getenv("OPENAI_LLM_MODEL_NAME", "gpt-4o-mini")))
+def get_chat_token_counts(question: str, answer: str) -> tuple[int, int]:
+    """Số token tính phí (câu hỏi, câu trả lời), đếm trong 1 lần gọi encoder."""
+    input_tokens, output_tokens = count_tokens_batch(
+        [question, answer], os.getenv("OPENAI_LLM_MODEL_NAME", "gpt-4o-mini")
+    )
+    return max(1, input_tokens), max(1, output_tokens)
+
+
+# Node vừa chạy xong -> stage báo cho client (task queue)
+WORKFLOW_STAGES = {
+    "retrieve": "retrieved",
+    "grade_documents": "graded",
+}
+
 
+async def arun_chat_workflow(
+    question: str,
+    prompt: str = "",
+    on_stage: Optional[Callable[[str], Awaitable[None]]] = None,
+    split_mode: Optional[str] = None,
+) -> tuple[str, list[dict], float, int]:
+    """
+    Chạy workflow RAG async: LLM gọi async, bước nặng CPU chạy trên executor giới hạn.
 
-def run_chat_workflow(question: str, prompt: str = "") -> tuple[str, list[dict], float, int]:
-    bot = get_chatbot()
+    Câu hỏi đã trả lời (hoặc diễn đạt gần giống) được lấy từ semantic cache, bỏ qua workflow.
+
+    Args:
+        on_stage: Callback async nhận tên bước (retrieved, graded, generating) mỗi khi
+            workflow chuyển bước. None = chạy ainvoke bình thường.
+        split_mode: Cách tách câu hỏi (auto | llm | local), None = theo QUERY_SPLIT_MODE.
+    """
+    bot = await run_in_threadpool(get_chatbot)
     start_time = time.time()
 
+    cached = await lookup_answer_cache(bot, question, prompt, split_mode)
+    if cached is not None:
+        return cached["answer"], cached["sources"], round(time.time() - start_time, 2), cached["num_docs"]
+
     input_state = {
         "question": question,
         "generation": "",
         "documents": [],
         "prompt": prompt or "",
+        "split_mode": split_mode or "",
     }
 
-    output_state = bot.compiled_workflow.invoke(input_state)
+    # Token provider báo cáo cho mọi lần gọi LLM (tách câu hỏi, chấm, sinh) - chỉ để theo dõi
+    usage_tracker = UsageTracker()
+    config = {"callbacks": [usage_tracker]}
+    if on_stage is None:
+        output_state = await bot.compiled_workflow.ainvoke(input_state, config=config)
+    else:
+        # stream_mode="updates": nhận output của từng node ngay khi node chạy xong
+        output_state = dict(input_state)
+        async for update in bot.compiled_workflow.astream(input_state, config=config, stream_mode="updates"):
+            for node_name, node_output in update.items():
+                output_state.update(node_output or {})
+                stage = WORKFLOW_STAGES.get(node_name)
+                if stage:
+                    await on_stage(stage)
+                if node_name == "grade_documents" and output_state.get("documents"):
+                    await on_stage("generating")
 
     elapsed = time.time() - start_time
     answer = output_state.get("generation", "Không thể tạo câu trả lời.")
     docs = output_state.get("documents", [])
+    sources = build_sources(docs)
+    await store_answer_cache(bot, question, prompt, answer, sources, len(docs), split_mode)
+
+    usage = usage_tracker.totals()
+    if usage["reported_calls"]:
+        logger.info(
+            f"LLM usage: {usage['llm_calls']} lần gọi, input={usage['input_tokens']}, "
+            f"output={usage['output_tokens']} tokens (provider báo cáo {usage['reported_calls']} lần)."
+        )
+
+    return answer, sources, round(elapsed, 2), len(docs)
+
+
+async def lookup_answer_cache(
+    bot: ChatbotRunner, question: str, prompt: str = "", split_mode: Optional[str] = None
+) -> Optional[dict]:
+    """Tra semantic cache (embed câu hỏi chạy trên CPU executor). None nếu cache tắt hoặc miss."""
+    if bot.semantic_cache is None:
+        return None
+    try:
+        cached = await run_cpu_bound(bot.semantic_cache.lookup, question, prompt or "", split_mode or "")
+    except Exception as e:
+        logger.warning(f"Lỗi tra semantic cache, bỏ qua cache: {e}")
+        return None
+    if cached is not None:
+        logger.info(f"Semantic cache hit (similarity={cached['similarity']:.3f}): {question[:80]}")
+    return cached
+
+
+async def store_answer_cache(
+    bot: ChatbotRunner,
+    question: str,
+    prompt: str,
+    answer: str,
+    sources: list[dict],
+    num_docs: int,
+    split_mode: Optional[str] = None,
+) -> None:
+    if bot.semantic_cache is None:
+        return
+    try:
+        await run_cpu_bound(
+            bot.semantic_cache.store, question, prompt or "", answer, sources, num_docs, split_mode or ""
+        )
+    except Exception as e:
+        logger.warning(f"Lỗi ghi semantic cache: {e}")
 
+
+def build_sources(docs) -> list[dict]:
     sources = []
     for doc in docs:
         sources.append({
@@ -192,8 +296,65 @@ def run_chat_workflow(question: str, prompt: str = "") -> tuple[str, list[dict],
             "source": doc.metadata.get("source", "Không rõ nguồn"),
             "full_content": doc.page_content,
         })
+    return sources
 
-    return answer, sources, round(elapsed, 2), len(docs)
+
+def _with_user_db(operation):
+    with UserDB() as db:
+        return operation(db)
+
+
+async def run_db(operation):
+    """Chạy operation(db) với UserDB trong threadpool (SQLite là I/O đồng bộ)."""
+    return await run_in_threadpool(_with_user_db, operation)
+
+
+def _read_after_flush(user_email: str, operation):
+    """
+    Bọc operation(db) để ghi nốt lịch sử chat còn trong hàng đợi của user trước
+    (read-your-writes khi đọc / xóa lịch sử). Dùng: await run_db(_read_after_flush(email, op)).
+    """
+    def run(db: UserDB):
+        history_writer.flush_user(user_email)
+        return operation(db)
+    return run
+
+
+def _save_chat_exchange(db: UserDB, **exchange) -> Optional[dict]:
+    """
+    Trừ token ngay (đồng bộ), messages + cập nhật conversation giao cho history_writer ghi theo lô.
+    Writer không chạy (HISTORY_WRITE_BEHIND=false) thì records được ghi ngay.
+    """
+    saved = db.debit_chat_exchange(**exchange)
+    if saved:
+        history_writer.enqueue(saved.pop("records"))
+    return saved
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Đóng gói 1 event Server-Sent Events (data dạng JSON 1 dòng)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _get_or_create_chat_conversation(db: UserDB, user_email: str, conversation_id: Optional[str], question: str) -> dict:
+    """Kiểm tra token balance rồi lấy (hoặc tạo) hội thoại cho /api/chat."""
+    if db.get_token_balance(user_email) <= 0:
+        raise_insufficient_tokens()
+
+    conversation = (
+        db.get_conversation(user_email, conversation_id)
+        if conversation_id else
+        db.create_conversation(user_email, title=question[:40])
+    )
+    if not conversation:
+        raise HTTPException(
+            status_code=404,
+            detail=ApiError(
+                message="Cuộc hội thoại không tồn tại.",
+                error_code="CONVERSATION_NOT_FOUND"
+            ).model_dump()
+        )
+    return conversation
 
 
 def raise_insufficient_tokens(message: str = "Bạn đã hết token. Vui lòng nạp thêm token để tiếp tục."):
@@ -217,9 +378,17 @@ async def lifespan(app):
     else:
         logger.info("Vector store đã sẵn sàng; chatbot sẽ được tải khi có request đầu tiên.")
 
+    await run_in_threadpool(init_db)
+    if HISTORY_WRITE_BEHIND:
+        await run_in_threadpool(history_writer.start)
+    await task_queue.start()
+
     yield
 
     logger.info("Shutting down server...")
+    await task_queue.stop()
+    await run_in_threadpool(history_writer.stop)
+    close_db_pools()
 
 
 # ------------------------------------------------------------------
@@ -315,9 +484,10 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 async def get_current_user_balance(current_user: dict = Depends(get_current_user)):
     """Tra ve token balance cua user hien tai."""
     email = current_user["email"]
-    with UserDB() as db:
-        balance = db.get_token_balance(email)
-        transactions = db.get_token_transactions(email, limit=20)
+    balance, transactions = await run_db(lambda db: (
+        db.get_token_balance(email),
+        db.get_token_transactions(email, limit=20),
+    ))
 
     return ApiSuccess(
         data={
@@ -344,16 +514,46 @@ async def health_check():
     )
 
 
+def invalid_cursor_error() -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=ApiError(
+            message="Cursor phân trang không hợp lệ.",
+            error_code="INVALID_CURSOR"
+        ).model_dump()
+    )
+
+
+def validate_cursor(cursor: Optional[str]) -> None:
+    """Kiểm tra cursor trước khi truy vấn DB: chỉ lỗi cursor mới trả về INVALID_CURSOR."""
+    if cursor is None:
+        return
+    try:
+        decode_cursor(cursor)
+    except ValueError:
+        raise invalid_cursor_error()
+
+
 @app.get("/api/v1/chat/conversations", tags=["Conversations"])
 async def list_chat_conversations(
     limit: int = 100,
     offset: int = 0,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
 ):
-    """Danh sách hội thoại của tài khoản đang đăng nhập."""
-    with UserDB() as db:
-        conversations = db.list_conversations(current_user["email"], limit=limit, offset=offset)
-    return ApiSuccess(data={"conversations": conversations})
+    """
+    Danh sách hội thoại của tài khoản đang đăng nhập.
+    Trang sau: truyền lại next_cursor của response (keyset, không dùng offset).
+    """
+    validate_cursor(cursor)
+    conversations = await run_db(_read_after_flush(
+        current_user["email"],
+        lambda db: db.list_conversations(current_user["email"], limit=limit, offset=offset, cursor=cursor),
+    ))
+    return ApiSuccess(data={
+        "conversations": conversations,
+        "next_cursor": next_page_cursor(conversations, limit, "updated_at", "id"),
+    })
 
 
 @app.post("/api/v1/chat/conversations", tags=["Conversations"])
@@ -362,19 +562,27 @@ async def create_chat_conversation(
     current_user: dict = Depends(get_current_user),
 ):
     """Tạo hội thoại mới cho tài khoản đang đăng nhập."""
-    with UserDB() as db:
-        conversation = db.create_conversation(current_user["email"], title=request.title)
+    conversation = await run_db(lambda db: db.create_conversation(current_user["email"], title=request.title))
     return ApiSuccess(data={"conversation": conversation})
 
 
 @app.get("/api/v1/chat/conversations/{conversation_id}/messages", tags=["Conversations"])
 async def get_chat_conversation_messages(
     conversation_id: str,
+    since_id: Optional[int] = None,
+    limit: Optional[int] = None,
     current_user: dict = Depends(get_current_user),
 ):
-    """Lấy messages của một hội thoại thuộc user."""
-    with UserDB() as db:
-        messages = db.get_conversation_messages(current_user["email"], conversation_id)
+    """
+    Lấy messages của một hội thoại thuộc user.
+    since_id: chỉ trả messages mới hơn message id này (hội thoại đang mở chỉ tải phần mới).
+    """
+    messages = await run_db(_read_after_flush(
+        current_user["email"],
+        lambda db: db.get_conversation_messages(
+            current_user["email"], conversation_id, since_id=since_id, limit=limit
+        ),
+    ))
     if messages is None:
         raise HTTPException(
             status_code=404,
@@ -393,10 +601,9 @@ async def update_chat_conversation(
     current_user: dict = Depends(get_current_user),
 ):
     """Đổi title hội thoại."""
-    with UserDB() as db:
-        conversation = db.update_conversation_title(
-            current_user["email"], conversation_id, request.title
-        )
+    conversation = await run_db(lambda db: db.update_conversation_title(
+        current_user["email"], conversation_id, request.title
+    ))
     if not conversation:
         raise HTTPException(
             status_code=404,
@@ -414,8 +621,10 @@ async def delete_chat_conversation(
     current_user: dict = Depends(get_current_user),
 ):
     """Xóa hội thoại thuộc user."""
-    with UserDB() as db:
-        deleted = db.delete_conversation(current_user["email"], conversation_id)
+    deleted = await run_db(_read_after_flush(
+        current_user["email"],
+        lambda db: db.delete_conversation(current_user["email"], conversation_id),
+    ))
     if not deleted:
         raise HTTPException(
             status_code=404,
@@ -437,36 +646,39 @@ async def send_chat_conversation_message(
     question = validate_question(request.question)
     user_email = current_user["email"]
 
-    with UserDB() as db:
-        balance = db.get_token_balance(user_email)
-        if balance <= 0:
-            raise_insufficient_tokens()
-        if not db.get_conversation(user_email, conversation_id):
-            raise HTTPException(
-                status_code=404,
-                detail=ApiError(
-                    message="Cuộc hội thoại không tồn tại.",
-                    error_code="CONVERSATION_NOT_FOUND"
-                ).model_dump()
-            )
+    balance, conversation = await run_db(lambda db: (
+        db.get_token_balance(user_email),
+        db.get_conversation(user_email, conversation_id),
+    ))
+    if balance <= 0:
+        raise_insufficient_tokens()
+    if not conversation:
+        raise HTTPException(
+            status_code=404,
+            detail=ApiError(
+                message="Cuộc hội thoại không tồn tại.",
+                error_code="CONVERSATION_NOT_FOUND"
+            ).model_dump()
+        )
 
     try:
-        answer, sources, response_time, num_docs = run_chat_workflow(question, request.prompt or "")
-        input_tokens = get_chat_token_count(question)
-        output_tokens = get_chat_token_count(answer)
+        answer, sources, response_time, num_docs = await arun_chat_workflow(
+            question, request.prompt or "", split_mode=request.split_mode
+        )
+        input_tokens, output_tokens = get_chat_token_counts(question, answer)
 
-        with UserDB() as db:
-            saved = db.save_chat_exchange_and_debit(
-                user_email=user_email,
-                conversation_id=conversation_id,
-                question=question,
-                answer=answer,
-                sources=sources,
-                response_time=response_time,
-                num_docs=num_docs,
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-            )
+        saved = await run_db(lambda db: _save_chat_exchange(
+            db,
+            user_email=user_email,
+            conversation_id=conversation_id,
+            question=question,
+            answer=answer,
+            sources=sources,
+            response_time=response_time,
+            num_docs=num_docs,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        ))
 
         if not saved:
             raise_insufficient_tokens("Không đủ token để lưu câu trả lời này.")
@@ -514,42 +726,25 @@ async def chat(
     user_email = current_user["email"]
 
     try:
-        with UserDB() as db:
-            balance = db.get_token_balance(user_email)
-            if balance <= 0:
-                raise_insufficient_tokens()
-
-            conversation = (
-                db.get_conversation(user_email, request.conversation_id)
-                if request.conversation_id else
-                db.create_conversation(user_email, title=question[:40])
-            )
+        conversation = await run_db(lambda db: _get_or_create_chat_conversation(
+            db, user_email, request.conversation_id, question
+        ))
 
-            if not conversation:
-                raise HTTPException(
-                    status_code=404,
-                    detail=ApiError(
-                        message="Cuộc hội thoại không tồn tại.",
-                        error_code="CONVERSATION_NOT_FOUND"
-                    ).model_dump()
-                )
-
-        answer, sources, response_time, num_docs = run_chat_workflow(question)
-        input_tokens = get_chat_token_count(question)
-        output_tokens = get_chat_token_count(answer)
-
-        with UserDB() as db:
-            saved = db.save_chat_exchange_and_debit(
-                user_email=user_email,
-                conversation_id=conversation["id"],
-                question=question,
-                answer=answer,
-                sources=sources,
-                response_time=response_time,
-                num_docs=num_docs,
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-            )
+        answer, sources, response_time, num_docs = await arun_chat_workflow(question, split_mode=request.split_mode)
+        input_tokens, output_tokens = get_chat_token_counts(question, answer)
+
+        saved = await run_db(lambda db: _save_chat_exchange(
+            db,
+            user_email=user_email,
+            conversation_id=conversation["id"],
+            question=question,
+            answer=answer,
+            sources=sources,
+            response_time=response_time,
+            num_docs=num_docs,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        ))
 
         if not saved:
             raise_insufficient_tokens("Không đủ token để lưu câu trả lời này.")
@@ -586,6 +781,123 @@ async def chat(
         )
 
 
+@app.post("/api/chat/stream", tags=["Chat"])
+async def chat_stream(
+    request: ChatRequest,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user),
+):
+    """
+    Giống /api/chat nhưng stream câu trả lời bằng Server-Sent Events.
+
+    Các event theo thứ tự:
+        meta    -> {conversation_id, num_docs_retrieved, num_docs_graded}
+        token   -> {delta} (lặp lại cho từng chunk câu trả lời)
+        sources -> {sources}
+        done    -> {answer, token_used, balance, response_time, user_message, bot_message, conversation}
+        error   -> {message, error_code} (thay cho done nếu lỗi)
+    """
+    question = validate_question(request.question)
+    user_email = current_user["email"]
+
+    conversation = await run_db(lambda db: _get_or_create_chat_conversation(
+        db, user_email, request.conversation_id, question
+    ))
+    bot = await run_in_threadpool(get_chatbot)
+
+    async def event_stream():
+        start_time = time.time()
+        try:
+            input_state = {
+                "question": question,
+                "generation": "",
+                "documents": [],
+                "prompt": "",
+                "split_mode": request.split_mode or "",
+            }
+            cached = await lookup_answer_cache(bot, question, "", request.split_mode)
+            if cached is not None:
+                # Cache hit: gửi cả câu trả lời trong 1 event token
+                num_docs = cached["num_docs"]
+                answer, sources = cached["answer"], cached["sources"]
+                yield format_sse("meta", {
+                    "conversation_id": conversation["id"],
+                    "num_docs_retrieved": num_docs,
+                    "num_docs_graded": num_docs,
+                })
+                yield format_sse("token", {"delta": answer})
+            else:
+                state = await bot.retrieval_workflow.ainvoke(input_state)
+                docs = state.get("documents", [])
+                num_docs = len(docs)
+                yield format_sse("meta", {
+                    "conversation_id": conversation["id"],
+                    "num_docs_retrieved": num_docs,
+                    "num_docs_graded": num_docs,
+                })
+
+                answer_parts = []
+                async for delta in bot.agent.astream_answer(state):
+                    if await http_request.is_disconnected():
+                        logger.info(f"Client ngắt kết nối khi đang stream câu trả lời ({user_email})")
+                        return
+                    answer_parts.append(delta)
+                    yield format_sse("token", {"delta": delta})
+
+                answer = "".join(answer_parts).strip() or "Không thể tạo câu trả lời."
+                sources = build_sources(docs)
+                await store_answer_cache(bot, question, "", answer, sources, num_docs, request.split_mode)
+            yield format_sse("sources", {"sources": sources})
+
+            response_time = round(time.time() - start_time, 2)
+            input_tokens, output_tokens = get_chat_token_counts(question, answer)
+            saved = await run_db(lambda db: _save_chat_exchange(
+                db,
+                user_email=user_email,
+                conversation_id=conversation["id"],
+                question=question,
+                answer=answer,
+                sources=sources,
+                response_time=response_time,
+                num_docs=num_docs,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+            ))
+
+            if not saved:
+                yield format_sse("error", ApiError(
+                    message="Không đủ token để lưu câu trả lời này.",
+                    error_code="INSUFFICIENT_TOKENS"
+                ).model_dump())
+                return
+
+            yield format_sse("done", {
+                "answer": answer,
+                "response_time": response_time,
+                "token_used": saved["token_used"],
+                "balance": saved["balance"],
+                "conversation_id": conversation["id"],
+                "user_message": saved["user_message"],
+                "bot_message": saved["bot_message"],
+                "conversation": saved["conversation"],
+            })
+        except Exception as e:
+            logger.error(f"Lỗi stream chat: {e}", exc_info=True)
+            yield format_sse("error", ApiError(
+                message="Lỗi xử lý yêu cầu. Vui lòng thử lại sau.",
+                error_code="CHAT_PROCESSING_ERROR"
+            ).model_dump())
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Tắt buffer của nginx để token tới client ngay
+        },
+    )
+
+
 # ------------------------------------------------------------------
 # Chat History Endpoints (sử dụng Depends(get_current_user) thay vì Header thủ công)
 # ------------------------------------------------------------------
@@ -593,22 +905,30 @@ async def chat(
 async def get_chat_history(
     limit: int = 100,
     offset: int = 0,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
 ):
     """
     Lấy lịch sử chat của user đang đăng nhập.
     Yêu cầu JWT token (tự động xác thực qua Depends).
+    Trang sau: truyền lại next_cursor của response (keyset, không dùng offset).
     """
     user_email = current_user["email"]
 
-    with UserDB() as db:
-        messages = db.get_chat_history(user_email, limit=limit, offset=offset)
-        total = db.get_chat_message_count(user_email)
+    validate_cursor(cursor)
+    messages, total = await run_db(_read_after_flush(
+        user_email,
+        lambda db: (
+            db.get_chat_history(user_email, limit=limit, offset=offset, cursor=cursor),
+            db.get_chat_message_count(user_email),
+        ),
+    ))
 
     return ApiSuccess(
         data={
             "messages": messages,
             "total": total,
+            "next_cursor": next_page_cursor(messages, limit, "created_at", "id"),
             "user_email": user_email,
         }
     )
@@ -622,8 +942,7 @@ async def clear_chat_history(current_user: dict = Depends(get_current_user)):
     """
     user_email = current_user["email"]
 
-    with UserDB() as db:
-        deleted = db.clear_chat_history(user_email)
+    deleted = await run_db(_read_after_flush(user_email, lambda db: db.clear_chat_history(user_email)))
 
     return ApiSuccess(
         message="Xóa lịch sử thành công",
@@ -635,211 +954,199 @@ async def clear_chat_history(current_user: dict = Depends(get_current_user)):
 # Async Task Polling (skill_async_task_polling.md)
 # Dùng cho các tác vụ AI nặng (background processing)
 # ------------------------------------------------------------------
-TASK_RESULT_TTL_SECONDS = int(os.getenv("TASK_RESULT_TTL_SECONDS", "600"))
-TASK_PROCESSING_TIMEOUT_SECONDS = int(os.getenv("TASK_PROCESSING_TIMEOUT_SECONDS", "1800"))
-TASK_CLEANUP_INTERVAL_SECONDS = int(os.getenv("TASK_CLEANUP_INTERVAL_SECONDS", "60"))
-
-task_store: dict[str, dict] = {}  # In-memory store cho task status
-task_store_lock = RLock()
-last_task_cleanup = 0.0
-
-
-def _set_task_status(task_id: str, values: dict) -> None:
-    """Cập nhật task store có lock để tránh race giữa worker và polling."""
-    with task_store_lock:
-        current = task_store.get(task_id, {})
-        task_store[task_id] = {
-            **current,
-            **values,
-            "updated_at": time.time(),
-        }
-
-
-def _cleanup_task_store(force: bool = False) -> None:
-    """Dọn task cũ theo TTL để tránh leak RAM."""
-    global last_task_cleanup
-
-    now = time.time()
-    if not force and now - last_task_cleanup < TASK_CLEANUP_INTERVAL_SECONDS:
-        return
-
-    with task_store_lock:
-        last_task_cleanup = now
-
-        for task_id, task in list(task_store.items()):
-            status = task.get("status")
-            updated_at = float(task.get("updated_at", task.get("start_time", now)))
-            start_time = float(task.get("start_time", updated_at))
-
-            if status == "processing" and now - start_time > TASK_PROCESSING_TIMEOUT_SECONDS:
-                task_store[task_id] = {
-                    **task,
-                    "status": "failed",
-                    "error": "Task quá thời gian xử lý.",
-                    "updated_at": now,
-                }
-                continue
-
-            if status in {"done", "failed"} and now - updated_at > TASK_RESULT_TTL_SECONDS:
-                del task_store[task_id]
-
-
 class TaskRequest(BaseModel):
     """Schema cho yêu cầu tạo task bất đồng bộ."""
     question: str
     prompt: Optional[str] = None
+    split_mode: SplitMode = None
 
 
-def _heavy_chat_worker(
-    task_id: str,
-    question: str,
-    prompt: str,
-    user_email: str,
-):
+async def _heavy_chat_worker(task: dict, report_stage: Callable[[str], Awaitable[None]]) -> dict:
     """
-    Worker chạy trong background thread cho tác vụ AI nặng.
-    Hàm đồng bộ (def) để FastAPI chạy trong ThreadPool riêng,
-    tránh gây nghẽn Event Loop.
+    Handler của task queue cho tác vụ AI nặng.
+    Dùng chung arun_chat_workflow (async) nên không chiếm thread của threadpool
+    trong lúc chờ LLM; các bước DB chạy qua run_db.
     """
-    try:
-        bot = get_chatbot()
-        start_time = time.time()
-
-        input_state = {
-            "question": question,
-            "generation": "",
-            "documents": [],
-            "prompt": prompt or "",
-        }
+    task_id = task["id"]
+    user_email = task["user_email"]
+    question = task["payload"]["question"]
+    prompt = task["payload"].get("prompt") or ""
+    split_mode = task["payload"].get("split_mode")
+
+    answer, sources, response_time, num_docs = await arun_chat_workflow(
+        question, prompt, on_stage=report_stage, split_mode=split_mode
+    )
+    sources = [
+        {"content": source["content"], "source": source["source"]}
+        for source in sources
+    ]
+
+    input_tokens, output_tokens = get_chat_token_counts(question, answer)
+    token_used = input_tokens + output_tokens
+
+    # Trừ token + giữ id messages đồng bộ; lịch sử (không gắn conversation) ghi theo lô
+    saved = await run_db(lambda db: _save_chat_exchange(
+        db,
+        user_email=user_email,
+        conversation_id=None,
+        question=question,
+        answer=answer,
+        sources=sources,
+        response_time=response_time,
+        num_docs=num_docs,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        reason=f"async_chat:{task_id}",
+    ))
+    if saved is None:
+        raise TaskFailed("INSUFFICIENT_TOKENS")
+
+    return {
+        "answer": answer,
+        "sources": sources,
+        "response_time": response_time,
+        "num_docs": num_docs,
+        "token_used": token_used,
+    }
 
-        output_state = bot.compiled_workflow.invoke(input_state)
 
-        elapsed = time.time() - start_time
-        answer = output_state.get("generation", "Không thể tạo câu trả lời.")
-        docs = output_state.get("documents", [])
+# Hàng đợi bền vững (SQLite) dùng chung giữa các worker uvicorn, xem chatbot/services/task_queue.py
+task_queue = ChatTaskQueue(handler=_heavy_chat_worker)
+TASK_LONG_POLL_MAX_SECONDS = float(os.getenv("TASK_LONG_POLL_MAX_SECONDS", "30"))
+TASK_SSE_HEARTBEAT_SECONDS = float(os.getenv("TASK_SSE_HEARTBEAT_SECONDS", "15"))
 
-        sources = []
-        for doc in docs:
-            sources.append({
-                "content": doc.page_content[:500],
-                "source": doc.metadata.get("source", "Không rõ nguồn"),
-            })
 
-        input_tokens = get_chat_token_count(question)
-        output_tokens = get_chat_token_count(answer)
-        token_used = input_tokens + output_tokens
+def _task_not_found():
+    raise HTTPException(
+        status_code=404,
+        detail=ApiError(
+            message="Task không tồn tại.",
+            error_code="TASK_NOT_FOUND"
+        ).model_dump()
+    )
 
-        with UserDB() as db:
-            balance = db.debit_user_tokens(user_email, token_used, f"async_chat:{task_id}")
-        if balance is None:
-            _set_task_status(task_id, {
-                "status": "failed",
-                "error": "INSUFFICIENT_TOKENS",
-            })
-            return
 
-        # Cập nhật store
-        _set_task_status(task_id, {
-            "status": "done",
-            "result": {
-                "answer": answer,
-                "sources": sources,
-                "response_time": round(elapsed, 2),
-                "num_docs": len(docs),
-                "token_used": token_used,
-            }
-        })
+def _task_response(task: dict) -> dict:
+    response_data = {
+        "task_id": task["id"],
+        "status": task["status"],
+        "stage": task.get("stage"),
+        "updated_at": task.get("updated_at"),
+    }
 
-        # Lưu lịch sử nếu có user
-        if user_email:
-            try:
-                with UserDB() as db:
-                    db.save_chat_message(
-                        user_email=user_email, role="user", content=question,
-                        token_used=input_tokens
-                    )
-                    db.save_chat_message(
-                        user_email=user_email, role="bot", content=answer,
-                        sources=sources, response_time=round(elapsed, 2),
-                        num_docs=len(docs), token_used=output_tokens
-                    )
-            except Exception as db_err:
-                logger.warning(f"Không thể lưu lịch sử task: {db_err}")
-
-        logger.info(f"Task {task_id} hoàn thành sau {elapsed:.1f}s")
+    if task["status"] == "done":
+        response_data["result"] = task["result"]
+    elif task["status"] in {"failed", "cancelled"}:
+        response_data["error"] = task.get("error") or "Lỗi không xác định"
 
-    except Exception as e:
-        logger.error(f"Task {task_id} thất bại: {e}", exc_info=True)
-        _set_task_status(task_id, {
-            "status": "failed",
-            "error": str(e),
-        })
+    return response_data
 
 
 @app.post("/api/task/chat", tags=["Async Task"])
 async def start_chat_task(
     request: TaskRequest,
-    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user),
 ):
     """
     Khởi tạo tác vụ chat bất đồng bộ (background).
     Trả về task_id ngay lập tức, frontend polling để lấy kết quả.
-    Yêu cầu đăng nhập (JWT token).
+    Yêu cầu đăng nhập (JWT token). Trả 429 khi hàng đợi đã đầy.
     """
     question = validate_question(request.question)
-    task_id = str(uuid.uuid4())
     user_email = current_user["email"]
 
-    with UserDB() as db:
-        if db.get_token_balance(user_email) <= 0:
-            raise_insufficient_tokens()
+    if await run_db(lambda db: db.get_token_balance(user_email)) <= 0:
+        raise_insufficient_tokens()
 
-    get_chatbot()  # Kiểm tra chatbot sẵn sàng sau khi token hợp lệ
+    await run_in_threadpool(get_chatbot)  # Kiểm tra chatbot sẵn sàng sau khi token hợp lệ
 
-    # Đánh dấu trạng thái đang xử lý
-    _cleanup_task_store()
-    _set_task_status(task_id, {"status": "processing", "start_time": time.time()})
-
-    # Đẩy vào background task
-    background_tasks.add_task(
-        _heavy_chat_worker, task_id, question, request.prompt, user_email
-    )
+    try:
+        task = await task_queue.submit(user_email, {
+            "question": question,
+            "prompt": request.prompt,
+            "split_mode": request.split_mode,
+        })
+    except TaskQueueFull:
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "5"},
+            content=ApiError(
+                message="Hệ thống đang bận, vui lòng thử lại sau ít phút.",
+                error_code="TASK_QUEUE_FULL"
+            ).model_dump()
+        )
 
     return ApiSuccess(
         message="Tác vụ đã được khởi tạo",
-        data={"task_id": task_id, "status": "processing"}
+        data={"task_id": task["id"], "status": task["status"]}
     )
 
 
 @app.get("/api/task/{task_id}", tags=["Async Task"])
-async def get_task_status(task_id: str):
-    """
-    Kiểm tra trạng thái tác vụ bất đồng bộ.
-    Frontend gọi API này mỗi 2-3 giây để polling kết quả.
+async def get_task_status(
+    task_id: str,
+    wait: float = 0,
+    since: Optional[float] = None,
+):
     """
-    _cleanup_task_store()
-    with task_store_lock:
-        task = task_store.get(task_id)
-        task = dict(task) if task else None
+    Kiểm tra trạng thái tác vụ bất đồng bộ (queued | processing | done | failed | cancelled).
 
-    if not task:
-        raise HTTPException(
-            status_code=404,
-            detail=ApiError(
-                message="Task không tồn tại.",
-                error_code="TASK_NOT_FOUND"
-            ).model_dump()
+    Long-poll: truyền wait=<giây> (tối đa TASK_LONG_POLL_MAX_SECONDS) để server giữ request
+    tới khi task đổi trạng thái / stage thay vì polling mỗi 2-3 giây. `since` là updated_at
+    lần trước client nhận được (bỏ trống = chờ thay đổi kế tiếp).
+    """
+    if wait > 0:
+        task = await task_queue.wait_for_update(
+            task_id, since=since, timeout=min(wait, TASK_LONG_POLL_MAX_SECONDS)
         )
+    else:
+        task = await task_queue.get(task_id)
+    if not task:
+        _task_not_found()
 
-    response_data = {"task_id": task_id, "status": task["status"]}
+    return ApiSuccess(data=_task_response(task))
 
-    if task["status"] == "done":
-        response_data["result"] = task["result"]
-    elif task["status"] == "failed":
-        response_data["error"] = task.get("error", "Lỗi không xác định")
 
-    return ApiSuccess(data=response_data)
+@app.get("/api/task/{task_id}/events", tags=["Async Task"])
+async def stream_task_events(task_id: str, http_request: Request):
+    """
+    Server-Sent Events cho 1 task: event `status` mỗi khi task đổi trạng thái / stage
+    (kèm result khi done), comment keep-alive khi không có gì mới; đóng stream khi task kết thúc.
+    """
+    if not await task_queue.get(task_id):
+        _task_not_found()
+
+    async def event_stream():
+        async for task in task_queue.subscribe(task_id, heartbeat=TASK_SSE_HEARTBEAT_SECONDS):
+            if await http_request.is_disconnected():
+                return
+            if task is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_sse("status", _task_response(task))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@app.delete("/api/task/{task_id}", tags=["Async Task"])
+async def cancel_task(
+    task_id: str,
+    current_user: dict = Depends(get_current_user),
+):
+    """Hủy tác vụ đang chờ / đang chạy của user hiện tại."""
+    task = await task_queue.cancel(task_id, user_email=current_user["email"])
+    if not task or task.get("user_email") != current_user["email"]:
+        _task_not_found()
+
+    return ApiSuccess(message="Đã hủy tác vụ" if task["status"] == "cancelled" else "Tác vụ đã kết thúc",
+                      data=_task_response(task))
 
 
 # ------------------------------------------------------------------
@@ -0,0 +1,415 @@
+"""
+Hàng đợi tác vụ chat nền, bền vững (SQLite) và có giới hạn.
+
+Thay cho BackgroundTasks + task_store (dict trong RAM) của /api/task/chat:
+    - Bảng chat_tasks dùng chung giữa các worker uvicorn (cùng file SQLite),
+      trạng thái/kết quả không mất khi restart, polling vào worker nào cũng thấy.
+    - Mỗi process chạy TASK_CONCURRENCY worker async → giới hạn số câu hỏi
+      chạy đồng thời (LLM + embedder không bị quá tải khi có burst).
+    - TASK_QUEUE_MAX_DEPTH giới hạn tổng số task queued + processing;
+      vượt quá thì submit() ném TaskQueueFull (server trả 429).
+    - Hủy task: queued → cancelled ngay; processing → worker đang chạy task
+      (ở bất kỳ process nào) phát hiện qua DB và hủy coroutine.
+
+Trạng thái: queued -> processing -> done | failed | cancelled
+Trong lúc processing, cột stage cho biết bước hiện tại (retrieved, graded, generating).
+
+Thay đổi trạng thái được đẩy tới client qua wait_for_update() / subscribe():
+trong cùng process thì đánh thức ngay bằng asyncio.Event; task chạy ở worker
+uvicorn khác thì phát hiện qua DB sau tối đa TASK_POLL_INTERVAL_SECONDS.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+from uuid import uuid4
+
+from chatbot.utils.base_db import DB_PATH
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+ACTIVE_STATUSES = ("queued", "processing")
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class TaskQueueFull(Exception):
+    """Hàng đợi đã đủ TASK_QUEUE_MAX_DEPTH task đang chờ / đang chạy."""
+
+
+class TaskFailed(Exception):
+    """Handler báo task thất bại có chủ đích (message được lưu vào cột error)."""
+
+
+class ChatTaskQueue:
+    """
+    Hàng đợi task + pool worker async trong process hiện tại.
+
+    Args:
+        handler: async handler(task, report_stage) -> dict kết quả. Ném TaskFailed để báo
+            lỗi nghiệp vụ; await report_stage("retrieved") để cập nhật bước đang chạy.
+        db_path: File SQLite. Mặc định: chatbot/data/login_sessions.db (dùng chung với UserDB).
+        concurrency: Số task chạy đồng thời trong 1 process (env TASK_CONCURRENCY).
+        max_depth: Số task queued + processing tối đa toàn hệ thống (env TASK_QUEUE_MAX_DEPTH).
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict, Callable[[str], Awaitable[None]]], Awaitable[dict]],
+        db_path: str | None = None,
+        concurrency: int | None = None,
+        max_depth: int | None = None,
+    ) -> None:
+        self.handler = handler
+        self.db_path = db_path or os.getenv("TASK_DB_PATH", "") or str(DB_PATH)
+        self.concurrency = concurrency or int(os.getenv("TASK_CONCURRENCY", "2"))
+        self.max_depth = max_depth or int(os.getenv("TASK_QUEUE_MAX_DEPTH", "50"))
+        self.poll_interval = float(os.getenv("TASK_POLL_INTERVAL_SECONDS", "1.0"))
+        self.result_ttl = int(os.getenv("TASK_RESULT_TTL_SECONDS", "600"))
+        self.processing_timeout = int(os.getenv("TASK_PROCESSING_TIMEOUT_SECONDS", "1800"))
+        self.cleanup_interval = int(os.getenv("TASK_CLEANUP_INTERVAL_SECONDS", "60"))
+
+        self.worker_id = f"{os.getpid()}-{uuid4().hex[:8]}"
+        self._wakeup: asyncio.Event | None = None
+        self._workers: list[asyncio.Task] = []
+        self._monitor: asyncio.Task | None = None
+        self._running: dict[str, asyncio.Task] = {}
+        # Bật trong stop(): phân biệt worker bị dừng (shutdown) với user hủy task
+        self._stopping = False
+        self._watchers: dict[str, set[asyncio.Event]] = {}
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_tasks (
+                    id TEXT PRIMARY KEY,
+                    user_email TEXT,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    worker_id TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(chat_tasks)")}
+            if "stage" not in columns:
+                conn.execute("ALTER TABLE chat_tasks ADD COLUMN stage TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_tasks_status_created ON chat_tasks(status, created_at)")
+
+    # ------------------------------------------------------------------
+    # SQLite (đồng bộ — được gọi qua asyncio.to_thread)
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # autocommit: mỗi câu lệnh là 1 transaction, trừ khi BEGIN tường minh
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row | None) -> dict | None:
+        if row is None:
+            return None
+        task = dict(row)
+        task["payload"] = json.loads(task["payload"]) if task["payload"] else {}
+        task["result"] = json.loads(task["result"]) if task["result"] else None
+        return task
+
+    def _insert(self, user_email: str, payload: dict) -> dict:
+        now = time.time()
+        task_id = str(uuid4())
+        with self._connect() as conn:
+            # BEGIN IMMEDIATE: đếm độ sâu + insert là 1 thao tác nguyên tử giữa các process
+            conn.execute("BEGIN IMMEDIATE")
+            depth = conn.execute(
+                "SELECT COUNT(*) FROM chat_tasks WHERE status IN (?, ?)", ACTIVE_STATUSES
+            ).fetchone()[0]
+            if depth >= self.max_depth:
+                conn.execute("ROLLBACK")
+                raise TaskQueueFull(f"Hàng đợi đã đầy ({depth}/{self.max_depth}).")
+            conn.execute(
+                """
+                INSERT INTO chat_tasks (id, user_email, status, payload, created_at, updated_at)
+                VALUES (?, ?, 'queued', ?, ?, ?)
+                """,
+                (task_id, user_email, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            conn.execute("COMMIT")
+        return {"id": task_id, "status": "queued", "user_email": user_email, "created_at": now}
+
+    def _claim_next(self) -> dict | None:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                UPDATE chat_tasks
+                SET status = 'processing', worker_id = ?, started_at = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM chat_tasks WHERE status = 'queued'
+                    ORDER BY created_at LIMIT 1
+                ) AND status = 'queued'
+                RETURNING *
+                """,
+                (self.worker_id, now, now),
+            ).fetchone()
+        return self._row_to_dict(row)
+
+    def _finish(self, task_id: str, status: str, result: dict | None = None, error: str | None = None) -> bool:
+        """Chỉ cập nhật task còn 'processing' (task đã bị hủy thì giữ nguyên cancelled)."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE chat_tasks SET status = ?, result = ?, error = ?, updated_at = ?
+                WHERE id = ? AND status = 'processing'
+                """,
+                (
+                    status,
+                    json.dumps(result, ensure_ascii=False) if result is not None else None,
+                    error,
+                    time.time(),
+                    task_id,
+                ),
+            )
+            return cursor.rowcount > 0
+
+    def _set_stage(self, task_id: str, stage: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE chat_tasks SET stage = ?, updated_at = ? WHERE id = ? AND status = 'processing'",
+                (stage, time.time(), task_id),
+            )
+
+    def _get(self, task_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM chat_tasks WHERE id = ?", (task_id,)).fetchone()
+        return self._row_to_dict(row)
+
+    def _mark_cancelled(self, task_id: str, user_email: str | None) -> dict | None:
+        with self._connect() as conn:
+            query = """
+                UPDATE chat_tasks SET status = 'cancelled', error = 'Task đã bị hủy.', updated_at = ?
+                WHERE id = ? AND status IN ('queued', 'processing')
+            """
+            params: list[Any] = [time.time(), task_id]
+            if user_email is not None:
+                query += " AND user_email = ?"
+                params.append(user_email)
+            conn.execute(query, params)
+        return self._get(task_id)
+
+    def _cancelled_ids(self, task_ids: list[str]) -> set[str]:
+        if not task_ids:
+            return set()
+        placeholders = ",".join("?" * len(task_ids))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM chat_tasks WHERE status = 'cancelled' AND id IN ({placeholders})",
+                task_ids,
+            ).fetchall()
+        return {row["id"] for row in rows}
+
+    def _cleanup(self) -> None:
+        """Task processing quá hạn → failed (worker chết / restart); xóa task đã xong quá TTL."""
+        now = time.time()
+        with self._connect() as conn:
+            expired = conn.execute(
+                """
+                UPDATE chat_tasks SET status = 'failed', error = 'Task quá thời gian xử lý.', updated_at = ?
+                WHERE status = 'processing' AND started_at < ?
+                """,
+                (now, now - self.processing_timeout),
+            ).rowcount
+            removed = conn.execute(
+                "DELETE FROM chat_tasks WHERE status IN (?, ?, ?) AND updated_at < ?",
+                (*FINAL_STATUSES, now - self.result_ttl),
+            ).rowcount
+        if expired or removed:
+            logger.info(f"Task queue cleanup: {expired} task quá hạn, xóa {removed} task cũ.")
+
+    # ------------------------------------------------------------------
+    # API async
+    # ------------------------------------------------------------------
+
+    async def submit(self, user_email: str, payload: dict) -> dict:
+        """Thêm task vào hàng đợi. Ném TaskQueueFull khi đã đủ max_depth."""
+        task = await asyncio.to_thread(self._insert, user_email, payload)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return task
+
+    async def get(self, task_id: str) -> dict | None:
+        return await asyncio.to_thread(self._get, task_id)
+
+    async def wait_for_update(self, task_id: str, since: float | None = None, timeout: float = 25.0) -> dict | None:
+        """
+        Long-poll: trả về task khi updated_at > since, khi task đã kết thúc, hoặc khi hết timeout.
+
+        Args:
+            since: updated_at client đã thấy. None = chờ thay đổi kế tiếp kể từ lúc gọi.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(0.0, timeout)
+        event = asyncio.Event()
+        self._watchers.setdefault(task_id, set()).add(event)
+        try:
+            while True:
+                # Đăng ký event TRƯỚC khi đọc DB để không lỡ thông báo xảy ra giữa 2 bước
+                event.clear()
+                task = await self.get(task_id)
+                if task is None or task["status"] in FINAL_STATUSES:
+                    return task
+                if since is None:
+                    since = task["updated_at"]
+                elif task["updated_at"] > since:
+                    return task
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return task
+                try:
+                    # Task của worker khác không đánh thức event → tự đọc lại DB theo poll_interval
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            watchers = self._watchers.get(task_id)
+            if watchers is not None:
+                watchers.discard(event)
+                if not watchers:
+                    self._watchers.pop(task_id, None)
+
+    async def subscribe(self, task_id: str, heartbeat: float = 15.0) -> AsyncIterator[dict | None]:
+        """
+        Stream trạng thái task: yield task mỗi lần thay đổi (lần đầu là trạng thái hiện tại),
+        yield None sau mỗi `heartbeat` giây không có gì mới; dừng khi task kết thúc.
+        """
+        task = await self.get(task_id)
+        if task is None:
+            return
+        yield task
+        last_seen = task["updated_at"]
+        while task["status"] not in FINAL_STATUSES:
+            task = await self.wait_for_update(task_id, since=last_seen, timeout=heartbeat)
+            if task is None:
+                return
+            if task["updated_at"] > last_seen or task["status"] in FINAL_STATUSES:
+                last_seen = task["updated_at"]
+                yield task
+            else:
+                yield None
+
+    def _notify(self, task_id: str) -> None:
+        for event in self._watchers.get(task_id, ()):
+            event.set()
+
+    async def cancel(self, task_id: str, user_email: str | None = None) -> dict | None:
+        """Hủy task (chỉ task của user_email nếu truyền vào). Trả về task sau khi cập nhật."""
+        task = await asyncio.to_thread(self._mark_cancelled, task_id, user_email)
+        self._notify(task_id)
+        running = self._running.get(task_id)
+        if running is not None and task and task["status"] == "cancelled":
+            running.cancel()
+        return task
+
+    async def start(self) -> None:
+        """Khởi động worker pool (gọi trong lifespan của FastAPI)."""
+        if self._workers:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        await asyncio.to_thread(self._cleanup)
+        self._workers = [
+            asyncio.create_task(self._worker_loop(index), name=f"chat-task-worker-{index}")
+            for index in range(self.concurrency)
+        ]
+        self._monitor = asyncio.create_task(self._monitor_loop(), name="chat-task-monitor")
+        logger.info(
+            f"Task queue sẵn sàng: {self.concurrency} worker, tối đa {self.max_depth} task ({self.worker_id})"
+        )
+
+    async def stop(self) -> None:
+        """Dừng worker pool; task đang chạy bị hủy và đánh dấu failed để client không chờ mãi."""
+        self._stopping = True
+        tasks = [*self._workers, *([self._monitor] if self._monitor else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._monitor = None
+
+    async def _worker_loop(self, index: int) -> None:
+        while True:
+            task = await asyncio.to_thread(self._claim_next)
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._notify(task["id"])
+            await self._run_task(task)
+
+    async def _run_task(self, task: dict) -> None:
+        task_id = task["id"]
+        start_time = time.time()
+
+        async def report_stage(stage: str) -> None:
+            await asyncio.to_thread(self._set_stage, task_id, stage)
+            self._notify(task_id)
+
+        runner = asyncio.create_task(self.handler(task, report_stage))
+        self._running[task_id] = runner
+        try:
+            result = await runner
+            await asyncio.to_thread(self._finish, task_id, "done", result)
+            logger.info(f"Task {task_id} hoàn thành sau {time.time() - start_time:.1f}s")
+        except asyncio.CancelledError:
+            # Worker bị cancel thì runner đang await cũng bị cancel theo → runner.cancelled()
+            # không phân biệt được shutdown với user hủy, phải dựa vào cờ _stopping
+            if self._stopping or not runner.cancelled():
+                # Chính worker bị dừng (shutdown) → không để task treo ở processing
+                runner.cancel()
+                await asyncio.to_thread(self._finish, task_id, "failed", None, "Server dừng khi đang xử lý task.")
+                raise
+            logger.info(f"Task {task_id} đã bị hủy.")
+        except TaskFailed as e:
+            await asyncio.to_thread(self._finish, task_id, "failed", None, str(e))
+        except Exception as e:
+            logger.error(f"Task {task_id} thất bại: {e}", exc_info=True)
+            await asyncio.to_thread(self._finish, task_id, "failed", None, str(e))
+        finally:
+            self._running.pop(task_id, None)
+            self._notify(task_id)
+
+    async def _monitor_loop(self) -> None:
+        """Phát hiện task bị hủy từ process khác + dọn dẹp định kỳ."""
+        last_cleanup = time.time()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                cancelled = await asyncio.to_thread(self._cancelled_ids, list(self._running))
+                for task_id in cancelled:
+                    self._notify(task_id)
+                    runner = self._running.get(task_id)
+                    if runner is not None:
+                        runner.cancel()
+                if time.time() - last_cleanup >= self.cleanup_interval:
+                    last_cleanup = time.time()
+                    await asyncio.to_thread(self._cleanup)
+            except Exception as e:
+                logger.warning(f"Task queue monitor lỗi: {e}")
@@ -1,3 +1,5 @@
+import re
+
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableSequence
 from langchain_core.output_parsers import StrOutputParser
@@ -31,3 +33,68 @@ Câu hỏi: {question}"""),
     def get_chain(self) -> RunnableSequence:
         """Trả về chain sinh câu trả lời dựa trên question + context."""
         return self.chain
+
+
+THINK_PATTERN = re.compile(r"<think>.*?</think>", flags=re.DOTALL)
+
+
+def strip_think_tags(text: str) -> str:
+    """Xóa các khối <think>...</think> (model reasoning) khỏi câu trả lời."""
+    return THINK_PATTERN.sub("", text).strip()
+
+
+class ThinkTagFilter:
+    """
+    Lọc khối <think>...</think> khi câu trả lời được stream từng chunk.
+
+    Tag có thể bị cắt ngang giữa 2 chunk nên phần đuôi có khả năng là
+    đầu của tag sẽ được giữ lại tới chunk sau.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._in_think = False
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        """Nhận 1 chunk, trả về phần text đã an toàn để gửi cho client."""
+        self._buffer += chunk
+        output = []
+        while self._buffer:
+            tag = self.CLOSE_TAG if self._in_think else self.OPEN_TAG
+            index = self._buffer.find(tag)
+            if index >= 0:
+                if not self._in_think:
+                    output.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(tag):]
+                self._in_think = not self._in_think
+                continue
+
+            keep = self._partial_tag_length(tag)
+            if not self._in_think:
+                output.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return self._emit("".join(output))
+
+    def flush(self) -> str:
+        """Trả nốt phần còn giữ lại khi stream kết thúc."""
+        rest = "" if self._in_think else self._buffer
+        self._buffer = ""
+        return self._emit(rest)
+
+    def _partial_tag_length(self, tag: str) -> int:
+        for length in range(min(len(tag) - 1, len(self._buffer)), 0, -1):
+            if self._buffer.endswith(tag[:length]):
+                return length
+        return 0
+
+    def _emit(self, text: str) -> str:
+        # Bỏ khoảng trắng đầu câu trả lời (giống strip_think_tags)
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
@@ -0,0 +1,733 @@
+"""
+Tầng repository async cho users / conversations / chat history / token balance.
+
+Cùng tên method và dạng dữ liệu trả về như UserDB (base_db.py), chọn driver theo ASYNC_DB_TYPE
+(tách khỏi DB_TYPE vì UserDB đồng bộ vẫn chạy sqlite3 và đổi placeholder theo DB_TYPE):
+    - sqlite   : aiosqlite, dùng chung file và schema với UserDB (1 node, 1 hoặc vài worker).
+    - postgres : pool asyncpg (DATABASE_URL), cho nhiều worker / nhiều host mà không
+                 tranh write-lock của file SQLite.
+
+SQL viết 1 lần với placeholder "?"; driver Postgres đổi sang $1, $2, ...
+Id tự tăng lấy bằng RETURNING id (SQLite >= 3.35 và Postgres đều hỗ trợ) thay cho lastrowid.
+
+Không hỗ trợ write-behind (ChatHistoryWriter): chưa có debit_chat_exchange / write_history_batch,
+messages được INSERT ngay trong save_chat_exchange_and_debit. Đọc lịch sử cũng không dừng trước
+id đang chờ ghi (bảng pending_chat_messages của UserDB), nên khi dùng chung file SQLite với
+server đang bật HISTORY_WRITE_BEHIND, since_id / cursor lấy từ tầng này có thể vượt qua message
+chưa ghi. Dùng tầng async thì đặt HISTORY_WRITE_BEHIND=false.
+
+Dùng:
+    db = await create_async_db()
+    saved = await db.save_chat_exchange_and_debit(...)
+    await db.close()
+"""
+
+import asyncio
+import json
+import os
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator
+from uuid import uuid4
+
+from app.logger import get_logger
+from app.security.principal_cache import invalidate_principal
+from chatbot.utils.base_db import (
+    DB_BUSY_TIMEOUT_MS,
+    DB_PATH,
+    DB_POOL_SIZE,
+    DEFAULT_FREE_TOKENS,
+    SCHEMA_VERSION,
+    decode_cursor,
+    get_gravatar_url,
+    init_db,
+)
+
+logger = get_logger(__name__)
+
+DEFAULT_CONVERSATION_TITLE = "Cuộc hội thoại mới"
+
+# Schema Postgres tương đương _create_tables của UserDB (SQLite dùng lại migration của UserDB).
+# TIMESTAMP(0): làm tròn tới giây như CURRENT_TIMESTAMP của SQLite -> cursor keyset không mất độ chính xác.
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS login_sessions (
+        session_id TEXT PRIMARY KEY,
+        token TEXT,
+        status TEXT DEFAULT 'pending',
+        user_email TEXT,
+        user_name TEXT,
+        user_picture TEXT,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT UNIQUE NOT NULL,
+        name TEXT,
+        picture TEXT,
+        gravatar_url TEXT,
+        is_admin INTEGER DEFAULT 0,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+        last_login TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id BIGSERIAL PRIMARY KEY,
+        conversation_id TEXT,
+        user_email TEXT NOT NULL,
+        role TEXT NOT NULL CHECK(role IN ('user', 'bot')),
+        content TEXT NOT NULL,
+        sources TEXT DEFAULT '[]',
+        token_used INTEGER DEFAULT 0,
+        response_time DOUBLE PRECISION,
+        num_docs INTEGER DEFAULT 0,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        user_email TEXT NOT NULL,
+        title TEXT NOT NULL,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_user_created ON chat_messages(user_email, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_conversation_created ON chat_messages(conversation_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_email, updated_at, id)",
+    "DROP INDEX IF EXISTS idx_chat_user_email",
+    "DROP INDEX IF EXISTS idx_chat_conversation_id",
+    "DROP INDEX IF EXISTS idx_conversations_user_email",
+    """
+    CREATE TABLE IF NOT EXISTS user_message_counts (
+        user_email TEXT PRIMARY KEY,
+        message_count BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION chat_messages_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_message_counts (user_email, message_count)
+            VALUES (NEW.user_email, 1)
+            ON CONFLICT (user_email) DO UPDATE SET message_count = user_message_counts.message_count + 1;
+        ELSE
+            UPDATE user_message_counts SET message_count = message_count - 1 WHERE user_email = OLD.user_email;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_chat_messages_count ON chat_messages",
+    """
+    CREATE TRIGGER trg_chat_messages_count
+    AFTER INSERT OR DELETE ON chat_messages
+    FOR EACH ROW EXECUTE FUNCTION chat_messages_count()
+    """,
+    """
+    INSERT INTO user_message_counts (user_email, message_count)
+    SELECT user_email, COUNT(*) FROM chat_messages GROUP BY user_email
+    ON CONFLICT (user_email) DO UPDATE SET message_count = EXCLUDED.message_count
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_balances (
+        user_email TEXT PRIMARY KEY,
+        token_balance INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS token_transactions (
+        id BIGSERIAL PRIMARY KEY,
+        user_email TEXT NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        related_payment_id BIGINT,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_token_transactions_user_email ON token_transactions(user_email, created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS guest_usage (
+        guest_key TEXT NOT NULL,
+        usage_date TEXT NOT NULL,
+        question_count INTEGER NOT NULL DEFAULT 0,
+        token_used INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (guest_key, usage_date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payments (
+        id BIGSERIAL PRIMARY KEY,
+        user_email TEXT NOT NULL,
+        amount_vnd DOUBLE PRECISION NOT NULL,
+        package_id TEXT,
+        tokens INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        sepay_tx_id TEXT,
+        created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_sepay_tx_id_unique
+    ON payments(sepay_tx_id)
+    WHERE sepay_tx_id IS NOT NULL AND sepay_tx_id != ''
+    """,
+]
+
+
+def _format_value(value: Any) -> Any:
+    # Postgres trả datetime; SQLite trả chuỗi "YYYY-MM-DD HH:MM:SS" — thống nhất theo SQLite
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+class _Session:
+    """1 kết nối đang mượn từ pool; mọi method nhận SQL với placeholder "?"."""
+
+    async def fetchall(self, sql: str, *params) -> list[dict]:
+        raise NotImplementedError
+
+    async def fetchone(self, sql: str, *params) -> dict | None:
+        rows = await self.fetchall(sql, *params)
+        return rows[0] if rows else None
+
+    async def execute(self, sql: str, *params) -> int:
+        """Chạy câu lệnh ghi, trả số dòng bị ảnh hưởng."""
+        raise NotImplementedError
+
+
+class _SQLiteSession(_Session):
+    def __init__(self, conn) -> None:
+        self.conn = conn
+
+    async def fetchall(self, sql: str, *params) -> list[dict]:
+        async with self.conn.execute(sql, params) as cursor:
+            return [{key: _format_value(row[key]) for key in row.keys()} for row in await cursor.fetchall()]
+
+    async def execute(self, sql: str, *params) -> int:
+        async with self.conn.execute(sql, params) as cursor:
+            return cursor.rowcount
+
+
+class _PostgresSession(_Session):
+    _placeholder = re.compile(r"\?")
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+
+    @classmethod
+    def _convert(cls, sql: str) -> str:
+        counter = iter(range(1, sql.count("?") + 1))
+        return cls._placeholder.sub(lambda _: f"${next(counter)}", sql)
+
+    async def fetchall(self, sql: str, *params) -> list[dict]:
+        records = await self.conn.fetch(self._convert(sql), *params)
+        return [{key: _format_value(value) for key, value in record.items()} for record in records]
+
+    async def execute(self, sql: str, *params) -> int:
+        status = await self.conn.execute(self._convert(sql), *params)
+        # asyncpg trả status dạng "UPDATE 1" / "INSERT 0 1"
+        try:
+            return int(status.rsplit(" ", 1)[-1])
+        except ValueError:
+            return 0
+
+
+class SQLiteDriver:
+    """
+    Pool kết nối aiosqlite (mỗi kết nối có 1 thread riêng của aiosqlite).
+    PRAGMA giống SQLiteConnectionPool của UserDB: WAL, synchronous=NORMAL, busy_timeout.
+    """
+
+    def __init__(self, db_path: str | None = None, pool_size: int | None = None) -> None:
+        self.db_path = os.path.abspath(db_path or str(DB_PATH))
+        self.pool_size = pool_size or DB_POOL_SIZE
+        self._idle: asyncio.LifoQueue | None = None
+        self._connections: list = []
+
+    async def open(self) -> None:
+        import aiosqlite
+
+        # Schema do UserDB quản lý (bảng schema_version) -> 2 tầng luôn cùng phiên bản
+        await asyncio.to_thread(init_db, self.db_path)
+
+        self._idle = asyncio.LifoQueue()
+        for _ in range(self.pool_size):
+            # isolation_level=None: autocommit, transaction chỉ mở khi BEGIN tường minh
+            conn = await aiosqlite.connect(
+                self.db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None
+            )
+            conn.row_factory = sqlite3.Row
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    @staticmethod
+    def timestamp(value: str) -> str:
+        """Mốc thời gian trong cursor -> tham số SQL (SQLite lưu dạng chuỗi)."""
+        return value
+
+    async def close(self) -> None:
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+    @asynccontextmanager
+    async def session(self, write: bool = False) -> AsyncIterator[_Session]:
+        """write=True: BEGIN IMMEDIATE (giữ write-lock ngay từ đầu, tránh deadlock nâng cấp lock)."""
+        conn = await self._idle.get()
+        try:
+            if not write:
+                yield _SQLiteSession(conn)
+                return
+
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield _SQLiteSession(conn)
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+        finally:
+            self._idle.put_nowait(conn)
+
+
+class PostgresDriver:
+    """Pool asyncpg. Cần cài thêm: pip install asyncpg."""
+
+    def __init__(self, dsn: str | None = None, min_size: int = 1, max_size: int | None = None) -> None:
+        self.dsn = dsn or os.getenv("DATABASE_URL", "")
+        self.min_size = min_size
+        self.max_size = max_size or DB_POOL_SIZE
+        self.pool = None
+
+    async def open(self) -> None:
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError("ASYNC_DB_TYPE=postgres cần thư viện asyncpg (pip install asyncpg).") from e
+        if not self.dsn:
+            raise ValueError("ASYNC_DB_TYPE=postgres cần DATABASE_URL.")
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            # CURRENT_TIMESTAMP theo UTC giống SQLite
+            server_settings={"timezone": "UTC"},
+        )
+        await self._migrate()
+
+    async def _migrate(self) -> None:
+        """Tạo schema 1 lần; advisory lock để nhiều worker khởi động cùng lúc không migrate chồng nhau."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('llm_rag_schema'))")
+                await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+                current_version = await conn.fetchval("SELECT MAX(version) FROM schema_version") or 0
+                if current_version < SCHEMA_VERSION:
+                    for statement in POSTGRES_SCHEMA:
+                        await conn.execute(statement)
+                    await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", SCHEMA_VERSION)
+                    logger.info(f"Đã migrate schema Postgres: v{current_version} -> v{SCHEMA_VERSION}")
+
+    @staticmethod
+    def timestamp(value: str) -> datetime:
+        """Mốc thời gian trong cursor (chuỗi do _format_value tạo) -> datetime cho cột TIMESTAMP."""
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def session(self, write: bool = False) -> AsyncIterator[_Session]:
+        async with self.pool.acquire() as conn:
+            if not write:
+                yield _PostgresSession(conn)
+                return
+            async with conn.transaction():
+                yield _PostgresSession(conn)
+
+
+class AsyncUserDB:
+    """
+    Phiên bản async của UserDB cho users, conversations, chat history và token balance.
+
+    Args:
+        driver: SQLiteDriver hoặc PostgresDriver đã open().
+    """
+
+    def __init__(self, driver) -> None:
+        self.driver = driver
+
+    async def close(self) -> None:
+        await self.driver.close()
+
+    @staticmethod
+    def _message_row_to_dict(row: dict) -> dict:
+        return {
+            "id": row["id"],
+            "conversation_id": row["conversation_id"],
+            "user_email": row["user_email"],
+            "role": row["role"],
+            "content": row["content"],
+            "sources": json.loads(row["sources"] or "[]"),
+            "token_used": row["token_used"] or 0,
+            "response_time": row["response_time"],
+            "num_docs": row["num_docs"],
+            "created_at": row["created_at"],
+        }
+
+    @staticmethod
+    def _conversation_row_to_dict(row: dict) -> dict:
+        return {
+            "id": row["id"],
+            "user_email": row["user_email"],
+            "title": row["title"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    # ------------------------------------------------------------------
+    # User Management
+    # ------------------------------------------------------------------
+
+    async def upsert_user(self, email: str, name: str = None, picture: str = None) -> dict:
+        """Tạo hoặc cập nhật user khi đăng nhập (giống UserDB.upsert_user)."""
+        gravatar = get_gravatar_url(email)
+        final_picture = picture or gravatar
+
+        async with self.driver.session(write=True) as session:
+            await session.execute("""
+                INSERT INTO users (email, name, picture, gravatar_url, last_login)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(email) DO UPDATE SET
+                    name = excluded.name,
+                    picture = excluded.picture,
+                    gravatar_url = excluded.gravatar_url,
+                    last_login = CURRENT_TIMESTAMP
+            """, email, name, final_picture, gravatar)
+            await self._ensure_balance(session, email)
+        # Sau commit: get_current_user đọc lại profile mới thay vì bản trong principal_cache
+        invalidate_principal(email)
+
+        return await self.get_user_by_email(email)
+
+    async def get_user_by_email(self, email: str) -> dict | None:
+        async with self.driver.session() as session:
+            row = await session.fetchone("SELECT * FROM users WHERE email = ?", email)
+        if not row:
+            return None
+        return {
+            "id": row["id"],
+            "email": row["email"],
+            "name": row["name"],
+            "picture": row["picture"],
+            "gravatar_url": row["gravatar_url"],
+            "is_admin": bool(row["is_admin"]),
+            "created_at": row["created_at"],
+            "last_login": row["last_login"],
+        }
+
+    # ------------------------------------------------------------------
+    # Token Balance / Ledger
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    async def _ensure_balance(session: _Session, user_email: str, initial_tokens: int = DEFAULT_FREE_TOKENS) -> None:
+        await session.execute("""
+            INSERT INTO user_balances (user_email, token_balance)
+            VALUES (?, ?)
+            ON CONFLICT(user_email) DO NOTHING
+        """, user_email, int(initial_tokens))
+
+    @staticmethod
+    async def _balance(session: _Session, user_email: str) -> int:
+        row = await session.fetchone("SELECT token_balance FROM user_balances WHERE user_email = ?", user_email)
+        return int(row["token_balance"]) if row else 0
+
+    async def ensure_user_balance(self, user_email: str, initial_tokens: int = DEFAULT_FREE_TOKENS) -> int:
+        """Tạo balance mặc định cho user mới nếu chưa có."""
+        async with self.driver.session(write=True) as session:
+            await self._ensure_balance(session, user_email, initial_tokens)
+            return await self._balance(session, user_email)
+
+    async def get_token_balance(self, user_email: str, ensure: bool = True) -> int:
+        if ensure:
+            return await self.ensure_user_balance(user_email)
+        async with self.driver.session() as session:
+            return await self._balance(session, user_email)
+
+    async def get_token_transactions(self, user_email: str, limit: int = 50) -> list[dict]:
+        async with self.driver.session() as session:
+            return await session.fetchall("""
+                SELECT * FROM token_transactions
+                WHERE user_email = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, user_email, limit)
+
+    async def debit_user_tokens(self, user_email: str, token_count: int, reason: str) -> int | None:
+        """Trừ token nếu đủ balance. Trả balance mới hoặc None nếu không đủ."""
+        token_count = max(1, int(token_count))
+        async with self.driver.session(write=True) as session:
+            await self._ensure_balance(session, user_email)
+            if not await self._debit(session, user_email, token_count, reason):
+                return None
+            return await self._balance(session, user_email)
+
+    @staticmethod
+    async def _debit(session: _Session, user_email: str, token_count: int, reason: str) -> bool:
+        updated = await session.execute("""
+            UPDATE user_balances
+            SET token_balance = token_balance - ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_email = ? AND token_balance >= ?
+        """, token_count, user_email, token_count)
+        if updated == 0:
+            return False
+        await session.execute("""
+            INSERT INTO token_transactions (user_email, delta, reason)
+            VALUES (?, ?, ?)
+        """, user_email, -token_count, reason)
+        return True
+
+    # ------------------------------------------------------------------
+    # Conversation Management
+    # ------------------------------------------------------------------
+
+    async def create_conversation(self, user_email: str, title: str = None) -> dict:
+        conversation_id = str(uuid4())
+        safe_title = (title or DEFAULT_CONVERSATION_TITLE).strip()[:120] or DEFAULT_CONVERSATION_TITLE
+        async with self.driver.session(write=True) as session:
+            row = await session.fetchone("""
+                INSERT INTO conversations (id, user_email, title)
+                VALUES (?, ?, ?)
+                RETURNING *
+            """, conversation_id, user_email, safe_title)
+        return self._conversation_row_to_dict(row)
+
+    async def get_conversation(self, user_email: str, conversation_id: str) -> dict | None:
+        async with self.driver.session() as session:
+            row = await session.fetchone(
+                "SELECT * FROM conversations WHERE id = ? AND user_email = ?",
+                conversation_id, user_email,
+            )
+        return self._conversation_row_to_dict(row) if row else None
+
+    async def list_conversations(self, user_email: str, limit: int = 100, offset: int = 0,
+                                 cursor: str = None) -> list[dict]:
+        async with self.driver.session() as session:
+            if cursor:
+                updated_at, conversation_id = decode_cursor(cursor)
+                rows = await session.fetchall("""
+                    SELECT * FROM conversations
+                    WHERE user_email = ? AND (updated_at, id) < (?, ?)
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ?
+                """, user_email, self.driver.timestamp(updated_at), conversation_id, limit)
+            else:
+                rows = await session.fetchall("""
+                    SELECT * FROM conversations
+                    WHERE user_email = ?
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ? OFFSET ?
+                """, user_email, limit, offset)
+        return [self._conversation_row_to_dict(row) for row in rows]
+
+    async def update_conversation_title(self, user_email: str, conversation_id: str, title: str) -> dict | None:
+        safe_title = title.strip()[:120]
+        if not safe_title:
+            return await self.get_conversation(user_email, conversation_id)
+
+        async with self.driver.session(write=True) as session:
+            row = await session.fetchone("""
+                UPDATE conversations
+                SET title = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_email = ?
+                RETURNING *
+            """, safe_title, conversation_id, user_email)
+        return self._conversation_row_to_dict(row) if row else None
+
+    async def delete_conversation(self, user_email: str, conversation_id: str) -> bool:
+        async with self.driver.session(write=True) as session:
+            await session.execute(
+                "DELETE FROM chat_messages WHERE conversation_id = ? AND user_email = ?",
+                conversation_id, user_email,
+            )
+            deleted = await session.execute(
+                "DELETE FROM conversations WHERE id = ? AND user_email = ?",
+                conversation_id, user_email,
+            )
+        return deleted > 0
+
+    async def get_conversation_messages(self, user_email: str, conversation_id: str,
+                                        since_id: int = None, limit: int = None) -> list[dict] | None:
+        if not await self.get_conversation(user_email, conversation_id):
+            return None
+        async with self.driver.session() as session:
+            sql = """
+                SELECT * FROM chat_messages
+                WHERE conversation_id = ? AND user_email = ? AND id > ?
+                ORDER BY created_at ASC, id ASC
+            """
+            params = [conversation_id, user_email, since_id or 0]
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(limit)
+            rows = await session.fetchall(sql, *params)
+        return [self._message_row_to_dict(row) for row in rows]
+
+    # ------------------------------------------------------------------
+    # Chat History
+    # ------------------------------------------------------------------
+
+    async def save_chat_message(self, user_email: str, role: str, content: str,
+                                sources: list = None, response_time: float = None,
+                                num_docs: int = 0, conversation_id: str = None,
+                                token_used: int = 0) -> int:
+        sources_json = json.dumps(sources or [], ensure_ascii=False)
+        async with self.driver.session(write=True) as session:
+            row = await session.fetchone("""
+                INSERT INTO chat_messages
+                (conversation_id, user_email, role, content, sources, token_used, response_time, num_docs)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            """, conversation_id, user_email, role, content, sources_json, token_used, response_time, num_docs)
+        return row["id"]
+
+    async def get_chat_history(self, user_email: str, limit: int = 100, offset: int = 0,
+                               cursor: str = None) -> list[dict]:
+        async with self.driver.session() as session:
+            if cursor:
+                created_at, message_id = decode_cursor(cursor)
+                rows = await session.fetchall("""
+                    SELECT * FROM chat_messages
+                    WHERE user_email = ? AND (created_at, id) > (?, ?)
+                    ORDER BY created_at ASC, id ASC
+                    LIMIT ?
+                """, user_email, self.driver.timestamp(created_at), message_id, limit)
+            else:
+                rows = await session.fetchall("""
+                    SELECT * FROM chat_messages
+                    WHERE user_email = ?
+                    ORDER BY created_at ASC, id ASC
+                    LIMIT ? OFFSET ?
+                """, user_email, limit, offset)
+        return [
+            {
+                "id": row["id"],
+                "role": row["role"],
+                "content": row["content"],
+                "sources": json.loads(row["sources"] or "[]"),
+                "response_time": row["response_time"],
+                "num_docs": row["num_docs"],
+                "created_at": row["created_at"],
+            }
+            for row in rows
+        ]
+
+    async def get_chat_message_count(self, user_email: str) -> int:
+        async with self.driver.session() as session:
+            row = await session.fetchone(
+                "SELECT message_count FROM user_message_counts WHERE user_email = ?", user_email
+            )
+        return int(row["message_count"]) if row else 0
+
+    async def clear_chat_history(self, user_email: str) -> int:
+        async with self.driver.session(write=True) as session:
+            return await session.execute("DELETE FROM chat_messages WHERE user_email = ?", user_email)
+
+    async def save_chat_exchange_and_debit(
+        self,
+        user_email: str,
+        conversation_id: str,
+        question: str,
+        answer: str,
+        sources: list,
+        response_time: float,
+        num_docs: int,
+        input_tokens: int,
+        output_tokens: int,
+    ) -> dict | None:
+        """
+        Lưu user/bot messages và trừ balance trong cùng transaction.
+        Trả None nếu conversation không thuộc user hoặc không đủ token.
+        """
+        total_tokens = max(1, int(input_tokens) + int(output_tokens))
+        sources_json = json.dumps(sources or [], ensure_ascii=False)
+        title = question.replace("\n", " ").strip()
+
+        async with self.driver.session(write=True) as session:
+            owner = await session.fetchone(
+                "SELECT id FROM conversations WHERE id = ? AND user_email = ?",
+                conversation_id, user_email,
+            )
+            if not owner:
+                return None
+
+            await self._ensure_balance(session, user_email)
+            if not await self._debit(session, user_email, total_tokens, f"chat:{conversation_id}"):
+                return None
+
+            user_row = await session.fetchone("""
+                INSERT INTO chat_messages
+                (conversation_id, user_email, role, content, token_used)
+                VALUES (?, ?, 'user', ?, ?)
+                RETURNING *
+            """, conversation_id, user_email, question, input_tokens)
+            bot_row = await session.fetchone("""
+                INSERT INTO chat_messages
+                (conversation_id, user_email, role, content, sources, token_used, response_time, num_docs)
+                VALUES (?, ?, 'bot', ?, ?, ?, ?, ?)
+                RETURNING *
+            """, conversation_id, user_email, answer, sources_json, output_tokens, response_time, num_docs)
+
+            conversation = await session.fetchone("""
+                UPDATE conversations
+                SET title = CASE WHEN title = ? AND ? != '' THEN ? ELSE title END,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_email = ?
+                RETURNING *
+            """, DEFAULT_CONVERSATION_TITLE, title, title[:40], conversation_id, user_email)
+            balance = await self._balance(session, user_email)
+
+        return {
+            "token_used": total_tokens,
+            "balance": balance,
+            "user_message": self._message_row_to_dict(user_row),
+            "bot_message": self._message_row_to_dict(bot_row),
+            "conversation": self._conversation_row_to_dict(conversation),
+        }
+
+
+async def create_async_db(db_type: str | None = None, **driver_kwargs) -> AsyncUserDB:
+    """
+    Tạo và mở AsyncUserDB theo ASYNC_DB_TYPE (sqlite | postgres).
+
+    Args:
+        driver_kwargs: Truyền thẳng cho driver (db_path cho SQLite, dsn cho Postgres).
+    """
+    db_type = (db_type or os.getenv("ASYNC_DB_TYPE", "sqlite")).strip().lower()
+    if db_type == "sqlite":
+        driver = SQLiteDriver(**driver_kwargs)
+    elif db_type in {"postgres", "postgresql"}:
+        driver = PostgresDriver(**driver_kwargs)
+    else:
+        raise ValueError(f"ASYNC_DB_TYPE không hỗ trợ: {db_type}")
+
+    await driver.open()
+    logger.info(f"Async DB sẵn sàng (driver={type(driver).__name__}).")
+    return AsyncUserDB(driver)
@@ -10,15 +10,19 @@ Tham chiếu:
     - docs/DOCS-main/skill_security_authentication.md
 """
 
+import base64
 import hashlib
 import json
+import queue
 import sqlite3
 import os
+import threading
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from uuid import uuid4
 
 from app.logger import get_logger
+from app.security.principal_cache import invalidate_principal
 
 logger = get_logger(__name__)
 
@@ -33,6 +37,13 @@ DEFAULT_FREE_TOKENS = int(os.getenv("DEFAULT_FREE_TOKENS", "100"))
 GUEST_DAILY_QUESTION_LIMIT = int(os.getenv("GUEST_DAILY_QUESTION_LIMIT", "5"))
 GUEST_DAILY_TOKEN_LIMIT = int(os.getenv("GUEST_DAILY_TOKEN_LIMIT", "2000"))
 
+# Tăng khi _create_tables có thay đổi schema (bảng/cột/index mới)
+SCHEMA_VERSION = 3
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Id message đã giữ trước nhưng quá hạn này vẫn chưa ghi (worker crash) thì đọc lịch sử không chờ nữa
+HISTORY_PENDING_MAX_AGE_SECONDS = int(os.getenv("HISTORY_PENDING_MAX_AGE_SECONDS", "60"))
+
 
 def get_gravatar_url(email: str) -> str:
     """
@@ -51,12 +62,132 @@ def get_gravatar_url(email: str) -> str:
     return f"https://www.gravatar.com/avatar/{email_hash}?d=identicon"
 
 
+class SQLiteConnectionPool:
+    """
+    Pool kết nối SQLite dùng chung trong process cho 1 file database.
+
+    - journal_mode=WAL: writer không chặn reader; synchronous=NORMAL an toàn với WAL và
+      không fsync mỗi commit.
+    - busy_timeout: chờ lock thay vì lỗi "database is locked" ngay khi có writer khác.
+    - Kết nối được dùng lại nên cache prepared statement (cached_statements) của nó cũng
+      được dùng lại qua các request.
+    - Pool rỗng thì mở kết nối mới; trả về lúc pool đã đủ max_size thì đóng kết nối đó.
+
+    Mỗi kết nối chỉ được 1 thread dùng tại 1 thời điểm (acquire -> release).
+    """
+
+    def __init__(self, db_path: str, max_size: int = None, busy_timeout_ms: int = None):
+        self.db_path = db_path
+        self.max_size = max_size or DB_POOL_SIZE
+        self.busy_timeout_ms = busy_timeout_ms or DB_BUSY_TIMEOUT_MS
+        # LIFO: kết nối vừa trả về còn nóng cache statement / page cache
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=self.max_size)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        """Trả kết nối về pool; transaction còn dở (do lỗi giữa chừng) bị rollback."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools: dict[str, SQLiteConnectionPool] = {}
+_pools_lock = threading.Lock()
+_schema_ready: set[str] = set()
+_schema_lock = threading.Lock()
+
+
+def get_connection_pool(db_path: str = None) -> SQLiteConnectionPool:
+    """Pool dùng chung của process cho file database (mỗi đường dẫn 1 pool)."""
+    db_path = os.path.abspath(db_path or str(DB_PATH))
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                pool = _pools[db_path] = SQLiteConnectionPool(db_path)
+    return pool
+
+
+def encode_cursor(*values) -> str:
+    """Cursor phân trang keyset (opaque cho client): các giá trị khóa sắp xếp của dòng cuối trang."""
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int = 2) -> list:
+    """Giải mã cursor của encode_cursor. Ném ValueError nếu cursor không hợp lệ."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except Exception as e:
+        raise ValueError("Cursor không hợp lệ.") from e
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Cursor không hợp lệ.")
+    return values
+
+
+def next_page_cursor(items: list[dict], limit: int, *keys: str) -> str | None:
+    """Cursor trang sau (None nếu trang hiện tại chưa đầy, tức đã hết dữ liệu)."""
+    if not items or len(items) < limit:
+        return None
+    return encode_cursor(*(items[-1][key] for key in keys))
+
+
+def init_db(db_path: str = None):
+    """Chạy migration schema (gọi 1 lần lúc khởi động server)."""
+    with UserDB(db_path):
+        pass
+
+
+def close_db_pools():
+    """Đóng toàn bộ kết nối đang rảnh (khi tắt server)."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_all()
+
+
 class UserDB:
     """Quản lý SQLite database cho login sessions và chat history."""
 
     def __init__(self, db_path: str = None):
         """
-        Khởi tạo kết nối đến SQLite database.
+        Lấy kết nối từ pool dùng chung; schema chỉ được kiểm tra/migrate ở lần đầu
+        mỗi process mở database này.
 
         Args:
             db_path: Đường dẫn đến file database. Mặc định: chatbot/data/login_sessions.db
@@ -67,15 +198,42 @@ class UserDB:
         self.db_type = os.getenv("DB_TYPE", "sqlite")
         self.P = "?" if self.db_type == "sqlite" else "%s"
 
-        # Đảm bảo thư mục tồn tại
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row
+        self._pool = get_connection_pool(self.db_path)
+        self.conn = self._pool.acquire()
         self.cursor = self.conn.cursor()
 
-        # Tạo bảng nếu chưa có
-        self._create_tables()
+        # Tạo bảng / migrate nếu schema cũ hơn SCHEMA_VERSION
+        self._ensure_schema()
+
+    def _ensure_schema(self):
+        """
+        Migrate schema 1 lần cho mỗi process. Phiên bản đã áp dụng lưu trong bảng schema_version;
+        BEGIN IMMEDIATE để các worker uvicorn khởi động cùng lúc không migrate chồng nhau.
+        """
+        if self._pool.db_path in _schema_ready:
+            return
+
+        with _schema_lock:
+            if self._pool.db_path in _schema_ready:
+                return
+
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+                self.cursor.execute("SELECT MAX(version) AS version FROM schema_version")
+                current_version = self.cursor.fetchone()["version"] or 0
+                if current_version < SCHEMA_VERSION:
+                    self._create_tables()
+                    self.cursor.execute(
+                        f"INSERT INTO schema_version (version) VALUES ({self.P})", (SCHEMA_VERSION,)
+                    )
+                    logger.info(f"Da migrate schema {self.db_path}: v{current_version} -> v{SCHEMA_VERSION}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+            _schema_ready.add(self._pool.db_path)
 
     def _table_columns(self, table_name: str) -> set[str]:
         self.cursor.execute(f"PRAGMA table_info({table_name})")
@@ -141,18 +299,66 @@ class UserDB:
             )
         """)
 
-        # Index cho truy van nhanh theo user_email
+        # Index khớp thứ tự phân trang keyset (khóa, thời gian, id); thay các index v1 chỉ theo khóa
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_chat_user_created
+            ON chat_messages(user_email, created_at, id)
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_chat_conversation_created
+            ON chat_messages(conversation_id, created_at, id)
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conversations_user_updated
+            ON conversations(user_email, updated_at, id)
+        """)
+        for old_index in ("idx_chat_user_email", "idx_chat_conversation_id", "idx_conversations_user_email"):
+            self.cursor.execute(f"DROP INDEX IF EXISTS {old_index}")
+
+        # Bộ đếm message theo user (trigger cập nhật) thay cho COUNT(*) mỗi lần phân trang
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_message_counts (
+                user_email TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_count_insert
+            AFTER INSERT ON chat_messages
+            BEGIN
+                INSERT INTO user_message_counts (user_email, message_count)
+                VALUES (NEW.user_email, 1)
+                ON CONFLICT(user_email) DO UPDATE SET message_count = message_count + 1;
+            END
+        """)
         self.cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_user_email 
-            ON chat_messages(user_email)
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_count_delete
+            AFTER DELETE ON chat_messages
+            BEGIN
+                UPDATE user_message_counts
+                SET message_count = message_count - 1
+                WHERE user_email = OLD.user_email;
+            END
         """)
+        # Chạy trong transaction migrate (đang giữ write-lock) nên không lệch với trigger
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO user_message_counts (user_email, message_count)
+            SELECT user_email, COUNT(*) FROM chat_messages GROUP BY user_email
+        """)
+
+        # Id messages đã giữ trước (debit_chat_exchange) nhưng chưa ghi (write_history_batch).
+        # Đọc lịch sử dừng trước id chờ ghi nhỏ nhất của user để since_id / cursor không vượt qua
+        # message còn nằm trong hàng đợi của worker khác.
         self.cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_conversation_id
-            ON chat_messages(conversation_id)
+            CREATE TABLE IF NOT EXISTS pending_chat_messages (
+                first_id INTEGER PRIMARY KEY,
+                user_email TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL
+            )
         """)
         self.cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_conversations_user_email
-            ON conversations(user_email, updated_at)
+            CREATE INDEX IF NOT EXISTS idx_pending_chat_messages_user
+            ON pending_chat_messages(user_email, first_id)
         """)
 
         self.cursor.execute("""
@@ -214,8 +420,6 @@ class UserDB:
         except sqlite3.IntegrityError:
             logger.warning("Khong the tao unique index cho sepay_tx_id vi dang co du lieu trung.")
 
-        self.conn.commit()
-
     # ------------------------------------------------------------------
     # User Management
     # ------------------------------------------------------------------
@@ -247,11 +451,40 @@ class UserDB:
                 last_login = CURRENT_TIMESTAMP
         """, (email, name, final_picture, gravatar))
         self.conn.commit()
+        invalidate_principal(email)
 
         self.ensure_user_balance(email)
 
         return self.get_user_by_email(email)
 
+    def set_user_admin(self, email: str, is_admin: bool) -> bool:
+        """
+        Cấp / thu hồi quyền admin. Cache principal của user bị xóa ngay để quyền mới có hiệu lực.
+
+        Returns:
+            True nếu user tồn tại.
+        """
+        self.cursor.execute(
+            f"UPDATE users SET is_admin = {self.P} WHERE email = {self.P}",
+            (1 if is_admin else 0, email)
+        )
+        self.conn.commit()
+        invalidate_principal(email)
+        return self.cursor.rowcount > 0
+
+    def delete_user(self, email: str) -> bool:
+        """
+        Xóa tài khoản user (lịch sử chat và ledger token được giữ lại).
+        Token JWT còn hạn của user bị từ chối ngay từ request tiếp theo.
+
+        Returns:
+            True nếu xóa thành công.
+        """
+        self.cursor.execute(f"DELETE FROM users WHERE email = {self.P}", (email,))
+        self.conn.commit()
+        invalidate_principal(email)
+        return self.cursor.rowcount > 0
+
     def get_user_by_email(self, email: str) -> dict | None:
         """
         Lấy thông tin user theo email.
@@ -446,26 +679,68 @@ class UserDB:
         self.conn.commit()
         return self.cursor.lastrowid
 
+    def _first_pending_message(self, user_email: str) -> sqlite3.Row | None:
+        """
+        Message chờ ghi (write-behind) sớm nhất của user: (first_id, created_at) hoặc None.
+
+        Id được giữ trước lúc trừ token nhưng chỉ được INSERT khi writer của worker đó flush, nên
+        worker khác có thể đã ghi id lớn hơn. Đọc lịch sử dừng trước message này (read-your-writes
+        giữa các worker): client không bao giờ nhận cursor / since_id vượt qua message chưa ghi.
+        Id giữ quá HISTORY_PENDING_MAX_AGE_SECONDS (worker crash, chờ replay) thì bỏ qua.
+        """
+        cutoff = (
+            datetime.now(timezone.utc) - timedelta(seconds=HISTORY_PENDING_MAX_AGE_SECONDS)
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        self.cursor.execute(f"""
+            SELECT first_id, created_at FROM pending_chat_messages
+            WHERE user_email = {self.P} AND created_at >= {self.P}
+            ORDER BY first_id ASC
+            LIMIT 1
+        """, (user_email, cutoff))
+        return self.cursor.fetchone()
+
     def get_chat_history(self, user_email: str, limit: int = 100,
-                         offset: int = 0) -> list[dict]:
+                         offset: int = 0, cursor: str = None) -> list[dict]:
         """
         Lấy lịch sử chat của user, sắp xếp từ cũ đến mới.
+        Dừng trước message còn chờ ghi (xem _first_pending_message).
 
         Args:
             user_email: Email của user.
             limit: Số tin nhắn tối đa trả về. Mặc định: 100.
-            offset: Bỏ qua bao nhiêu tin nhắn đầu. Mặc định: 0.
+            offset: Bỏ qua bao nhiêu tin nhắn đầu. Mặc định: 0 (bị bỏ qua khi có cursor).
+            cursor: Cursor keyset của trang trước (next_page_cursor theo created_at, id).
+                Đọc thẳng từ index (user_email, created_at, id), không quét lại offset dòng đầu.
 
         Returns:
             Danh sách dict tin nhắn.
+
+        Raises:
+            ValueError: Nếu cursor không hợp lệ.
         """
-        self.cursor.execute(f"""
-            SELECT * FROM chat_messages
-            WHERE user_email = {self.P}
-            ORDER BY created_at ASC
-            LIMIT {self.P} OFFSET {self.P}""",
-            (user_email, limit, offset)
-        )
+        pending = self._first_pending_message(user_email)
+        pending_clause, pending_params = "", ()
+        if pending is not None:
+            pending_clause = f" AND (created_at, id) < ({self.P}, {self.P})"
+            pending_params = (pending["created_at"], pending["first_id"])
+
+        if cursor:
+            created_at, message_id = decode_cursor(cursor)
+            self.cursor.execute(f"""
+                SELECT * FROM chat_messages
+                WHERE user_email = {self.P} AND (created_at, id) > ({self.P}, {self.P}){pending_clause}
+                ORDER BY created_at ASC, id ASC
+                LIMIT {self.P}""",
+                (user_email, created_at, message_id, *pending_params, limit)
+            )
+        else:
+            self.cursor.execute(f"""
+                SELECT * FROM chat_messages
+                WHERE user_email = {self.P}{pending_clause}
+                ORDER BY created_at ASC, id ASC
+                LIMIT {self.P} OFFSET {self.P}""",
+                (user_email, *pending_params, limit, offset)
+            )
         rows = self.cursor.fetchall()
 
         messages = []
@@ -491,11 +766,13 @@ class UserDB:
         Returns:
             Số lượng tin nhắn.
         """
+        # Bộ đếm do trigger của chat_messages cập nhật, không COUNT(*) lại toàn bộ lịch sử
         self.cursor.execute(
-            f"SELECT COUNT(*) as cnt FROM chat_messages WHERE user_email = {self.P}",
+            f"SELECT message_count FROM user_message_counts WHERE user_email = {self.P}",
             (user_email,)
         )
-        return self.cursor.fetchone()["cnt"]
+        row = self.cursor.fetchone()
+        return int(row["message_count"]) if row else 0
 
     def clear_chat_history(self, user_email: str) -> int:
         """
@@ -563,14 +840,31 @@ class UserDB:
         row = self.cursor.fetchone()
         return self._conversation_row_to_dict(row) if row else None
 
-    def list_conversations(self, user_email: str, limit: int = 100, offset: int = 0) -> list[dict]:
-        """Liệt kê cuộc hội thoại của user, mới nhất trước."""
-        self.cursor.execute(f"""
-            SELECT * FROM conversations
-            WHERE user_email = {self.P}
-            ORDER BY updated_at DESC
-            LIMIT {self.P} OFFSET {self.P}
-        """, (user_email, limit, offset))
+    def list_conversations(self, user_email: str, limit: int = 100, offset: int = 0,
+                           cursor: str = None) -> list[dict]:
+        """
+        Liệt kê cuộc hội thoại của user, mới nhất trước.
+        cursor: keyset theo (updated_at, id) của dòng cuối trang trước; có cursor thì bỏ qua offset.
+
+        updated_at thay đổi mỗi khi có tin nhắn mới: hội thoại được cập nhật trong lúc client đang
+        duyệt các trang sau sẽ nhảy lên đầu danh sách và không xuất hiện ở trang sau nữa (không bị
+        lặp). Client cần danh sách đầy đủ thì tải lại từ trang đầu.
+        """
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            self.cursor.execute(f"""
+                SELECT * FROM conversations
+                WHERE user_email = {self.P} AND (updated_at, id) < ({self.P}, {self.P})
+                ORDER BY updated_at DESC, id DESC
+                LIMIT {self.P}
+            """, (user_email, updated_at, conversation_id, limit))
+        else:
+            self.cursor.execute(f"""
+                SELECT * FROM conversations
+                WHERE user_email = {self.P}
+                ORDER BY updated_at DESC, id DESC
+                LIMIT {self.P} OFFSET {self.P}
+            """, (user_email, limit, offset))
         return [self._conversation_row_to_dict(row) for row in self.cursor.fetchall()]
 
     def update_conversation_title(self, user_email: str, conversation_id: str, title: str) -> dict | None:
@@ -601,16 +895,31 @@ class UserDB:
         self.conn.commit()
         return deleted
 
-    def get_conversation_messages(self, user_email: str, conversation_id: str) -> list[dict] | None:
-        """Lấy messages của conversation nếu thuộc user."""
+    def get_conversation_messages(self, user_email: str, conversation_id: str,
+                                  since_id: int = None, limit: int = None) -> list[dict] | None:
+        """
+        Lấy messages của conversation nếu thuộc user.
+
+        Args:
+            since_id: Chỉ lấy messages có id > since_id (client đang mở conversation chỉ tải phần mới).
+                Kết quả dừng trước message còn chờ ghi (xem _first_pending_message) nên id cuối
+                cùng trả về luôn dùng được làm since_id lần sau.
+            limit: Số messages tối đa (mặc định: tất cả).
+        """
         if not self.get_conversation(user_email, conversation_id):
             return None
 
+        pending = self._first_pending_message(user_email)
         self.cursor.execute(f"""
             SELECT * FROM chat_messages
-            WHERE conversation_id = {self.P} AND user_email = {self.P}
+            WHERE conversation_id = {self.P} AND user_email = {self.P} AND id > {self.P} AND id < {self.P}
             ORDER BY created_at ASC, id ASC
-        """, (conversation_id, user_email))
+            LIMIT {self.P}
+        """, (
+            conversation_id, user_email, since_id or 0,
+            pending["first_id"] if pending is not None else 2 ** 63 - 1,
+            -1 if limit is None else limit,
+        ))
         return [self._message_row_to_dict(row) for row in self.cursor.fetchall()]
 
     def save_chat_exchange_and_debit(
@@ -706,6 +1015,195 @@ class UserDB:
             self.conn.rollback()
             raise
 
+    def _reserve_message_ids(self, count: int) -> int:
+        """
+        Giữ trước count id liên tiếp của chat_messages (gọi trong transaction đang giữ write-lock).
+        AUTOINCREMENT không bao giờ cấp lại id <= sqlite_sequence.seq nên id đã giữ không bị trùng,
+        kể cả với worker khác. Trả về id đầu tiên.
+        """
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_messages'")
+        row = self.cursor.fetchone()
+        if row is None:
+            self.cursor.execute("SELECT COALESCE(MAX(id), 0) AS seq FROM chat_messages")
+            current = self.cursor.fetchone()["seq"]
+            self.cursor.execute(
+                f"INSERT INTO sqlite_sequence (name, seq) VALUES ('chat_messages', {self.P})",
+                (current + count,)
+            )
+        else:
+            current = row["seq"]
+            self.cursor.execute(
+                f"UPDATE sqlite_sequence SET seq = {self.P} WHERE name = 'chat_messages'",
+                (current + count,)
+            )
+        return current + 1
+
+    def debit_chat_exchange(
+        self,
+        user_email: str,
+        conversation_id: str | None,
+        question: str,
+        answer: str,
+        sources: list,
+        response_time: float,
+        num_docs: int,
+        input_tokens: int,
+        output_tokens: int,
+        reason: str = None,
+    ) -> dict | None:
+        """
+        Phần đồng bộ của write-behind (ChatHistoryWriter): trừ balance + ghi ledger và giữ trước id
+        cho 2 messages trong 1 transaction. Messages và cập nhật conversation được trả về ở
+        "records" để ghi sau theo lô.
+
+        Args:
+            conversation_id: None = lịch sử không gắn cuộc hội thoại (task bất đồng bộ).
+            reason: Lý do trong ledger. Mặc định: "chat:<conversation_id>".
+
+        Returns:
+            Dict cùng dạng save_chat_exchange_and_debit + "records";
+            None nếu conversation không thuộc user hoặc không đủ token.
+        """
+        total_tokens = max(1, int(input_tokens) + int(output_tokens))
+
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            # Lấy thời điểm khi đã giữ write-lock: created_at tăng cùng chiều với id giữ trước
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            conversation = None
+            if conversation_id is not None:
+                self.cursor.execute(f"""
+                    SELECT * FROM conversations
+                    WHERE id = {self.P} AND user_email = {self.P}
+                """, (conversation_id, user_email))
+                row = self.cursor.fetchone()
+                if not row:
+                    self.conn.rollback()
+                    return None
+                conversation = self._conversation_row_to_dict(row)
+
+            self.cursor.execute(f"""
+                INSERT OR IGNORE INTO user_balances (user_email, token_balance)
+                VALUES ({self.P}, {self.P})
+            """, (user_email, DEFAULT_FREE_TOKENS))
+            self.cursor.execute(f"""
+                UPDATE user_balances
+                SET token_balance = token_balance - {self.P}, updated_at = CURRENT_TIMESTAMP
+                WHERE user_email = {self.P} AND token_balance >= {self.P}
+            """, (total_tokens, user_email, total_tokens))
+            if self.cursor.rowcount == 0:
+                self.conn.rollback()
+                return None
+
+            self.cursor.execute(f"""
+                INSERT INTO token_transactions (user_email, delta, reason)
+                VALUES ({self.P}, {self.P}, {self.P})
+            """, (user_email, -total_tokens, reason or f"chat:{conversation_id}"))
+            first_id = self._reserve_message_ids(2)
+            self.cursor.execute(f"""
+                INSERT INTO pending_chat_messages (first_id, user_email, created_at)
+                VALUES ({self.P}, {self.P}, {self.P})
+            """, (first_id, user_email, now))
+            balance = self.get_token_balance(user_email, ensure=False)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        base = {"type": "message", "conversation_id": conversation_id, "user_email": user_email, "created_at": now}
+        user_record = {
+            **base, "id": first_id, "role": "user", "content": question,
+            "sources": [], "token_used": input_tokens, "response_time": None, "num_docs": 0,
+        }
+        bot_record = {
+            **base, "id": first_id + 1, "role": "bot", "content": answer,
+            "sources": sources or [], "token_used": output_tokens,
+            "response_time": response_time, "num_docs": num_docs,
+        }
+        records = [user_record, bot_record]
+
+        title = question.replace("\n", " ").strip()[:40]
+        if conversation is not None:
+            records.append({
+                "type": "touch", "conversation_id": conversation_id, "user_email": user_email,
+                "title": title, "updated_at": now,
+            })
+            if title and conversation["title"] == "Cuộc hội thoại mới":
+                conversation["title"] = title
+            conversation["updated_at"] = now
+
+        return {
+            "token_used": total_tokens,
+            "balance": balance,
+            "user_message": {key: value for key, value in user_record.items() if key != "type"},
+            "bot_message": {key: value for key, value in bot_record.items() if key != "type"},
+            "conversation": conversation,
+            "records": records,
+        }
+
+    def write_history_batch(self, records: list[dict]) -> int:
+        """
+        Ghi 1 lô records của ChatHistoryWriter trong 1 transaction.
+
+        Idempotent (replay journal an toàn): message đã có id thì bỏ qua, message của conversation
+        đã bị xóa thì không ghi; các cập nhật cùng 1 conversation được gộp thành 1 UPDATE.
+        Id của lô được xóa khỏi pending_chat_messages trong cùng transaction.
+
+        Returns:
+            Số message được ghi mới.
+        """
+        messages = [record for record in records if record["type"] == "message"]
+        touches: dict[str, dict] = {}
+        for record in records:
+            if record["type"] != "touch":
+                continue
+            touch = touches.setdefault(record["conversation_id"], dict(record))
+            # Tiêu đề lấy từ câu hỏi đầu tiên, updated_at lấy mốc muộn nhất
+            touch["title"] = touch["title"] or record["title"]
+            touch["updated_at"] = max(touch["updated_at"], record["updated_at"])
+
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            inserted = 0
+            for message in messages:
+                self.cursor.execute(f"""
+                    INSERT OR IGNORE INTO chat_messages
+                    (id, conversation_id, user_email, role, content, sources,
+                     token_used, response_time, num_docs, created_at)
+                    SELECT {self.P}, {self.P}, {self.P}, {self.P}, {self.P}, {self.P},
+                           {self.P}, {self.P}, {self.P}, {self.P}
+                    WHERE {self.P} IS NULL OR EXISTS (SELECT 1 FROM conversations WHERE id = {self.P})
+                """, (
+                    message["id"], message["conversation_id"], message["user_email"], message["role"],
+                    message["content"], json.dumps(message["sources"] or [], ensure_ascii=False),
+                    message["token_used"], message["response_time"], message["num_docs"],
+                    message["created_at"], message["conversation_id"], message["conversation_id"],
+                ))
+                inserted += self.cursor.rowcount
+            self.cursor.executemany(
+                f"DELETE FROM pending_chat_messages WHERE first_id = {self.P}",
+                [(message["id"],) for message in messages]
+            )
+
+            for touch in touches.values():
+                self.cursor.execute(f"""
+                    UPDATE conversations
+                    SET title = CASE
+                            WHEN title = 'Cuộc hội thoại mới' AND {self.P} != '' THEN {self.P}
+                            ELSE title
+                        END,
+                        updated_at = CASE WHEN updated_at < {self.P} THEN {self.P} ELSE updated_at END
+                    WHERE id = {self.P} AND user_email = {self.P}
+                """, (
+                    touch["title"], touch["title"], touch["updated_at"], touch["updated_at"],
+                    touch["conversation_id"], touch["user_email"],
+                ))
+            self.conn.commit()
+            return inserted
+        except Exception:
+            self.conn.rollback()
+            raise
+
     # ------------------------------------------------------------------
     # Token Balance / Ledger
     # ------------------------------------------------------------------
@@ -865,9 +1363,11 @@ class UserDB:
             return False
 
     def close(self):
-        """Đóng kết nối database."""
+        """Trả kết nối về pool."""
         if self.conn:
-            self.conn.close()
+            self._pool.release(self.conn)
+            self.conn = None
+            self.cursor = None
 
     def __enter__(self):
         return self
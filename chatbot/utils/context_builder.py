@@ -0,0 +1,182 @@
+"""
+ContextPacker: ghép các tài liệu đã chấm thành context cho bước generate.
+
+Thay cho "\n\n".join(...) toàn bộ documents:
+    1. Gộp các chunk liền kề của cùng file (phần overlap 80 ký tự của splitter chỉ giữ 1 lần),
+       bỏ chunk trùng / nằm trọn trong chunk khác.
+    2. Sắp xếp theo độ liên quan: metadata["relevance_score"] (reranker) nếu có,
+       ngược lại theo tỉ lệ từ khóa của câu hỏi xuất hiện trong chunk.
+    3. Đưa chunk vào context tới khi hết ngân sách token (CONTEXT_MAX_TOKENS). Chunk không
+       còn vừa thì chỉ trích các câu chứa nhiều từ khóa nhất (hợp với prompt trích xuất câu).
+"""
+
+import os
+import re
+
+from app.logger import get_logger
+from chatbot.utils.token_counter import count_tokens
+
+logger = get_logger(__name__)
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;])\s+|\n+")
+_STOPWORDS = {
+    "và", "của", "là", "có", "các", "những", "được", "cho", "trong", "với", "một",
+    "này", "đã", "để", "không", "theo", "từ", "khi", "về", "như", "thì", "ra",
+    "nào", "gì", "bao", "nhiêu", "đâu", "hãy", "biết", "câu", "hỏi", "ở", "tại",
+}
+
+
+def _terms(text: str) -> set[str]:
+    return {token for token in re.findall(r"\w+", text.lower()) if token not in _STOPWORDS}
+
+
+def _overlap_length(left: str, right: str, max_overlap: int = 300, min_overlap: int = 20) -> int:
+    """Độ dài đoạn cuối của left trùng với đoạn đầu của right (0 nếu không có)."""
+    tail = left[-max_overlap:]
+    if len(right) < min_overlap:
+        return 0
+    probe = right[:min_overlap]
+    start = tail.find(probe)
+    while start != -1:
+        length = len(tail) - start
+        if right.startswith(tail[start:]):
+            return length
+        start = tail.find(probe, start + 1)
+    return 0
+
+
+class ContextPacker:
+    """
+    Args:
+        max_tokens: Ngân sách token cho context (env CONTEXT_MAX_TOKENS, mặc định 3000).
+        sentence_mode: overflow (mặc định) = chỉ trích câu khi chunk không còn vừa ngân sách,
+            always = mọi chunk chỉ giữ các câu liên quan, off = bỏ qua chunk không vừa
+            (env CONTEXT_SENTENCE_MODE).
+        max_sentences: Số câu tối đa trích từ mỗi chunk.
+        model: Model dùng để đếm token (env OPENAI_LLM_MODEL_NAME).
+    """
+
+    SEPARATOR = "\n\n"
+
+    def __init__(
+        self,
+        max_tokens: int | None = None,
+        sentence_mode: str | None = None,
+        max_sentences: int | None = None,
+        model: str | None = None,
+    ) -> None:
+        self.max_tokens = max_tokens or int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+        self.sentence_mode = (sentence_mode or os.getenv("CONTEXT_SENTENCE_MODE", "overflow")).strip().lower()
+        self.max_sentences = max_sentences or int(os.getenv("CONTEXT_MAX_SENTENCES", "3"))
+        self.model = model or os.getenv("OPENAI_LLM_MODEL_NAME", "gpt-4o-mini")
+
+    def pack(self, question: str, documents: list) -> str:
+        """Trả về context đã gộp overlap, sắp theo độ liên quan và nằm trong ngân sách token."""
+        passages = self._merge_overlaps(documents)
+        question_terms = _terms(question)
+        # Sort ổn định: cùng độ liên quan thì giữ thứ tự retrieval
+        passages.sort(key=lambda passage: (-self._relevance(passage, question_terms), passage["order"]))
+
+        parts: list[str] = []
+        used = 0
+        separator_tokens = count_tokens(self.SEPARATOR, self.model)
+        for passage in passages:
+            remaining = self.max_tokens - used - (separator_tokens if parts else 0)
+            if remaining <= 0:
+                break
+
+            text = passage["text"]
+            if self.sentence_mode == "always":
+                text = self._extract_sentences(text, question_terms, remaining)
+            else:
+                tokens = count_tokens(text, self.model)
+                if tokens > remaining:
+                    if self.sentence_mode == "off":
+                        continue
+                    text = self._extract_sentences(text, question_terms, remaining)
+            if not text:
+                continue
+
+            used += count_tokens(text, self.model) + (separator_tokens if parts else 0)
+            parts.append(text)
+
+        context = self.SEPARATOR.join(parts)
+        logger.info(
+            f"Context: {len(documents)} tài liệu -> {len(passages)} đoạn sau gộp overlap, "
+            f"dùng {len(parts)} đoạn (~{used}/{self.max_tokens} tokens)."
+        )
+        return context
+
+    def _merge_overlaps(self, documents: list) -> list[dict]:
+        """Gộp chunk liền kề cùng file theo phần overlap, bỏ chunk trùng."""
+        passages: list[dict] = []
+        for order, doc in enumerate(documents):
+            text = (doc.page_content or "").strip()
+            if not text:
+                continue
+            metadata = doc.metadata or {}
+            passages.append({
+                "text": text,
+                "source": metadata.get("source", ""),
+                "score": metadata.get("relevance_score"),
+                "order": order,
+            })
+
+        merged = True
+        while merged:
+            merged = False
+            for i, left in enumerate(passages):
+                for j, right in enumerate(passages):
+                    if i == j or left["source"] != right["source"]:
+                        continue
+                    if right["text"] in left["text"]:
+                        self._absorb(left, right, left["text"])
+                    else:
+                        overlap = _overlap_length(left["text"], right["text"])
+                        if not overlap:
+                            continue
+                        self._absorb(left, right, left["text"] + right["text"][overlap:])
+                    passages.pop(j)
+                    merged = True
+                    break
+                if merged:
+                    break
+        return passages
+
+    @staticmethod
+    def _absorb(target: dict, other: dict, text: str) -> None:
+        target["text"] = text
+        scores = [score for score in (target["score"], other["score"]) if score is not None]
+        target["score"] = max(scores) if scores else None
+        target["order"] = min(target["order"], other["order"])
+
+    @staticmethod
+    def _relevance(passage: dict, question_terms: set[str]) -> float:
+        """Điểm reranker nếu có, ngược lại tỉ lệ từ khóa của câu hỏi xuất hiện trong đoạn."""
+        if passage["score"] is not None:
+            return float(passage["score"])
+        if question_terms:
+            return len(question_terms & _terms(passage["text"])) / len(question_terms)
+        return 0.0
+
+    def _extract_sentences(self, text: str, question_terms: set[str], budget: int) -> str:
+        """Các câu chứa nhiều từ khóa nhất (giữ thứ tự trong văn bản) vừa với budget token."""
+        sentences = [sentence.strip() for sentence in _SENTENCE_SPLIT.split(text) if sentence.strip()]
+        ranked = sorted(
+            range(len(sentences)),
+            key=lambda index: -len(question_terms & _terms(sentences[index])),
+        )
+
+        chosen: list[int] = []
+        used = 0
+        for index in ranked:
+            if len(chosen) >= self.max_sentences:
+                break
+            if not question_terms & _terms(sentences[index]):
+                break
+            tokens = count_tokens(sentences[index], self.model) + 1
+            if used + tokens > budget:
+                continue
+            chosen.append(index)
+            used += tokens
+        return " ".join(sentences[index] for index in sorted(chosen))
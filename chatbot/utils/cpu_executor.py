@@ -0,0 +1,35 @@
+"""
+Executor giới hạn cho các bước nặng CPU trong pipeline chat async.
+
+Embedding, K-Means, Energy Distance và truy vấn Chroma là code đồng bộ; gọi
+trực tiếp trong handler async sẽ chặn toàn bộ event loop của worker uvicorn.
+run_cpu_bound() đẩy chúng sang một ThreadPoolExecutor có số luồng cố định
+(numpy / torch nhả GIL khi tính toán) để event loop vẫn phục vụ request khác.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = Lock()
+
+
+def get_cpu_executor() -> ThreadPoolExecutor:
+    """Executor dùng chung, số luồng lấy từ env CPU_EXECUTOR_WORKERS (mặc định min(4, số CPU))."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                max_workers = int(os.getenv("CPU_EXECUTOR_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+                _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-cpu")
+    return _executor
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Chạy func(*args, **kwargs) trên executor giới hạn và await kết quả."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_executor(), functools.partial(func, *args, **kwargs))
@@ -1,11 +1,16 @@
 """
 DocumentGrader: Đánh giá mức độ liên quan của tài liệu với câu hỏi.
 
-Sử dụng kỹ thuật Batching để gộp N tài liệu vào 1 prompt,
-giảm số lần gọi API từ N lần xuống 1 lần duy nhất.
+Sử dụng kỹ thuật Batching để gộp tài liệu vào prompt. Danh sách dài được chia
+thành các shard (GRADER_SHARD_SIZE tài liệu/shard) chấm song song bằng
+batch/abatch, nên độ trễ gần như không đổi theo số candidates:
+    - chấm theo từng đợt GRADER_MAX_CONCURRENCY shard,
+    - dừng sớm khi đã đủ GRADER_EARLY_EXIT_DOCS tài liệu liên quan (0 = tắt),
+    - chỉ chấm lại các shard lỗi / trả về JSON hỏng (GRADER_MAX_RETRIES lần).
 """
 
 import json
+import os
 import re
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
@@ -19,7 +24,7 @@ logger = get_logger(__name__)
 class DocumentGrader:
     """
     Lớp kiểm tra HÀNG LOẠT (Batching) xem các documents có liên quan tới câu đầu vào không.
-    Giúp giảm số lần gọi API từ 15 lần xuống 1 lần duy nhất.
+    Mỗi shard GRADER_SHARD_SIZE tài liệu tốn 1 API call, các shard chạy song song.
     """
 
     def __init__(self, llm) -> None:
@@ -30,6 +35,10 @@ class DocumentGrader:
             ]
         )
         self.chain = prompt | llm | StrOutputParser()
+        self.shard_size = max(1, int(os.getenv("GRADER_SHARD_SIZE", "8")))
+        self.max_concurrency = max(1, int(os.getenv("GRADER_MAX_CONCURRENCY", "4")))
+        self.early_exit_docs = int(os.getenv("GRADER_EARLY_EXIT_DOCS", "0"))
+        self.max_retries = max(0, int(os.getenv("GRADER_MAX_RETRIES", "1")))
 
     def get_chain(self) -> RunnableSequence:
         """Trả về chain đánh giá tài liệu."""
@@ -37,40 +46,136 @@ class DocumentGrader:
 
     def grade_batch(self, question: str, retrieved_docs: list) -> list:
         """
-        Chấm điểm hàng loạt các tài liệu trong 1 API call.
+        Chấm điểm hàng loạt các tài liệu, mỗi shard 1 API call (các shard chạy song song).
 
         Args:
             question: Câu hỏi của người dùng.
             retrieved_docs: Danh sách Document đã truy xuất.
 
         Returns:
-            Danh sách Document đã lọc (chỉ giữ tài liệu liên quan).
+            Danh sách Document đã lọc (chỉ giữ tài liệu liên quan), giữ thứ tự ban đầu.
+        """
+        steps = self._grade_steps(question, retrieved_docs)
+        try:
+            inputs = next(steps)
+            while True:
+                inputs = steps.send(self.chain.batch(inputs, **self._batch_kwargs()))
+        except StopIteration as done:
+            return done.value
+
+    async def agrade_batch(self, question: str, retrieved_docs: list) -> list:
+        """Như grade_batch() nhưng gọi LLM bằng abatch (không chặn event loop)."""
+        steps = self._grade_steps(question, retrieved_docs)
+        try:
+            inputs = next(steps)
+            while True:
+                inputs = steps.send(await self.chain.abatch(inputs, **self._batch_kwargs()))
+        except StopIteration as done:
+            return done.value
+
+    def _grade_steps(self, question: str, retrieved_docs: list):
+        """
+        Vòng chấm dùng chung cho grade_batch / agrade_batch (chia shard, chạy theo đợt, chấm lại
+        shard lỗi, dừng sớm). Generator: yield danh sách input cần chấm, nhận lại responses qua
+        send(), kết thúc bằng return danh sách Document đã lọc.
         """
         if not retrieved_docs:
             return []
 
+        shards = self._make_shards(retrieved_docs)
+        results: dict[int, list[int]] = {}
+        for wave in self._waves(shards):
+            pending = list(wave)
+            for attempt in range(self.max_retries + 1):
+                responses = yield [self._build_input(question, shards[i]) for i in pending]
+                pending = self._collect(pending, responses, shards, results, attempt)
+                if not pending:
+                    break
+            if self._enough(results):
+                break
+
+        return self._merge(shards, results)
+
+    def _batch_kwargs(self) -> dict:
+        return {"config": {"max_concurrency": self.max_concurrency}, "return_exceptions": True}
+
+    def _make_shards(self, retrieved_docs: list) -> list[list]:
+        return [
+            retrieved_docs[start:start + self.shard_size]
+            for start in range(0, len(retrieved_docs), self.shard_size)
+        ]
+
+    def _waves(self, shards: list[list]):
+        """Chia shard thành từng đợt chạy song song; không dừng sớm thì chạy 1 đợt duy nhất."""
+        wave_size = self.max_concurrency if self.early_exit_docs > 0 else len(shards)
+        for start in range(0, len(shards), wave_size):
+            yield range(start, min(start + wave_size, len(shards)))
+
+    def _collect(self, pending: list[int], responses: list, shards: list[list], results: dict, attempt: int) -> list[int]:
+        """Ghi kết quả các shard chấm được, trả về các shard cần chấm lại."""
+        failed = []
+        for shard_index, response in zip(pending, responses):
+            indices = None
+            if isinstance(response, Exception):
+                logger.warning(f"Lỗi gọi LLM chấm shard {shard_index + 1}: {response}")
+            else:
+                indices = self._parse_indices(response, len(shards[shard_index]))
+            if indices is None:
+                failed.append(shard_index)
+            else:
+                results[shard_index] = indices
+
+        if failed and attempt >= self.max_retries:
+            logger.warning(f"Bỏ {len(failed)} shard không chấm được sau {attempt + 1} lần thử.")
+            return []
+        return failed
+
+    def _enough(self, results: dict) -> bool:
+        if self.early_exit_docs <= 0:
+            return False
+        return sum(len(indices) for indices in results.values()) >= self.early_exit_docs
+
+    @staticmethod
+    def _merge(shards: list[list], results: dict) -> list:
+        return [
+            shards[shard_index][idx]
+            for shard_index in sorted(results)
+            for idx in results[shard_index]
+        ]
+
+    def _build_input(self, question: str, retrieved_docs: list) -> dict:
         # 1. Gom tất cả documents thành 1 string duy nhất có đánh số
         formatted_docs = "\n".join(
             [f"--- [Tài liệu {i+1}] ---\n{doc.page_content}" for i, doc in enumerate(retrieved_docs)]
         )
-
-        # 2. Gọi LLM đúng 1 lần
-        response = self.chain.invoke({
+        return {
             "documents": formatted_docs,
             "question": question
-        })
+        }
 
-        # 3. Trích xuất mảng JSON an toàn bằng Regex
-        filtered_docs = []
-        try:
-            match = re.search(r'\[.*?\]', response)
-            if match:
-                indices = json.loads(match.group(0))
-                for idx in indices:
-                    real_idx = idx - 1  # Chuyển index từ (1-N) sang (0-based)
-                    if 0 <= real_idx < len(retrieved_docs):
-                        filtered_docs.append(retrieved_docs[real_idx])
-        except Exception as e:
-            logger.warning(f"Lỗi parse JSON từ LLM: {response}. Chi tiết: {e}")
-
-        return filtered_docs
\ No newline at end of file
+    @staticmethod
+    def _parse_indices(response: str, n_docs: int) -> list[int] | None:
+        """
+        Trích xuất mảng JSON số thứ tự (1-N) từ câu trả lời của LLM.
+
+        Returns:
+            Index 0-based tăng dần của tài liệu liên quan, hoặc None nếu không parse được
+            (để shard đó được chấm lại thay vì bị coi là không có tài liệu nào liên quan).
+        """
+        # Mảng có thể xuống dòng; thử lần lượt từng mảng cho tới khi gặp mảng số hợp lệ
+        for match in re.finditer(r'\[[\s\S]*?\]', str(response)):
+            try:
+                parsed = json.loads(match.group(0))
+            except ValueError:
+                continue
+            if not isinstance(parsed, list):
+                continue
+            try:
+                numbers = [int(item) for item in parsed]
+            except (TypeError, ValueError):
+                continue
+            # Chuyển index từ (1-N) sang (0-based), bỏ số ngoài khoảng và trùng lặp
+            return sorted({number - 1 for number in numbers if 1 <= number <= n_docs})
+
+        logger.warning(f"Lỗi parse JSON từ LLM: {response}")
+        return None
\ No newline at end of file
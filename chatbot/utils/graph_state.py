@@ -17,6 +17,7 @@ class GraphState(TypedDict, total=False):
         generation (str): Kết quả sinh ra từ LLM.
         documents (List): Danh sách tài liệu liên quan.
         prompt (str): Prompt hệ thống/hướng dẫn kèm theo.
+        split_mode (str): Cách tách câu hỏi cho retrieval: auto | llm | local (tùy chọn).
     """
 
     question: str
@@ -26,4 +27,5 @@ class GraphState(TypedDict, total=False):
     query_parts: List[str]
     retrieval_debug: List[dict[str, Any]]
     algorithm: str
+    split_mode: str
 
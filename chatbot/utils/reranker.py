@@ -0,0 +1,131 @@
+"""
+CrossEncoderReranker: chấm mức độ liên quan (câu hỏi, chunk) bằng cross-encoder chạy local.
+
+Thay thế (GRADING_MODE=rerank) hoặc đứng trước (GRADING_MODE=hybrid) DocumentGrader:
+    - rerank : giữ các chunk có điểm >= RERANKER_THRESHOLD, không gọi LLM.
+    - hybrid : điểm >= RERANKER_ACCEPT_THRESHOLD giữ luôn, < RERANKER_REJECT_THRESHOLD bỏ luôn,
+               chỉ các chunk lưng chừng mới gửi cho LLM grader.
+
+Model mặc định là cross-encoder đa ngôn ngữ nhỏ (MiniLM, ~118M tham số), chạy được trên CPU
+với vài ms/chunk khi chấm theo batch.
+"""
+
+import os
+from threading import Lock
+
+import numpy as np
+
+from app.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class CrossEncoderReranker:
+    """
+    Args:
+        model_name: Tên model cross-encoder (env RERANKER_MODEL).
+        device: cpu | cuda | auto (env RERANKER_DEVICE, mặc định auto).
+        batch_size: Số cặp (câu hỏi, chunk) mỗi lần predict (env RERANKER_BATCH_SIZE).
+        max_length: Số token tối đa của mỗi cặp, phần dư bị cắt.
+    """
+
+    default_model = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+    def __init__(
+        self,
+        model_name: str | None = None,
+        device: str | None = None,
+        batch_size: int | None = None,
+        max_length: int = 512,
+    ) -> None:
+        self.model_name = model_name or os.getenv("RERANKER_MODEL", self.default_model)
+        self.requested_device = device or os.getenv("RERANKER_DEVICE", "auto")
+        self.batch_size = batch_size or int(os.getenv("RERANKER_BATCH_SIZE", "32"))
+        self.max_length = max_length
+        self.threshold = float(os.getenv("RERANKER_THRESHOLD", "0.5"))
+        self.accept_threshold = float(os.getenv("RERANKER_ACCEPT_THRESHOLD", "0.8"))
+        self.reject_threshold = float(os.getenv("RERANKER_REJECT_THRESHOLD", "0.2"))
+        self.model = None
+        self._lock = Lock()
+
+    def _resolve_device(self) -> str:
+        requested = (self.requested_device or "auto").strip().lower()
+        if requested not in {"", "auto"}:
+            return requested
+        try:
+            import torch
+            return "cuda" if torch.cuda.is_available() else "cpu"
+        except Exception:
+            return "cpu"
+
+    def _load_model(self):
+        """Tải model khi cần dùng lần đầu (sentence-transformers import chậm)."""
+        if self.model is not None:
+            return self.model
+
+        with self._lock:
+            if self.model is not None:
+                return self.model
+
+            from sentence_transformers import CrossEncoder
+
+            device = self._resolve_device()
+            logger.info(f"Đang tải reranker {self.model_name} trên {device}...")
+            self.model = CrossEncoder(self.model_name, max_length=self.max_length, device=device)
+            return self.model
+
+    def score(self, question: str, documents: list) -> np.ndarray:
+        """
+        Điểm liên quan trong khoảng [0, 1] của từng document với câu hỏi.
+
+        Model 1 nhãn của sentence-transformers trả về điểm đã qua sigmoid.
+        """
+        if not documents:
+            return np.zeros(0)
+
+        model = self._load_model()
+        pairs = [(question, doc.page_content) for doc in documents]
+        scores = model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        return np.asarray(scores, dtype=np.float64).reshape(len(documents))
+
+    def rerank(self, question: str, documents: list, threshold: float | None = None) -> list:
+        """
+        Giữ các document có điểm >= threshold, sắp xếp theo điểm giảm dần.
+
+        Điểm được ghi vào metadata["relevance_score"] để các bước sau (đóng gói context) dùng lại.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        scores = self.score(question, documents)
+        kept = [
+            (score, doc)
+            for score, doc in zip(scores, self._with_scores(documents, scores))
+            if score >= threshold
+        ]
+        kept.sort(key=lambda item: -item[0])
+        return [doc for _, doc in kept]
+
+    def triage(self, question: str, documents: list) -> tuple[list, list]:
+        """
+        Chia documents thành (chắc chắn liên quan, cần LLM chấm), bỏ các document điểm thấp.
+
+        Returns:
+            tuple (accepted, ambiguous), cả hai giữ thứ tự điểm giảm dần.
+        """
+        scores = self.score(question, documents)
+        order = np.argsort(-scores, kind="stable")
+        scored_docs = self._with_scores(documents, scores)
+
+        accepted, ambiguous = [], []
+        for index in order:
+            score = scores[index]
+            if score >= self.accept_threshold:
+                accepted.append(scored_docs[index])
+            elif score >= self.reject_threshold:
+                ambiguous.append(scored_docs[index])
+        return accepted, ambiguous
+
+    @staticmethod
+    def _with_scores(documents: list, scores: np.ndarray) -> list:
+        for doc, score in zip(documents, scores):
+            doc.metadata = {**(doc.metadata or {}), "relevance_score": float(score)}
+        return documents
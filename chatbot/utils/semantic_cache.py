@@ -0,0 +1,213 @@
+"""
+Cache câu trả lời theo ngữ nghĩa, đặt trước workflow LangGraph.
+
+Câu hỏi được chuẩn hóa (_clean_text + lowercase) rồi embed bằng chính model
+E5 của retriever. Nếu đã có câu hỏi trước đó (cùng prompt, cùng split_mode) với cosine
+similarity >= SEMANTIC_CACHE_THRESHOLD thì trả lại answer + sources đã lưu, bỏ qua
+split -> retrieve -> grade -> generate.
+
+E5 cho similarity rất cao giữa các câu chỉ khác năm / số liệu / tên riêng
+("GDP năm 2022" vs "GDP năm 2023"), nên hit theo ngữ nghĩa còn yêu cầu cùng tập số
+và cùng tập từ viết hoa (tên riêng, viết tắt) với câu đã lưu. Mặc định cache tắt
+(SEMANTIC_CACHE_ENABLED=false), bật khi đã kiểm tra ngưỡng trên bộ câu hỏi thật.
+
+Index là ma trận numpy (max_entries × dim) trong RAM: với vài nghìn câu hỏi,
+một phép nhân ma trận đã nhanh hơn mọi cấu trúc ANN. Cache tự xóa khi version
+của vector store (manifest ingest) thay đổi.
+"""
+
+import os
+import re
+import time
+from threading import Lock
+from typing import Any, Callable
+
+import numpy as np
+
+from ingestion.query_splitter import _clean_text
+
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+_WORD_PATTERN = re.compile(r"\w+")
+_SENTENCE_END = (".", "?", "!", ":")
+
+
+class SemanticAnswerCache:
+    """
+    Args:
+        embeddings: Model embedding có embed_query (E5EmbeddingsWrapper).
+        threshold: Ngưỡng cosine similarity để coi là cùng câu hỏi (env SEMANTIC_CACHE_THRESHOLD).
+        max_entries: Số câu hỏi tối đa, vượt quá thì thay câu ít dùng nhất (env SEMANTIC_CACHE_MAX_ENTRIES).
+        version_fn: Hàm trả về version dữ liệu hiện tại (vd: ChromaDBManager.get_manifest_version).
+    """
+
+    def __init__(
+        self,
+        embeddings: Any,
+        threshold: float | None = None,
+        max_entries: int | None = None,
+        version_fn: Callable[[], Any] | None = None,
+    ) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold or float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+        self.max_entries = max_entries or int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+        self.version_fn = version_fn
+        self.version_check_seconds = float(os.getenv("SEMANTIC_CACHE_VERSION_CHECK_SECONDS", "30"))
+
+        self._lock = Lock()
+        self._vectors: np.ndarray | None = None
+        self._entries: list[dict[str, Any] | None] = []
+        self._last_used = np.zeros(self.max_entries)
+        self._exact: dict[tuple[str, str, str], int] = {}
+        self._version = self._current_version()
+        self._last_version_check = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return _clean_text(question).lower()
+
+    @staticmethod
+    def signature(question: str) -> tuple[frozenset[str], frozenset[str]]:
+        """
+        Số liệu + thực thể của câu hỏi: 2 câu chỉ được dùng chung câu trả lời khi trùng cả 2 tập.
+
+        Thực thể = từ viết hoa không đứng đầu câu (Việt Nam, GDP, FDI, ...).
+        """
+        text = _clean_text(question)
+        numbers = frozenset(
+            number.replace(",", ".") for number in _NUMBER_PATTERN.findall(text)
+        )
+        entities = set()
+        sentence_start = True
+        for token in text.split():
+            for word in _WORD_PATTERN.findall(token):
+                if not sentence_start and word[0].isupper():
+                    entities.add(word.lower())
+                sentence_start = False
+            if token.endswith(_SENTENCE_END):
+                sentence_start = True
+        return numbers, frozenset(entities)
+
+    def lookup(self, question: str, prompt: str = "", split_mode: str = "") -> dict[str, Any] | None:
+        """
+        Tìm câu trả lời đã cache cho câu hỏi (hoặc câu diễn đạt lại gần giống).
+
+        Returns:
+            dict (answer, sources, num_docs, question, similarity) hoặc None.
+        """
+        self._check_version()
+        key = (self.normalize(question), prompt or "", split_mode or "")
+        if not key[0]:
+            return None
+
+        with self._lock:
+            slot = self._exact.get(key)
+            if slot is not None:
+                return self._hit(slot, 1.0)
+            if not self._exact:
+                self.misses += 1
+                return None
+
+        signature = self.signature(question)
+        vector = self._embed(key[0])
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            similarities = self._vectors @ vector
+            for slot, entry in enumerate(self._entries):
+                if (
+                    entry is None
+                    or (entry["prompt"], entry["split_mode"]) != key[1:]
+                    or entry["signature"] != signature
+                ):
+                    similarities[slot] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self._hit(best, float(similarities[best]))
+            self.misses += 1
+        return None
+
+    def store(
+        self,
+        question: str,
+        prompt: str,
+        answer: str,
+        sources: list[dict],
+        num_docs: int,
+        split_mode: str = "",
+    ) -> None:
+        """Lưu câu trả lời. Bỏ qua khi không có tài liệu (câu báo không tìm thấy)."""
+        key = (self.normalize(question), prompt or "", split_mode or "")
+        if not key[0] or not num_docs:
+            return
+
+        version = self._version
+        vector = self._embed(key[0])
+        with self._lock:
+            if version != self._version:
+                return  # Dữ liệu vừa đổi trong lúc sinh câu trả lời
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._entries = [None] * self.max_entries
+
+            slot = self._exact.get(key)
+            if slot is None:
+                slot = self._free_slot()
+            old = self._entries[slot]
+            if old is not None:
+                self._exact.pop((old["question"], old["prompt"], old["split_mode"]), None)
+
+            self._vectors[slot] = vector
+            self._entries[slot] = {
+                "question": key[0],
+                "prompt": key[1],
+                "split_mode": key[2],
+                "signature": self.signature(question),
+                "answer": answer,
+                "sources": sources,
+                "num_docs": num_docs,
+            }
+            self._exact[key] = slot
+            self._last_used[slot] = time.time()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vectors = None
+            self._entries = []
+            self._exact = {}
+            self._last_used[:] = 0
+
+    def _hit(self, slot: int, similarity: float) -> dict[str, Any]:
+        self._last_used[slot] = time.time()
+        self.hits += 1
+        return {**self._entries[slot], "similarity": similarity}
+
+    def _free_slot(self) -> int:
+        # Slot trống có last_used = 0 nên argmin chọn slot trống trước, rồi tới slot ít dùng nhất
+        return int(np.argmin(self._last_used))
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _current_version(self) -> Any:
+        if self.version_fn is None:
+            return None
+        try:
+            return self.version_fn()
+        except Exception:
+            return None
+
+    def _check_version(self) -> None:
+        now = time.time()
+        if self.version_fn is None or now - self._last_version_check < self.version_check_seconds:
+            return
+        self._last_version_check = now
+        version = self._current_version()
+        if version != self._version:
+            print(f"♻️ Vector store đổi version ({self._version} → {version}), xóa semantic cache.")
+            self.clear()
+            self._version = version
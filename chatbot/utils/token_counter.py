@@ -2,38 +2,176 @@
 Module: token_counter
 Mo ta: Tinh toan so luong token su dung de quan ly chi phi LLM.
 Tham chieu: docs/DOCS-main/skill_ai_rag_workflow.md Muc 3
+
+- Encoder tiktoken duoc tao 1 lan cho moi model (lru_cache), canh bao model la chi log 1 lan.
+  Chi cache khi tai thanh cong; loi tam thoi (mat mang) thi thu lai sau ENCODING_RETRY_SECONDS.
+- count_tokens_batch: dem nhieu chuoi trong 1 lan goi (encode_batch).
+- approximate_tokens: uoc luong rat nhanh, khong can tiktoken (dung cho pre-check).
+- usage_from_response / UsageTracker: doc so token do provider tra ve (usage_metadata).
 """
 
+import math
+import time
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Optional
+
 import tiktoken
+from langchain_core.callbacks import BaseCallbackHandler
 from app.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Sau 1 lan tai encoding loi, dung uoc luong trong khoang nay roi moi thu tai lai
+ENCODING_RETRY_SECONDS = 60.0
+_encoding_failed_at: dict[str, float] = {}
+
+
+@lru_cache(maxsize=32)
+def _load_encoding(model: str) -> tiktoken.Encoding:
+    """Tai encoding; loi thi raise (lru_cache khong cache exception)."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"Model '{model}' khong tim thay trong tiktoken. Dung 'cl100k_base' thay the.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_encoding(model: str = "gpt-4o-mini") -> Optional[tiktoken.Encoding]:
+    """
+    Lay encoding cua model (cache theo ten model, chi cache khi tai thanh cong).
+
+    Returns:
+        Encoding, hoac None neu khong tai duoc (vd: khong co mang de tai file BPE).
+    """
+    failed_at = _encoding_failed_at.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_SECONDS:
+        return None
+    try:
+        encoding = _load_encoding(model)
+    except Exception as e:
+        _encoding_failed_at[model] = time.monotonic()
+        logger.error(f"Loi khi tai encoding tiktoken, chuyen sang uoc luong: {e}")
+        return None
+    _encoding_failed_at.pop(model, None)
+    return encoding
+
+
+def approximate_tokens(text: str) -> int:
+    """
+    Uoc luong nhanh so token: ~4 byte UTF-8 / token.
+    Tinh theo byte thay vi ky tu de tieng Viet co dau (2-3 byte/ky tu) khong bi uoc luong thap.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
 def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
     """
     Dem so luong token cua mot doan text theo encoding cua model OpenAI.
     Neu dung model cua hang khac (Gemini, Groq), van co the dung GPT de uoc luong.
-    
+
     Args:
         text: Chuoi van ban can dem.
         model: Ten model (mac dinh gpt-4o-mini).
-        
+
     Returns:
         So luong token.
     """
     if not text:
         return 0
-        
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return approximate_tokens(text)
     try:
-        # Lay encoding cua model chi dinh hoac mac dinh la cl100k_base
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            logger.warning(f"Model '{model}' khong tim thay trong tiktoken. Dung 'cl100k_base' thay the.")
-            encoding = tiktoken.get_encoding("cl100k_base")
-            
-        return len(encoding.encode(text))
+        return len(encoding.encode(text, disallowed_special=()))
     except Exception as e:
         logger.error(f"Loi khi dem token: {e}")
-        # Tra ve gia tri uoc luong tam: 1 token ~ 4 ky tu
-        return len(text) // 4
+        return approximate_tokens(text)
+
+
+def count_tokens_batch(texts: list[str], model: str = "gpt-4o-mini") -> list[int]:
+    """Dem token cho nhieu chuoi trong 1 lan goi (tiktoken encode_batch chay da luong)."""
+    if not texts:
+        return []
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return [approximate_tokens(text) for text in texts]
+    try:
+        encoded = encoding.encode_batch([text or "" for text in texts], disallowed_special=())
+        return [len(tokens) for tokens in encoded]
+    except Exception as e:
+        logger.error(f"Loi khi dem token: {e}")
+        return [approximate_tokens(text) for text in texts]
+
+
+def usage_from_response(response: Any) -> Optional[dict]:
+    """
+    Doc so token provider tra ve tu AIMessage (usage_metadata cua LangChain,
+    hoac response_metadata["token_usage"] cua OpenAI/Groq).
+
+    Returns:
+        dict {input_tokens, output_tokens, total_tokens} hoac None neu provider khong tra ve.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        metadata = getattr(response, "response_metadata", None) or {}
+        usage = metadata.get("token_usage") or metadata.get("usage")
+    return _normalize_usage(usage)
+
+
+def _normalize_usage(usage: Optional[dict]) -> Optional[dict]:
+    if not usage:
+        return None
+    input_tokens = int(usage.get("input_tokens", 0) or usage.get("prompt_tokens", 0) or 0)
+    output_tokens = int(usage.get("output_tokens", 0) or usage.get("completion_tokens", 0) or 0)
+    total_tokens = int(usage.get("total_tokens", 0) or input_tokens + output_tokens)
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": total_tokens}
+
+
+class UsageTracker(BaseCallbackHandler):
+    """
+    Callback cong don token provider bao cao cho moi lan goi LLM trong 1 request
+    (tach cau hoi, cham tai lieu, sinh cau tra loi).
+
+    Dung: workflow.ainvoke(state, config={"callbacks": [tracker]}), sau do doc tracker.totals().
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.calls = 0
+        self.reported_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def on_llm_end(self, response, **kwargs: Any) -> None:
+        usage = None
+        for generations in response.generations or []:
+            for generation in generations:
+                usage = usage_from_response(getattr(generation, "message", None))
+                if usage:
+                    break
+            if usage:
+                break
+        if usage is None and response.llm_output:
+            usage = _normalize_usage(response.llm_output.get("token_usage") or response.llm_output.get("usage"))
+
+        with self._lock:
+            self.calls += 1
+            if usage:
+                self.reported_calls += 1
+                self.input_tokens += usage["input_tokens"]
+                self.output_tokens += usage["output_tokens"]
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {
+                "llm_calls": self.calls,
+                "reported_calls": self.reported_calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.input_tokens + self.output_tokens,
+            }
@@ -1,10 +1,73 @@
 import os
+import json
 import hashlib
 import shutil
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 
 
+# Manifest lưu hash từng file + id các chunk của file đó (nằm trong persist_dir)
+MANIFEST_FILENAME = "ingest_manifest.json"
+# Chroma giới hạn số bản ghi mỗi lần upsert
+UPSERT_BATCH_SIZE = 1000
+
+
+def chunk_id(doc):
+    """Id ổn định của chunk = md5(nội dung + nhãn), trùng với hash dùng để dedup."""
+    content = doc.page_content.strip()
+    label = str(doc.metadata.get("is_relevant", "NA"))
+    return hashlib.md5((content + label).encode("utf-8")).hexdigest()
+
+
+def source_key(doc):
+    """File gốc của document (metadata 'source'), fallback theo nội dung."""
+    return doc.metadata.get("source") or hashlib.md5(doc.page_content.encode("utf-8")).hexdigest()
+
+
+def file_hash(docs, chunk_config):
+    """Hash nội dung + metadata của 1 file và cấu hình chunking (đổi cấu hình = đổi hash)."""
+    payload = json.dumps(
+        {
+            "chunk_config": chunk_config,
+            "docs": [[doc.page_content, doc.metadata] for doc in docs],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def split_documents(raw_documents, chunk_size=600, chunk_overlap=80):
+    """
+    Cắt documents thành chunks và loại chunk trùng nội dung trong cùng file.
+
+    Returns:
+        tuple: (unique_splits, số chunk trước dedup)
+    """
+    # 1. Cấu hình Splitter
+    if chunk_size is None:
+        doc_splits = list(raw_documents)
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            separators=['\n\n', '\n']
+        )
+        # Cắt thành các chunk nhỏ
+        doc_splits = text_splitter.split_documents(raw_documents)
+
+    # === DEDUPLICATION: Loại bỏ chunks trùng nội dung ===
+    seen_hashes = set()
+    unique_splits = []
+    for doc in doc_splits:
+        key = (source_key(doc), chunk_id(doc))
+        if key not in seen_hashes:
+            seen_hashes.add(key)
+            unique_splits.append(doc)
+    return unique_splits, len(doc_splits)
+
+
 class ChromaDBManager:
     """
     Class quản lý Vector Database (Chroma) và xử lý cắt văn bản.
@@ -18,84 +81,199 @@ class ChromaDBManager:
         self.persist_dir = persist_dir
         self.vector_store = None
 
-    def process_and_store(self, raw_documents, chunk_size=600, chunk_overlap=80, force_rebuild=False):
+    @property
+    def manifest_path(self):
+        return os.path.join(self.persist_dir, MANIFEST_FILENAME)
+
+    def process_and_store(self, raw_documents, chunk_size=600, chunk_overlap=80, force_rebuild=False, incremental=False):
         """
         Hàm thực hiện cắt văn bản và lưu vào Database.
-        
+
         Args:
             raw_documents: Danh sách documents gốc
             chunk_size: Kích thước chunk
             chunk_overlap: Số ký tự overlap
             force_rebuild: Nếu True, xóa DB cũ và tạo lại từ đầu
+            incremental: Nếu True, chỉ embed chunk của file mới/đã sửa và xóa chunk của file đã bị xóa
+
+        Returns:
+            dict thống kê (added, deleted, ...) hoặc None nếu chỉ load DB cũ.
         """
         # 2. Xử lý VectorDB (Chroma)
-        if os.path.exists(self.persist_dir) and not force_rebuild:
+        if os.path.exists(self.persist_dir) and not force_rebuild and not incremental:
             print(f"📂 Đã tìm thấy DB cũ tại '{self.persist_dir}'. Đang load...")
             # Load DB cũ — KHÔNG thêm lại data để tránh trùng lặp
-            self.vector_store = Chroma(
-                persist_directory=self.persist_dir,
-                embedding_function=self.embeddings
-            )
+            self._load_vector_store()
             print(f"✅ Đã load DB với {self.vector_store._collection.count()} vectors.")
-            return
-        
+            return None
+
+        # DB cũ không có manifest (id chunk ngẫu nhiên) → không đồng bộ được, phải build lại
+        if incremental and not force_rebuild and os.path.exists(self.persist_dir) \
+                and not os.path.exists(self.manifest_path):
+            print(f"⚠️ DB tại '{self.persist_dir}' chưa có {MANIFEST_FILENAME} → build lại toàn bộ.")
+            force_rebuild = True
+
         # Nếu force_rebuild, xóa DB cũ
         if force_rebuild and os.path.exists(self.persist_dir):
             shutil.rmtree(self.persist_dir)
+            self.vector_store = None
             print(f"🗑️ Đã xóa DB cũ tại '{self.persist_dir}'.")
 
+        return self.sync_documents(raw_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def ingest_directory(self, dataset_dir, chunk_size=600, chunk_overlap=80, force_rebuild=False, **pipeline_kwargs):
+        """
+        Ingest cả thư mục theo kiểu streaming (đọc/cắt song song, embed + ghi theo batch).
+
+        Dùng cho corpus lớn thay cho load_documents_from_dir() + process_and_store():
+        không giữ toàn bộ văn bản / chunks trong bộ nhớ. Luôn chạy incremental theo manifest.
+        """
+        from ingestion.ingest_pipeline import StreamingIngestPipeline
+
+        if not force_rebuild and os.path.exists(self.persist_dir) and not os.path.exists(self.manifest_path):
+            print(f"⚠️ DB tại '{self.persist_dir}' chưa có {MANIFEST_FILENAME} → build lại toàn bộ.")
+            force_rebuild = True
+        if force_rebuild and os.path.exists(self.persist_dir):
+            shutil.rmtree(self.persist_dir)
+            self.vector_store = None
+            print(f"🗑️ Đã xóa DB cũ tại '{self.persist_dir}'.")
+
+        pipeline = StreamingIngestPipeline(self, **pipeline_kwargs)
+        return pipeline.run(dataset_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def sync_documents(self, raw_documents, chunk_size=600, chunk_overlap=80):
+        """
+        Đồng bộ DB với danh sách documents hiện tại (idempotent).
+
+        - File có hash không đổi: bỏ qua, không embed lại.
+        - File mới / đã sửa: cắt lại, upsert các chunk chưa có trong DB.
+        - File không còn trong raw_documents: xóa các chunk không còn file nào dùng.
+        Chunk trùng nội dung giữa nhiều file chỉ lưu 1 lần (đếm tham chiếu qua manifest).
+        """
+        chunk_config = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+        manifest = self._load_manifest()
+        old_files = manifest["files"]
+
+        docs_by_source = {}
+        for doc in raw_documents:
+            docs_by_source.setdefault(source_key(doc), []).append(doc)
+
+        changed_docs = []
+        new_files = {}
+        unchanged = 0
+        for source, docs in docs_by_source.items():
+            digest = file_hash(docs, chunk_config)
+            previous = old_files.get(source)
+            if previous and previous["hash"] == digest:
+                new_files[source] = previous
+                unchanged += 1
+            else:
+                new_files[source] = {"hash": digest, "chunk_ids": []}
+                changed_docs.extend(docs)
+
+        removed_files = [source for source in old_files if source not in docs_by_source]
+        changed_files = len(docs_by_source) - unchanged
+        print(f"📊 Ingest: {unchanged} file không đổi, {changed_files} file mới/đã sửa, {len(removed_files)} file đã xóa.")
+
+        # Cắt + dedup chỉ các file mới/đã sửa
+        new_chunks = {}
+        for doc in self._split_documents(changed_docs, chunk_size, chunk_overlap):
+            cid = chunk_id(doc)
+            ids = new_files[source_key(doc)]["chunk_ids"]
+            if cid not in ids:
+                ids.append(cid)
+            new_chunks.setdefault(cid, doc)
+
+        old_ids = {cid for entry in old_files.values() for cid in entry["chunk_ids"]}
+        live_ids = {cid for entry in new_files.values() for cid in entry["chunk_ids"]}
+        to_delete = sorted(old_ids - live_ids)
+        to_add = [cid for cid in new_chunks if cid not in old_ids]
+
+        self._load_vector_store()
+        if to_delete:
+            for start in range(0, len(to_delete), UPSERT_BATCH_SIZE):
+                self.vector_store.delete(ids=to_delete[start:start + UPSERT_BATCH_SIZE])
+            print(f"🗑️ Đã xóa {len(to_delete)} chunks không còn dùng.")
+        if to_add:
+            print(f"🧠 Đang embed & upsert {len(to_add)} chunks mới...")
+            for start in range(0, len(to_add), UPSERT_BATCH_SIZE):
+                batch_ids = to_add[start:start + UPSERT_BATCH_SIZE]
+                self.vector_store.add_documents(
+                    documents=[new_chunks[cid] for cid in batch_ids],
+                    ids=batch_ids,
+                )
+
+        stats = {
+            "added": len(to_add),
+            "deleted": len(to_delete),
+            "unchanged_files": unchanged,
+            "changed_files": changed_files,
+            "removed_files": len(removed_files),
+        }
+        changed = bool(to_add or to_delete or changed_files or removed_files)
+        if changed or not os.path.exists(self.manifest_path):
+            manifest["version"] += 1 if changed else 0
+            manifest["chunk_config"] = chunk_config
+            manifest["files"] = new_files
+            self._save_manifest(manifest)
+
+        stats["version"] = manifest["version"]
+        print(f"✅ Đồng bộ xong: +{stats['added']} / -{stats['deleted']} chunks, "
+              f"DB hiện có {self.vector_store._collection.count()} vectors (version {stats['version']}).")
+        return stats
+
+    def _split_documents(self, raw_documents, chunk_size, chunk_overlap):
+        """Cắt documents thành chunks và loại chunk trùng nội dung."""
+        if not raw_documents:
+            return []
+
         print(f"✂️ Đang cắt {len(raw_documents)} văn bản gốc...")
-        
-        # 1. Cấu hình Splitter
+        unique_splits, n_splits = split_documents(raw_documents, chunk_size, chunk_overlap)
         if chunk_size is None:
-            doc_splits = raw_documents
-            print(f"⚠️ Không chunking → giữ nguyên {len(doc_splits)} passages")
+            print(f"⚠️ Không chunking → giữ nguyên {n_splits} passages")
         else:
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-                separators=['\n\n', '\n']
-            )        
-        # Cắt thành các chunk nhỏ
-            doc_splits = text_splitter.split_documents(raw_documents)
-            print(f"✅ Đã cắt thành {len(doc_splits)} chunks nhỏ.")
-
-        # === DEDUPLICATION: Loại bỏ chunks trùng nội dung ===
-        seen_hashes = set()
-        unique_splits = []
-        for doc in doc_splits:
-            content = doc.page_content.strip()
-            label = str(doc.metadata.get("is_relevant", "NA"))
-            content_hash = hashlib.md5(
-                (content + label).encode("utf-8")
-            ).hexdigest()
-            if content_hash not in seen_hashes:
-                seen_hashes.add(content_hash)
-                unique_splits.append(doc)
-        
-        removed = len(doc_splits) - len(unique_splits)
-        print(f"🔄 Dedup: {len(doc_splits)} → {len(unique_splits)} chunks (loại {removed} trùng lặp)")
-        doc_splits = unique_splits
-
-        print(f"🆕 Đang tạo DB mới tại '{self.persist_dir}'...")
-        # Tạo mới hoàn toàn
-        self.vector_store = Chroma.from_documents(
-            documents=doc_splits,
-            embedding=self.embeddings,
-            persist_directory=self.persist_dir
-        )
-        print("✅ Đã tạo và lưu DB mới thành công!")
+            print(f"✅ Đã cắt thành {n_splits} chunks nhỏ.")
+
+        removed = n_splits - len(unique_splits)
+        print(f"🔄 Dedup: {n_splits} → {len(unique_splits)} chunks (loại {removed} trùng lặp)")
+        return unique_splits
+
+    def _load_vector_store(self):
+        if self.vector_store is None:
+            self.vector_store = Chroma(
+                persist_directory=self.persist_dir,
+                embedding_function=self.embeddings
+            )
+        return self.vector_store
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            manifest.setdefault("version", 0)
+            manifest.setdefault("files", {})
+            return manifest
+        return {"version": 0, "chunk_config": None, "files": {}}
+
+    def _save_manifest(self, manifest):
+        # Ghi file tạm rồi rename để không để lại manifest hỏng nếu bị ngắt giữa chừng
+        os.makedirs(self.persist_dir, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_manifest_version(self):
+        """Version tăng mỗi lần nội dung DB thay đổi (0 nếu chưa có manifest)."""
+        return self._load_manifest()["version"]
 
     def get_retriever(self, k=40):
         """Hàm lấy retriever ra để tìm kiếm"""
         if not self.vector_store:
             if os.path.exists(self.persist_dir):
-                self.vector_store = Chroma(
-                    persist_directory=self.persist_dir,
-                    embedding_function=self.embeddings
-                )
+                self._load_vector_store()
             else:
                 raise ValueError("❌ Database chưa được tạo. Hãy chạy process_and_store() trước!")
-                
+
         # Trả về retriever
         return self.vector_store.as_retriever(search_kwargs={'k': k})
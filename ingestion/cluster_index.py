@@ -0,0 +1,373 @@
+"""
+Chỉ mục cụm (cluster index) cấp toàn corpus cho Energy Retriever.
+
+Offline (ingestion/vector_data_builder.py):
+    toàn bộ vectors trong Chroma -> MiniBatchKMeans -> lưu centroids,
+    id của các chunk trong từng cụm, self-energy E_yy và mẫu dùng tính energy của từng cụm.
+    Vectors của chunk (float16, xếp theo cụm) lưu riêng ở energy_cluster_vectors.npy,
+    đọc bằng memmap nên không phải nạp cả corpus vào RAM.
+
+Online (SplitQueryEnergyRetriever, ENERGY_RETRIEVAL_MODE=cluster_index):
+    query vectors -> shortlist cụm theo khoảng cách tới centroid
+    -> Energy Distance giữa phân phối query và mẫu của từng cụm (E_yy đọc sẵn từ index)
+    -> chọn max_docs chunk gần query nhất từ vectors đã lưu
+    -> chỉ đọc Chroma cho các chunk được chọn.
+Không còn quét K-Means theo từng câu hỏi. Index cũ (chưa có file vectors) vẫn dùng được,
+khi đó vectors được đọc từ Chroma như trước.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from ingestion.energy_base_distance import cross_euclidean, pairwise_euclidean
+
+
+INDEX_FILENAME = "energy_cluster_index.npz"
+VECTORS_FILENAME = "energy_cluster_vectors.npy"
+
+
+def _mean_pairwise_distance(vectors: np.ndarray) -> float:
+    if len(vectors) == 0:
+        return 0.0
+    return float(pairwise_euclidean(vectors).mean())
+
+
+def _sample_rows(rng: np.random.Generator, n_rows: int, max_rows: int) -> np.ndarray:
+    if n_rows <= max_rows:
+        return np.arange(n_rows)
+    return np.sort(rng.choice(n_rows, size=max_rows, replace=False))
+
+
+class CorpusClusterIndex:
+    """
+    Cụm tiền tính trên toàn bộ collection Chroma.
+
+    Attributes:
+        centroids (np.ndarray): Tâm cụm (n_clusters × dim).
+        member_ids (list[list[str]]): Id chunk Chroma của từng cụm.
+        self_energies (np.ndarray): E_yy = trung bình khoảng cách trong từng cụm.
+        member_vectors (np.ndarray | None): Vectors của chunk theo thứ tự member_ids nối liền
+            (có thể là memmap). None với index cũ -> đọc từ Chroma.
+        sample_rows (list[np.ndarray] | None): Vị trí (trong cụm) của mẫu đã dùng tính E_yy.
+    """
+
+    def __init__(
+        self,
+        centroids,
+        member_ids: list[list[str]],
+        self_energies,
+        n_vectors: int = 0,
+        member_vectors=None,
+        sample_rows: list[np.ndarray] | None = None,
+    ) -> None:
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.member_ids = member_ids
+        self.self_energies = np.asarray(self_energies, dtype=np.float64)
+        self.n_vectors = n_vectors or sum(len(ids) for ids in member_ids)
+        self.max_energy_sample = int(os.getenv("CLUSTER_INDEX_ENERGY_SAMPLE", "512"))
+        self.member_vectors = member_vectors
+        self.sample_rows = sample_rows
+        self.offsets = np.cumsum([0, *[len(members) for members in member_ids]])
+
+    def _cluster_vectors(self, cluster_id: int, rows=None) -> np.ndarray:
+        """Vectors đã lưu của cụm (hoặc chỉ các dòng rows trong cụm)."""
+        start, end = self.offsets[cluster_id], self.offsets[cluster_id + 1]
+        block = self.member_vectors[start:end]
+        if rows is not None:
+            block = block[rows]
+        return np.asarray(block, dtype=np.float64)
+
+    @property
+    def n_clusters(self) -> int:
+        return len(self.centroids)
+
+    # ------------------------------------------------------------------
+    # Offline: build / save / load
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def build(
+        cls,
+        vector_store,
+        n_clusters: int | None = None,
+        batch_size: int = 1024,
+        max_energy_sample: int | None = None,
+        random_state: int = 42,
+    ) -> "CorpusClusterIndex":
+        """
+        Gom cụm toàn bộ vectors đang lưu trong Chroma.
+
+        Args:
+            vector_store: Chroma vector store đã có dữ liệu.
+            n_clusters: Số cụm. Mặc định ~ sqrt(n_vectors / 2), giới hạn 8..512.
+            batch_size: Batch size cho MiniBatchKMeans và khi đọc từ Chroma.
+            max_energy_sample: Số vector tối đa mỗi cụm khi ước lượng E_yy.
+            random_state: Seed cho K-Means và việc lấy mẫu.
+        """
+        collection = vector_store._collection
+        total = collection.count()
+        if total == 0:
+            raise ValueError("❌ Collection rỗng, không thể xây cluster index.")
+
+        ids: list[str] = []
+        chunks: list[np.ndarray] = []
+        for offset in range(0, total, batch_size):
+            page = collection.get(include=["embeddings"], limit=batch_size, offset=offset)
+            ids.extend(page["ids"])
+            chunks.append(np.asarray(page["embeddings"], dtype=np.float32))
+        vectors = np.vstack(chunks)
+
+        if n_clusters is None:
+            n_clusters = int(os.getenv("CLUSTER_INDEX_N_CLUSTERS", "0")) or int(np.sqrt(len(ids) / 2))
+            n_clusters = min(max(8, n_clusters), 512)
+        n_clusters = max(1, min(n_clusters, len(ids)))
+
+        print(f"🧩 Đang gom {len(ids)} vectors thành {n_clusters} cụm (MiniBatchKMeans)...")
+        model = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            batch_size=batch_size,
+            random_state=random_state,
+            n_init="auto",
+        )
+        labels = model.fit_predict(vectors)
+
+        if max_energy_sample is None:
+            max_energy_sample = int(os.getenv("CLUSTER_INDEX_ENERGY_SAMPLE", "512"))
+        rng = np.random.default_rng(random_state)
+
+        member_ids: list[list[str]] = []
+        member_rows: list[np.ndarray] = []
+        sample_rows: list[np.ndarray] = []
+        self_energies = np.zeros(n_clusters)
+        for cluster_id in range(n_clusters):
+            rows = np.where(labels == cluster_id)[0]
+            member_ids.append([ids[row] for row in rows])
+            member_rows.append(rows)
+            sample_rows.append(_sample_rows(rng, len(rows), max_energy_sample))
+
+        # Lưu float16 (E5 đã chuẩn hóa, sai số ~1e-3 không đổi thứ hạng); E_yy tính trên chính
+        # vectors đã lưu để khớp với E_xy lúc truy vấn
+        member_vectors = vectors[np.concatenate(member_rows)].astype(np.float16)
+        index = cls(
+            model.cluster_centers_,
+            member_ids,
+            self_energies,
+            n_vectors=len(ids),
+            member_vectors=member_vectors,
+            sample_rows=sample_rows,
+        )
+        for cluster_id in range(n_clusters):
+            index.self_energies[cluster_id] = _mean_pairwise_distance(
+                index._cluster_vectors(cluster_id, sample_rows[cluster_id])
+            )
+
+        non_empty = sum(1 for members in member_ids if members)
+        print(f"✅ Cluster index: {non_empty} cụm khác rỗng trên {len(ids)} vectors.")
+        return index
+
+    def save(self, persist_dir: str) -> str:
+        """Lưu index vào <persist_dir>/energy_cluster_index.npz (+ energy_cluster_vectors.npy)."""
+        os.makedirs(persist_dir, exist_ok=True)
+        path = os.path.join(persist_dir, INDEX_FILENAME)
+        vectors_path = os.path.join(persist_dir, VECTORS_FILENAME)
+        flat_ids = [member for members in self.member_ids for member in members]
+        arrays = {}
+        if self.member_vectors is not None and self.sample_rows is not None:
+            np.save(vectors_path, np.asarray(self.member_vectors, dtype=np.float16))
+            arrays["sample_rows"] = np.concatenate([*self.sample_rows, np.zeros(0, dtype=np.int64)])
+            arrays["sample_offsets"] = np.cumsum([0, *[len(rows) for rows in self.sample_rows]])
+        elif os.path.exists(vectors_path):
+            os.remove(vectors_path)
+        np.savez_compressed(
+            path,
+            centroids=self.centroids.astype(np.float32),
+            self_energies=self.self_energies,
+            member_ids=np.array(flat_ids, dtype=str),
+            offsets=self.offsets,
+            **arrays,
+        )
+        print(f"💾 Đã lưu cluster index tại '{path}'")
+        return path
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "CorpusClusterIndex | None":
+        """Đọc index nếu đã được build, ngược lại trả về None."""
+        path = os.path.join(persist_dir, INDEX_FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as data:
+            flat_ids = data["member_ids"].tolist()
+            offsets = data["offsets"].tolist()
+            member_ids = [flat_ids[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+            member_vectors, sample_rows = None, None
+            vectors_path = os.path.join(persist_dir, VECTORS_FILENAME)
+            if "sample_rows" in data and os.path.exists(vectors_path):
+                vectors = np.load(vectors_path, mmap_mode="r")
+                if len(vectors) == len(flat_ids):
+                    member_vectors = vectors
+                    flat_rows, sample_offsets = data["sample_rows"], data["sample_offsets"].tolist()
+                    sample_rows = [
+                        flat_rows[sample_offsets[i]:sample_offsets[i + 1]]
+                        for i in range(len(sample_offsets) - 1)
+                    ]
+                else:
+                    print(f"⚠️ '{VECTORS_FILENAME}' không khớp cluster index, đọc vectors từ Chroma.")
+
+            return cls(
+                data["centroids"],
+                member_ids,
+                data["self_energies"],
+                n_vectors=len(flat_ids),
+                member_vectors=member_vectors,
+                sample_rows=sample_rows,
+            )
+
+    # ------------------------------------------------------------------
+    # Online: xếp hạng cụm theo Energy Distance
+    # ------------------------------------------------------------------
+
+    def rank_clusters(
+        self,
+        query_vectors,
+        vector_store,
+        n_shortlist: int = 8,
+    ) -> list[tuple[int, float]]:
+        """
+        Xếp hạng cụm theo Energy Distance với phân phối query.
+
+        Chỉ n_shortlist cụm có centroid gần query nhất được tính ED đầy đủ;
+        E_yy lấy từ index nên chỉ còn phải tính E_xy (query × mẫu của cụm).
+        Mẫu đọc từ vectors đã lưu, không truy vấn Chroma (index cũ: đọc từ vector_store).
+
+        Returns:
+            list (cluster_id, energy) tăng dần theo energy.
+        """
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float64))
+        e_xx = float(pairwise_euclidean(query_vectors).mean())
+
+        centroid_distances = cross_euclidean(query_vectors, self.centroids).mean(axis=0)
+        sizes = np.array([len(members) for members in self.member_ids])
+        centroid_distances[sizes == 0] = np.inf
+        shortlist = [
+            int(cluster_id)
+            for cluster_id in np.argsort(centroid_distances)[:n_shortlist]
+            if np.isfinite(centroid_distances[cluster_id])
+        ]
+
+        samples = (
+            self._stored_samples(shortlist)
+            if self.member_vectors is not None
+            else self._fetch_samples(shortlist, vector_store)
+        )
+
+        ranked = []
+        for cluster_id in shortlist:
+            member_vectors = samples[cluster_id]
+            if len(member_vectors) == 0:
+                continue
+            e_xy = float(cross_euclidean(query_vectors, member_vectors).mean())
+            energy = max(0.0, 2 * e_xy - e_xx - float(self.self_energies[cluster_id]))
+            ranked.append((cluster_id, energy))
+
+        ranked.sort(key=lambda item: item[1])
+        return ranked
+
+    def _stored_samples(self, cluster_ids: list[int]) -> dict[int, np.ndarray]:
+        return {
+            cluster_id: self._cluster_vectors(cluster_id, self.sample_rows[cluster_id])
+            for cluster_id in cluster_ids
+        }
+
+    def _fetch_samples(self, cluster_ids: list[int], vector_store) -> dict[int, np.ndarray]:
+        """Index cũ chưa lưu vectors: lấy mẫu id rồi đọc embeddings từ Chroma."""
+        rng = np.random.default_rng(0)
+        sampled_ids: dict[int, list[str]] = {}
+        for cluster_id in cluster_ids:
+            members = self.member_ids[cluster_id]
+            rows = _sample_rows(rng, len(members), self.max_energy_sample)
+            sampled_ids[cluster_id] = [members[row] for row in rows]
+
+        all_ids = [member for cluster_id in cluster_ids for member in sampled_ids[cluster_id]]
+        vectors_by_id = self._fetch_embeddings(vector_store, all_ids)
+        return {
+            cluster_id: np.array([
+                vectors_by_id[member]
+                for member in sampled_ids[cluster_id]
+                if member in vectors_by_id
+            ])
+            for cluster_id in cluster_ids
+        }
+
+    def get_cluster_documents(
+        self,
+        cluster_id: int,
+        query_vectors,
+        vector_store,
+        max_docs: int | None = None,
+    ) -> list[tuple[Any, np.ndarray]]:
+        """
+        Lấy (Document, embedding) của một cụm, xếp theo độ gần phân phối query.
+
+        Args:
+            max_docs: Giới hạn số chunk trả về (cụm toàn corpus có thể rất lớn).
+                Với index có vectors đã lưu, chỉ max_docs chunk được chọn mới bị đọc từ Chroma.
+        """
+        from langchain_core.documents import Document
+
+        members = self.member_ids[cluster_id]
+        if not members:
+            return []
+
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float64))
+        if self.member_vectors is not None:
+            similarity = (self._cluster_vectors(cluster_id) @ query_vectors.T).mean(axis=1)
+            order = np.argsort(-similarity, kind="stable")
+            if max_docs:
+                order = order[:max_docs]
+            selected = [members[row] for row in order]
+            result = vector_store._collection.get(
+                ids=selected,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            # Chroma không đảm bảo thứ tự theo ids truyền vào
+            position = {member_id: row for row, member_id in enumerate(result["ids"])}
+            vectors = np.asarray(result["embeddings"], dtype=np.float64)
+            order = [position[member_id] for member_id in selected if member_id in position]
+        else:
+            result = vector_store._collection.get(
+                ids=members,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            vectors = np.asarray(result["embeddings"], dtype=np.float64)
+            similarity = (vectors @ query_vectors.T).mean(axis=1)
+            order = np.argsort(-similarity, kind="stable")
+            if max_docs:
+                order = order[:max_docs]
+
+        return [
+            (
+                Document(
+                    page_content=result["documents"][row] or "",
+                    metadata=result["metadatas"][row] or {},
+                ),
+                vectors[row],
+            )
+            for row in order
+        ]
+
+    @staticmethod
+    def _fetch_embeddings(vector_store, ids: list[str]) -> dict[str, np.ndarray]:
+        if not ids:
+            return {}
+        result = vector_store._collection.get(ids=ids, include=["embeddings"])
+        return {
+            member_id: np.asarray(vector, dtype=np.float64)
+            for member_id, vector in zip(result["ids"], result["embeddings"])
+        }
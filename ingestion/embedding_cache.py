@@ -0,0 +1,155 @@
+"""
+Cache embedding trên đĩa (SQLite), địa chỉ hóa theo nội dung.
+
+Key = sha256(tên model + prefix E5 + text), value = vector float32.
+Dùng cho E5EmbeddingsWrapper để:
+    - rebuild DB sau khi sửa vài file chỉ embed các chunk thay đổi,
+    - scoring/main.py (cosine_excel) không encode lại các câu đã gặp,
+    - câu hỏi lặp lại không phải encode lại query.
+
+Giới hạn kích thước bằng số entry tối đa, xóa theo LRU (last_access cũ nhất).
+last_access không ghi mỗi lần đọc: gom trong RAM, ghi theo lô (ACCESS_FLUSH_EVERY key hoặc
+ACCESS_FLUSH_SECONDS giây, trước eviction và khi close) nên đường đọc chỉ còn SELECT.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Iterable
+
+import numpy as np
+
+
+DEFAULT_CACHE_PATH = Path(__file__).parent.parent / "embedding_cache" / "embeddings.sqlite3"
+
+
+class EmbeddingCache:
+    """
+    Cache vector embedding dùng chung giữa các lần chạy và giữa các process.
+
+    Args:
+        path: File SQLite. Mặc định: embedding_cache/embeddings.sqlite3
+        namespace: Định danh model + cấu hình encode (đổi model là đổi key).
+        max_entries: Số vector tối đa giữ lại (~3KB/vector với dim 768).
+    """
+
+    # Chỉ kiểm tra eviction sau mỗi N lần ghi để không COUNT(*) liên tục
+    EVICT_CHECK_EVERY = 1000
+    SQLITE_MAX_VARIABLES = 900
+    # Ghi last_access đã gom khi đủ N key hoặc sau N giây
+    ACCESS_FLUSH_EVERY = 1000
+    ACCESS_FLUSH_SECONDS = 60.0
+
+    def __init__(self, path: str | os.PathLike | None = None, namespace: str = "", max_entries: int | None = None):
+        self.path = str(path or os.getenv("EMBEDDING_CACHE_PATH", "") or DEFAULT_CACHE_PATH)
+        self.namespace = namespace
+        self.max_entries = max_entries or int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+        self._lock = Lock()
+        self._writes_since_check = 0
+        # key -> last_access chưa ghi xuống DB
+        self._pending_access: dict[str, float] = {}
+        self._last_access_flush = time.time()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        self.conn.commit()
+
+    def make_key(self, text: str) -> str:
+        """Key cho text ĐÃ gắn prefix (vd: 'passage: ...')."""
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Đọc các vector đã có; key không có trong cache bị bỏ qua."""
+        found: dict[str, list[float]] = {}
+        if not keys:
+            return found
+
+        now = time.time()
+        with self._lock:
+            for batch in _chunks(list(dict.fromkeys(keys)), self.SQLITE_MAX_VARIABLES):
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    self._pending_access[key] = now
+            if (
+                len(self._pending_access) >= self.ACCESS_FLUSH_EVERY
+                or now - self._last_access_flush >= self.ACCESS_FLUSH_SECONDS
+            ):
+                self._flush_access_locked()
+        return found
+
+    def put_many(self, items: dict[str, list[float]]) -> None:
+        """Ghi (hoặc ghi đè) các vector mới vào cache."""
+        if not items:
+            return
+
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+            self._writes_since_check += len(rows)
+            if self._writes_since_check >= self.EVICT_CHECK_EVERY:
+                self._writes_since_check = 0
+                self._evict_locked()
+
+    def _flush_access_locked(self) -> None:
+        self._last_access_flush = time.time()
+        if not self._pending_access:
+            return
+        self.conn.executemany(
+            "UPDATE embeddings SET last_access = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._pending_access.items()],
+        )
+        self.conn.commit()
+        self._pending_access.clear()
+
+    def _evict_locked(self) -> None:
+        # LRU phải thấy các lần đọc gần nhất
+        self._flush_access_locked()
+        count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        self.conn.execute("""
+            DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+            )
+        """, (overflow,))
+        self.conn.commit()
+        print(f"🧹 Embedding cache: đã xóa {overflow} vector ít dùng nhất (LRU).")
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_access_locked()
+            self.conn.close()
+
+
+def _chunks(items: list[str], size: int) -> Iterable[list[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -17,4 +17,97 @@ def energy_base_distance(X,Y):
     #Energy_distance
     ED=2*E_xy - E_xx - E_yy
 
-    return max(0,ED)
\ No newline at end of file
+    return max(0,ED)
+
+
+def pairwise_euclidean(vectors):
+    """
+    Ma trận khoảng cách Euclid của toàn bộ vectors, tính từ 1 Gram matrix.
+
+    ‖a−b‖² = ‖a‖² + ‖b‖² − 2a·b. Với vector E5 đã L2-normalize thì
+    ‖a‖ = ‖b‖ = 1 nên công thức rút về sqrt(2 − 2a·b), chỉ tốn 1 phép nhân ma trận.
+    """
+    V = np.asarray(vectors, dtype=np.float64)
+    gram = V @ V.T
+    sq_norms = np.diag(gram)
+    d2 = sq_norms[:, None] + sq_norms[None, :] - 2.0 * gram
+    np.maximum(d2, 0.0, out=d2)
+    np.fill_diagonal(d2, 0.0)
+    return np.sqrt(d2)
+
+
+def cross_euclidean(X, Y):
+    """Khoảng cách Euclid giữa từng hàng của X và Y (tương đương cdist), qua tích vô hướng."""
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    d2 = (X ** 2).sum(axis=1)[:, None] + (Y ** 2).sum(axis=1)[None, :] - 2.0 * X @ Y.T
+    return np.sqrt(np.maximum(d2, 0.0))
+
+
+class EnergyDistanceBatch:
+    """
+    Tính Energy Distance giữa 1 phân phối query và NHIỀU cụm docs trong 1 lượt.
+
+    Ma trận khoảng cách của [query vectors ∪ doc vectors] chỉ tính 1 lần.
+    Sau đó mỗi cách gom cụm (labels) được chấm điểm bằng ma trận one-hot M
+    (n_docs × k), không gọi lại cdist cho từng cụm / từng K:
+        E_xy[c] = mean(D_xd[:, cụm c])         = (1ᵀ D_xd M)[c] / (n_x · n_c)
+        E_yy[c] = mean(D_dd[cụm c, cụm c])     = diag(Mᵀ D_dd M)[c] / n_c²
+        ED[c]   = max(0, 2·E_xy[c] − E_xx − E_yy[c])
+    Kết quả trùng với energy_base_distance(query_vectors, doc_vectors[labels == c]).
+    """
+
+    def __init__(self, query_vectors, doc_vectors):
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float64))
+        doc_vectors = np.atleast_2d(np.asarray(doc_vectors, dtype=np.float64))
+        self.n_queries = len(query_vectors)
+        self.n_docs = len(doc_vectors)
+
+        distances = pairwise_euclidean(np.vstack([query_vectors, doc_vectors]))
+        q = self.n_queries
+        self.query_distances = distances[:q, :q]
+        self.cross_distances = distances[:q, q:]
+        # Ma trận doc×doc dùng lại được cho silhouette / K-Means ở các bước sau
+        self.doc_distances = distances[q:, q:]
+
+        self.e_xx = float(self.query_distances.mean())
+        # Tổng khoảng cách từ phân phối query tới từng doc (1 lần cho mọi cụm)
+        self._cross_sums = self.cross_distances.sum(axis=0)
+
+    def score_labels(self, labels, n_clusters=None):
+        """
+        Energy Distance của từng cụm trong 1 labeling.
+
+        Args:
+            labels: Mảng nhãn cụm (0..k-1) cho từng doc.
+            n_clusters: Số cụm (mặc định max(labels) + 1).
+
+        Returns:
+            np.ndarray shape (k,): ED của từng cụm, cụm rỗng nhận np.inf.
+        """
+        labels = np.asarray(labels, dtype=int)
+        k = int(n_clusters if n_clusters is not None else labels.max() + 1)
+        membership = np.zeros((self.n_docs, k))
+        membership[np.arange(self.n_docs), labels] = 1.0
+        counts = membership.sum(axis=0)
+
+        energies = np.full(k, np.inf)
+        non_empty = counts > 0
+        if not np.any(non_empty):
+            return energies
+
+        e_xy = (self._cross_sums @ membership)[non_empty] / (self.n_queries * counts[non_empty])
+        within = np.einsum("ic,ij,jc->c", membership, self.doc_distances, membership)
+        e_yy = within[non_empty] / counts[non_empty] ** 2
+        energies[non_empty] = np.maximum(0.0, 2 * e_xy - self.e_xx - e_yy)
+        return energies
+
+    def rank_clusters(self, labels, n_clusters=None):
+        """Trả về list (cluster_id, energy) sắp xếp tăng dần, bỏ cụm rỗng."""
+        energies = self.score_labels(labels, n_clusters)
+        order = np.argsort(energies, kind="stable")
+        return [
+            (int(cluster_id), float(energies[cluster_id]))
+            for cluster_id in order
+            if np.isfinite(energies[cluster_id])
+        ]
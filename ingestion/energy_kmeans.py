@@ -1,10 +1,8 @@
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-import warnings
-warnings.filterwarnings("ignore", category=UserWarning) # Ẩn cảnh báo của K-Means
 from sklearn.metrics.pairwise import cosine_similarity
-from ingestion.energy_base_distance import energy_base_distance
+from ingestion.energy_base_distance import EnergyDistanceBatch
+from ingestion.kmeans_selector import KMeansSelector
+from ingestion.vector_search import fill_missing_embeddings, search_with_embeddings
 
 
 class EnergyRetriever:
@@ -35,6 +33,8 @@ class EnergyRetriever:
         self.embeddings = embeddings_model
         self.n_top_clusters = n_top_clusters
         self.vector_store = vector_store
+        self.k_retrieve = k_retrieve
+        self.kmeans_selector = KMeansSelector()
 
     def retrieve(self, query):
         """
@@ -48,19 +48,20 @@ class EnergyRetriever:
         """
         print(f"\n🔎 [Energy Retriever] Đang xử lý câu hỏi: '{query}'")
         
-        # 1. Truy xuất diện rộng (Top 40 từ cosine similarity)
-        docs = self.retriever.invoke(query)
-        if not docs:
+        # 1. Truy xuất diện rộng (Top 40 từ cosine similarity), lấy kèm vector đã lưu trong Chroma
+        query_embedding = self.embeddings.embed_query(query)
+        hits = search_with_embeddings(self.vector_store, query_embedding, k=self.k_retrieve)
+        if not hits:
             print("   -> ⚠️ Không tìm thấy tài liệu thô nào.")
             return []
 
-        context = [doc.page_content for doc in docs]
+        docs = [doc for doc, _, _ in hits]
 
-        # 2. Embedding lại query và context.
-        # Code cũ: query chỉ có 1 vector nên không biểu diễn đúng phân phối query.
-        # Pipeline chính dùng query_splitter.py để tạo nhiều query vectors trước khi tính ED.
-        doc_vectors = np.array(self.embeddings.embed_documents(context))
-        query_vector = np.array(self.embeddings.embed_query(query)).reshape(1, -1)
+        # 2. Vector của docs đọc từ Chroma (không embed lại context).
+        # Code cũ: query chỉ có 1 vector nên không biểu diễn đúng phân phối query.
+        # Pipeline chính dùng query_splitter.py để tạo nhiều query vectors trước khi tính ED.
+        doc_vectors = fill_missing_embeddings(self.embeddings, docs, [vector for _, vector, _ in hits])
+        query_vector = np.array(query_embedding).reshape(1, -1)
 
         # 3. Tính cosine similarity cho từng doc (dùng để log)
         sims = cosine_similarity(query_vector, doc_vectors)[0]
@@ -70,53 +71,28 @@ class EnergyRetriever:
         n_samples = len(doc_vectors)
         print(f"   -> 📋 Đưa toàn bộ {n_samples} docs vào K-Means")
 
-        # 5. Gom cụm K-Means
-        max_possible_k = min(10, n_samples - 1)
-        
-        best_k = 2
-        best_labels = None
-        
+        # 5. Gom cụm K-Means (silhouette dùng lại ma trận doc×doc của energy_batch)
+        energy_batch = EnergyDistanceBatch(query_vector, doc_vectors)
+
         if n_samples > 2:
-            best_score = -1.0
-            
-            for k in range(2, max_possible_k + 1):
-                kmeans_temp = KMeans(n_clusters=k, random_state=42, n_init='auto')
-                labels_temp = kmeans_temp.fit_predict(doc_vectors)
-                
-                score = silhouette_score(doc_vectors, labels_temp)
-                
-                if score > best_score:
-                    best_score = score
-                    best_k = k
-                    best_labels = labels_temp
-            
-            print(f"   -> 🤖 Tự động chọn K tối ưu = {best_k} (Silhouette Score cao nhất: {best_score:.4f})")
-            labels = best_labels
-            actual_k = best_k
-            
+            labels, actual_k, best_score = self.kmeans_selector.fit(
+                doc_vectors, distances=energy_batch.doc_distances
+            )
+            score_text = f"{best_score:.4f}" if best_score is not None else "N/A"
+            print(f"   -> 🤖 Tự động chọn K tối ưu = {actual_k} (Silhouette Score cao nhất: {score_text})")
+
         else:
-            best_k = 1
             labels = np.zeros(n_samples, dtype=int)
-            actual_k = best_k
+            actual_k = 1
             print(f"   -> ⚠️ Số lượng docs quá ít ({n_samples}), tự động gom thành 1 cụm.")
 
 
         # 6. Tính Energy Distance cho từng cụm và xếp hạng
-        cluster_energies = []
-        for i in range(actual_k):
-            cluster_mask = labels == i
-            if not np.any(cluster_mask):
-                continue
-                
-            cluster_vectors = doc_vectors[cluster_mask]
-            # Code cũ: không dùng kết quả này để mô tả pipeline hiện tại,
-            # vì X chỉ có 1 query vector. Với chatbot hiện tại, ED được tính bằng:
-            # energy_base_distance(query_vectors, cluster_vectors)
-            # trong SplitQueryEnergyRetriever, trong đó query_vectors gồm câu hỏi gốc + câu hỏi con.
-            energy = energy_base_distance(query_vector, cluster_vectors)
-            cluster_energies.append((i, energy))
-        
-        cluster_energies.sort(key=lambda x: x[1])
+        # Code cũ: không dùng kết quả này để mô tả pipeline hiện tại,
+        # vì X chỉ có 1 query vector. Với chatbot hiện tại, ED được tính bằng
+        # EnergyDistanceBatch(query_vectors, doc_vectors) trong SplitQueryEnergyRetriever,
+        # trong đó query_vectors gồm câu hỏi gốc + câu hỏi con.
+        cluster_energies = energy_batch.rank_clusters(labels, actual_k)
         
         # 7. Lấy docs từ top N clusters
         n_select = min(self.n_top_clusters, len(cluster_energies))
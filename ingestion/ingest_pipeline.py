@@ -0,0 +1,226 @@
+"""
+Pipeline ingest dạng streaming cho corpus lớn.
+
+    process pool (đọc + cắt file song song, số file đang xử lý có giới hạn)
+        -> gom chunks mới thành batch cố định
+        -> embed batch (process chính)
+        -> hàng đợi có giới hạn -> thread ghi Chroma (upsert kèm embedding)
+
+Embed batch i+1 chạy song song với việc ghi batch i, và bộ nhớ đỉnh phụ thuộc
+vào batch_size / số file đang xử lý thay vì kích thước toàn corpus.
+Dùng chung manifest + id chunk với ChromaDBManager.sync_documents nên có thể
+chạy incremental: file có hash không đổi bị bỏ qua ngay trong worker.
+"""
+
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from ingestion.chunks_document import (
+    UPSERT_BATCH_SIZE,
+    chunk_id,
+    file_hash,
+    split_documents,
+)
+from ingestion.load_document import iter_document_paths, load_document_file
+
+
+def _load_and_split(filepath, dataset_dir, chunk_config, previous_hash):
+    """
+    Worker (chạy trong process con): đọc + cắt 1 file.
+
+    Returns:
+        tuple (source, hash, chunks). chunks = None nếu file không đổi,
+        hash = None nếu file rỗng.
+    """
+    doc = load_document_file(filepath, dataset_dir)
+    if doc is None:
+        return filepath, None, []
+
+    digest = file_hash([doc], chunk_config)
+    if digest == previous_hash:
+        return filepath, digest, None
+
+    chunks, _ = split_documents([doc], chunk_config["chunk_size"], chunk_config["chunk_overlap"])
+    return filepath, digest, chunks
+
+
+class StreamingIngestPipeline:
+    """
+    Ingest toàn bộ thư mục vào Chroma theo kiểu streaming.
+
+    Args:
+        db_manager: ChromaDBManager đích (embedding model + persist_dir + manifest).
+        max_workers: Số process đọc/cắt file. Mặc định: env INGEST_WORKERS hoặc số CPU.
+        batch_size: Số chunk mỗi lần embed/ghi. Mặc định: env INGEST_BATCH_SIZE (256).
+        max_pending_files: Số file tối đa đang nằm trong process pool.
+        write_queue_size: Số batch đã embed tối đa chờ ghi vào Chroma.
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        max_workers: int | None = None,
+        batch_size: int | None = None,
+        max_pending_files: int | None = None,
+        write_queue_size: int = 2,
+    ) -> None:
+        self.db_manager = db_manager
+        self.max_workers = max_workers or int(os.getenv("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+        self.batch_size = min(batch_size or int(os.getenv("INGEST_BATCH_SIZE", "256")), UPSERT_BATCH_SIZE)
+        self.max_pending_files = max_pending_files or self.max_workers * 4
+        self.write_queue_size = write_queue_size
+
+    def run(self, dataset_dir, chunk_size=600, chunk_overlap=80):
+        """Đồng bộ DB với dataset_dir, trả về dict thống kê giống sync_documents()."""
+        db_manager = self.db_manager
+        chunk_config = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+        manifest = db_manager._load_manifest()
+        old_files = manifest["files"]
+        if manifest.get("chunk_config") not in (None, chunk_config):
+            print("⚠️ Cấu hình chunking đã đổi → mọi file sẽ được cắt lại.")
+
+        old_ids = {cid for entry in old_files.values() for cid in entry["chunk_ids"]}
+        vector_store = db_manager._load_vector_store()
+
+        writer = _ChromaWriter(vector_store._collection, self.write_queue_size)
+        writer.start()
+
+        new_files = {}
+        seen_sources = set()
+        queued_ids = set()
+        pending_chunks = []
+        stats = {"added": 0, "deleted": 0, "unchanged_files": 0, "changed_files": 0, "removed_files": 0}
+
+        def flush(force=False):
+            while pending_chunks and (force or len(pending_chunks) >= self.batch_size):
+                batch = pending_chunks[:self.batch_size]
+                del pending_chunks[:self.batch_size]
+                vectors = db_manager.embeddings.embed_documents([doc.page_content for _, doc in batch])
+                writer.put(batch, vectors)
+                stats["added"] += len(batch)
+                print(f"   -> 🧠 Đã embed {stats['added']} chunks mới...")
+
+        def collect(result):
+            source, digest, chunks = result
+            seen_sources.add(source)
+            if digest is None:
+                return
+            if chunks is None:
+                new_files[source] = old_files[source]
+                stats["unchanged_files"] += 1
+                return
+
+            stats["changed_files"] += 1
+            ids = []
+            for doc in chunks:
+                cid = chunk_id(doc)
+                if cid not in ids:
+                    ids.append(cid)
+                if cid not in old_ids and cid not in queued_ids:
+                    queued_ids.add(cid)
+                    pending_chunks.append((cid, doc))
+            new_files[source] = {"hash": digest, "chunk_ids": ids}
+            flush()
+
+        print(f"🚀 Ingest streaming từ '{dataset_dir}' ({self.max_workers} workers, batch {self.batch_size})...")
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                in_flight = {}
+                for filepath in iter_document_paths(dataset_dir):
+                    previous = old_files.get(filepath)
+                    future = pool.submit(
+                        _load_and_split, filepath, dataset_dir, chunk_config,
+                        previous["hash"] if previous else None,
+                    )
+                    in_flight[future] = filepath
+                    if len(in_flight) >= self.max_pending_files:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        self._collect_done(done, in_flight, collect, old_files, new_files, seen_sources)
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._collect_done(done, in_flight, collect, old_files, new_files, seen_sources)
+            flush(force=True)
+        finally:
+            writer.close()
+
+        removed_files = [source for source in old_files if source not in seen_sources]
+        stats["removed_files"] = len(removed_files)
+
+        live_ids = {cid for entry in new_files.values() for cid in entry["chunk_ids"]}
+        to_delete = sorted(old_ids - live_ids)
+        for start in range(0, len(to_delete), UPSERT_BATCH_SIZE):
+            vector_store.delete(ids=to_delete[start:start + UPSERT_BATCH_SIZE])
+        stats["deleted"] = len(to_delete)
+
+        changed = bool(stats["added"] or stats["deleted"] or stats["changed_files"] or removed_files)
+        if changed or not os.path.exists(db_manager.manifest_path):
+            manifest["version"] += 1 if changed else 0
+            manifest["chunk_config"] = chunk_config
+            manifest["files"] = new_files
+            db_manager._save_manifest(manifest)
+
+        stats["version"] = manifest["version"]
+        print(f"📊 Ingest: {stats['unchanged_files']} file không đổi, {stats['changed_files']} file mới/đã sửa, "
+              f"{stats['removed_files']} file đã xóa.")
+        print(f"✅ Đồng bộ xong: +{stats['added']} / -{stats['deleted']} chunks, "
+              f"DB hiện có {vector_store._collection.count()} vectors (version {stats['version']}).")
+        return stats
+
+    @staticmethod
+    def _collect_done(done, in_flight, collect, old_files, new_files, seen_sources):
+        for future in done:
+            filepath = in_flight.pop(future)
+            try:
+                collect(future.result())
+            except Exception as e:
+                # Lỗi đọc file: giữ nguyên chunks cũ của file (nếu có) thay vì xóa
+                print(f"❌ Lỗi đọc file {filepath}: {e}")
+                seen_sources.add(filepath)
+                if filepath in old_files:
+                    new_files[filepath] = old_files[filepath]
+
+
+class _ChromaWriter:
+    """Thread ghi các batch (đã có embedding) vào Chroma qua hàng đợi có giới hạn."""
+
+    def __init__(self, collection, max_pending_batches: int) -> None:
+        self.collection = collection
+        self.queue = queue.Queue(maxsize=max(1, max_pending_batches))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="chroma-writer", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def put(self, batch, vectors) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put((batch, vectors))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            batch, vectors = item
+            try:
+                self.collection.upsert(
+                    ids=[cid for cid, _ in batch],
+                    embeddings=[list(vector) for vector in vectors],
+                    documents=[doc.page_content for _, doc in batch],
+                    metadatas=[doc.metadata or None for _, doc in batch],
+                )
+            except Exception as e:
+                self.error = e
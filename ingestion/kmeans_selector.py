@@ -0,0 +1,118 @@
+"""
+Chọn số cụm K cho K-Means bằng Silhouette Score, tối ưu cho CPU.
+
+Cách cũ: với mỗi k trong 2..10 fit một KMeans mới từ đầu và gọi
+silhouette_score(doc_vectors, labels), tức 9 lần fit + 9 lần tính lại
+toàn bộ khoảng cách O(n²) cho mỗi câu hỏi.
+
+KMeansSelector:
+    - Dùng MỘT ma trận khoảng cách doc×doc (precomputed) cho silhouette ở mọi k.
+    - Warm-start: centroids của k+1 = centroids của k + điểm xa tâm cụm nhất.
+    - Early stopping: dừng khi score không cải thiện sau `patience` bước k liên tiếp.
+"""
+
+from __future__ import annotations
+
+import os
+import warnings
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+
+from ingestion.energy_base_distance import pairwise_euclidean
+
+warnings.filterwarnings("ignore", category=UserWarning)  # Ẩn cảnh báo của K-Means
+
+
+class KMeansSelector:
+    """
+    Quét K tăng dần với warm-start và silhouette trên ma trận khoảng cách dùng chung.
+
+    Kết quả fit() là (labels, best_k, best_score). Khi số docs <= 2 thì gom
+    tất cả vào 1 cụm và best_score = None (giống hành vi của retriever cũ).
+    """
+
+    def __init__(
+        self,
+        k_min: int = 2,
+        k_max: int = 10,
+        patience: int | None = None,
+        random_state: int = 42,
+    ) -> None:
+        self.k_min = max(2, k_min)
+        self.k_max = max(self.k_min, k_max)
+        if patience is None:
+            patience = int(os.getenv("KMEANS_SWEEP_PATIENCE", "3"))
+        # patience <= 0: tắt early stopping, quét đủ k_min..k_max
+        self.patience = patience
+        self.random_state = random_state
+
+    def fit(
+        self,
+        vectors,
+        distances=None,
+    ) -> tuple[np.ndarray, int, float | None]:
+        """
+        Gom cụm vectors và chọn K có Silhouette Score cao nhất.
+
+        Args:
+            vectors: Ma trận doc vectors (n_samples × dim).
+            distances: Ma trận khoảng cách Euclid doc×doc đã tính sẵn (tùy chọn),
+                ví dụ EnergyDistanceBatch.doc_distances. Nếu None sẽ tự tính 1 lần.
+
+        Returns:
+            tuple: (labels, best_k, best_score)
+        """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        n_samples = len(vectors)
+
+        if n_samples <= 2:
+            return np.zeros(n_samples, dtype=int), 1, None
+
+        if distances is None:
+            distances = pairwise_euclidean(vectors)
+
+        max_possible_k = min(self.k_max, n_samples - 1)
+        best_score = -1.0
+        best_k = self.k_min
+        best_labels = None
+        centroids = None
+        stale_steps = 0
+
+        for k in range(self.k_min, max_possible_k + 1):
+            if centroids is None:
+                model = KMeans(n_clusters=k, random_state=self.random_state, n_init="auto")
+            else:
+                init = np.vstack([centroids, self._next_seed(vectors, labels, centroids)])
+                model = KMeans(n_clusters=k, init=init, n_init=1, random_state=self.random_state)
+
+            labels = model.fit_predict(vectors)
+            centroids = model.cluster_centers_
+
+            n_labels = len(np.unique(labels))
+            if n_labels < 2 or n_labels >= n_samples:
+                continue
+
+            score = float(silhouette_score(distances, labels, metric="precomputed"))
+
+            if score > best_score:
+                best_score = score
+                best_k = k
+                best_labels = labels
+                stale_steps = 0
+            else:
+                stale_steps += 1
+                if self.patience > 0 and stale_steps >= self.patience:
+                    break
+
+        if best_labels is None:
+            return np.zeros(n_samples, dtype=int), 1, None
+
+        return best_labels, best_k, best_score
+
+    @staticmethod
+    def _next_seed(vectors: np.ndarray, labels: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Điểm xa tâm cụm của nó nhất — seed cho centroid mới khi tăng k."""
+        residuals = np.linalg.norm(vectors - centroids[labels], axis=1)
+        return vectors[int(np.argmax(residuals))]
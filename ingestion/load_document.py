@@ -2,36 +2,48 @@ import os
 import glob
 from langchain_core.documents import Document
 
-def load_documents_from_dir(dataset_dir='./Dataset_economy'):
-    documents = []
-    
+def iter_document_paths(dataset_dir='./Dataset_economy'):
+    """Liệt kê (lazy) các file .txt trong dataset_dir, kể cả thư mục con."""
     # 1. Tạo pattern tìm kiếm an toàn trên mọi OS
     search_pattern = os.path.join(dataset_dir, '**', '*.txt')
+    return glob.iglob(search_pattern, recursive=True)
+
+
+def load_document_file(filepath, dataset_dir='./Dataset_economy'):
+    """Đọc 1 file .txt thành Document, trả về None nếu file rỗng."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+
+    if not content:  # 2. Bỏ qua file rỗng
+        return None
+
+    # 3. Lấy tên Category AN TOÀN trên cả Windows lẫn Mac/Linux
+    # os.path.relpath loại bỏ phần thư mục gốc. 
+    # VD: ./Dataset_economy/NganHang/file1.txt -> NganHang/file1.txt
+    rel_path = os.path.relpath(filepath, dataset_dir)
+
+    # Dùng os.sep để tự động lấy dấu / hoặc \ tuỳ hệ điều hành
+    parts = rel_path.split(os.sep) 
+    category = parts[0] if len(parts) > 1 else 'unknown'
+
+    # 4. Tạo Document
+    return Document(
+        page_content=content,
+        metadata={
+            "source": filepath,
+            "category": category,
+            "filename": os.path.basename(filepath)
+        }
+    )
+
+
+def load_documents_from_dir(dataset_dir='./Dataset_economy'):
+    documents = []
     
-    for filepath in glob.glob(search_pattern, recursive=True):
+    for filepath in iter_document_paths(dataset_dir):
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                
-            if content:  # 2. Bỏ qua file rỗng
-                # 3. Lấy tên Category AN TOÀN trên cả Windows lẫn Mac/Linux
-                # os.path.relpath loại bỏ phần thư mục gốc. 
-                # VD: ./Dataset_economy/NganHang/file1.txt -> NganHang/file1.txt
-                rel_path = os.path.relpath(filepath, dataset_dir)
-                
-                # Dùng os.sep để tự động lấy dấu / hoặc \ tuỳ hệ điều hành
-                parts = rel_path.split(os.sep) 
-                category = parts[0] if len(parts) > 1 else 'unknown'
-                
-                # 4. Tạo Document
-                doc = Document(
-                    page_content=content,
-                    metadata={
-                        "source": filepath,
-                        "category": category,
-                        "filename": os.path.basename(filepath)
-                    }
-                )
+            doc = load_document_file(filepath, dataset_dir)
+            if doc is not None:
                 documents.append(doc)
                 
         except Exception as e:
@@ -1,9 +1,11 @@
 import os
 from threading import Lock
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, TYPE_CHECKING
 
 from langchain_core.embeddings import Embeddings
 
+from ingestion.embedding_cache import EmbeddingCache
+
 if TYPE_CHECKING:
     from langchain_huggingface import HuggingFaceEmbeddings
 
@@ -22,19 +24,49 @@ class E5EmbeddingsWrapper(Embeddings):
 
     def __init__(self, base_embeddings: "HuggingFaceEmbeddings",
                  query_prefix: str = "query: ",
-                 passage_prefix: str = "passage: "):
+                 passage_prefix: str = "passage: ",
+                 cache: Optional["EmbeddingCache"] = None):
         self._base = base_embeddings
         self._query_prefix = query_prefix
         self._passage_prefix = passage_prefix
+        self._cache = cache
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Embed danh sách documents (thêm prefix 'passage: ')."""
         prefixed = [self._passage_prefix + t for t in texts]
-        return self._base.embed_documents(prefixed)
+        return self._embed_cached(prefixed)
 
     def embed_query(self, text: str) -> List[float]:
         """Embed câu hỏi / query (thêm prefix 'query: ')."""
-        return self._base.embed_query(self._query_prefix + text)
+        if self._cache is None:
+            return self._base.embed_query(self._query_prefix + text)
+        return self._embed_cached([self._query_prefix + text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed nhiều query trong 1 batch (thêm prefix 'query: ' cho từng câu)."""
+        prefixed = [self._query_prefix + t for t in texts]
+        return self._embed_cached(prefixed)
+
+    def _embed_cached(self, prefixed: List[str]) -> List[List[float]]:
+        """Chỉ gọi model cho các text chưa có trong cache (text đã gắn prefix)."""
+        if self._cache is None:
+            return self._base.embed_documents(prefixed)
+
+        keys = [self._cache.make_key(text) for text in prefixed]
+        cached = self._cache.get_many(keys)
+
+        missing: dict[str, str] = {}
+        for key, text in zip(keys, prefixed):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            fresh = self._base.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), fresh))
+            self._cache.put_many(new_items)
+            cached.update(new_items)
+
+        return [list(cached[key]) for key in keys]
 
 
 class VietnameseEmbedding:
@@ -94,14 +126,25 @@ class VietnameseEmbedding:
                     model_kwargs=self.model_kwargs,
                     encode_kwargs=self.encode_kwargs
                 )
-                # Bọc wrapper để tự động thêm prefix cho E5
-                self.embeddings = E5EmbeddingsWrapper(base)
+                # Bọc wrapper để tự động thêm prefix cho E5 (+ cache embedding trên đĩa)
+                self.embeddings = E5EmbeddingsWrapper(base, cache=self._build_cache())
                 print("✅ Đã tải mô hình thành công!")
                 return self.embeddings
             except Exception as e:
                 print(f"❌ Lỗi khi tải mô hình: {e}")
                 raise
 
+    def _build_cache(self) -> EmbeddingCache | None:
+        """Bật cache mặc định; đặt EMBEDDING_CACHE_ENABLED=false để tắt."""
+        if os.getenv("EMBEDDING_CACHE_ENABLED", "true").strip().lower() in {"0", "false", "no"}:
+            return None
+        try:
+            namespace = f"{self.model_name}|normalize={self.encode_kwargs.get('normalize_embeddings')}"
+            return EmbeddingCache(namespace=namespace)
+        except Exception as e:
+            print(f"⚠️ Không mở được embedding cache, chạy không cache: {e}")
+            return None
+
     def get_model(self):
         """Trả về object embeddings (lazy-load và đã có prefix wrapper)."""
         return self._load_model()
@@ -9,19 +9,26 @@ Luồng dùng trong chatbot:
 
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import json
 import os
 import re
 import unicodedata
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
 from sklearn.metrics.pairwise import cosine_similarity
 
-from ingestion.energy_base_distance import energy_base_distance
+from ingestion.cluster_index import CorpusClusterIndex
+from ingestion.energy_base_distance import EnergyDistanceBatch
+from ingestion.kmeans_selector import KMeansSelector
+from ingestion.split_cache import build_split_cache
+from ingestion.vector_search import (
+    embed_queries,
+    fill_missing_embeddings,
+    search_many_with_embeddings,
+)
 
 
 def _clean_text(text: object) -> str:
@@ -73,32 +80,11 @@ def _fallback_query_parts(question: str, max_parts: int) -> list[str]:
     chỉ tạo thêm biến thể truy vấn cho retrieval.
     """
 
-    base = _strip_question_label(question)
-    base = _clean_text(re.sub(r"[?!.;:]+", " ", base))
-    candidates: list[str] = []
-
-    connector_pattern = re.compile(
-        r"\s*(?:,|\bva\b|\bvà\b|\bhoac\b|\bhoặc\b|\bnhung\b|\bnhưng\b|"
-        r"\bdong thoi\b|\bđồng thời\b|\bngoai ra\b|\bngoài ra\b)\s*",
-        flags=re.IGNORECASE,
-    )
-    for piece in connector_pattern.split(base):
-        piece = _clean_text(piece)
-        if len(piece.split()) >= 5:
-            candidates.append(piece)
-
-    stopwords = {
-        "câu", "hỏi", "là", "gì", "nào", "bao", "nhiêu", "có", "không",
-        "hãy", "cho", "biết", "về", "trong", "của", "ở", "đâu", "khi",
-        "như", "thế", "nào", "được", "đã",
-    }
-    keyword_words = [
-        word
-        for word in re.sub(r"[^\w\s]", " ", base.lower()).split()
-        if word not in stopwords
-    ]
-    keyword_query = " ".join(keyword_words)
-    if len(keyword_words) >= 5:
+    base = _question_base(question)
+    candidates: list[str] = _clause_parts(base)
+
+    keyword_query = _keyword_query(base)
+    if keyword_query:
         candidates.append(keyword_query)
 
     if base:
@@ -108,6 +94,75 @@ def _fallback_query_parts(question: str, max_parts: int) -> list[str]:
     return _dedupe_keep_order(candidates)[:max_parts]
 
 
+_CONNECTOR_PATTERN = re.compile(
+    r"\s*(?:,|\bva\b|\bvà\b|\bhoac\b|\bhoặc\b|\bnhung\b|\bnhưng\b|"
+    r"\bdong thoi\b|\bđồng thời\b|\bngoai ra\b|\bngoài ra\b)\s*",
+    flags=re.IGNORECASE,
+)
+
+_KEYWORD_STOPWORDS = {
+    "câu", "hỏi", "là", "gì", "nào", "bao", "nhiêu", "có", "không",
+    "hãy", "cho", "biết", "về", "trong", "của", "ở", "đâu", "khi",
+    "như", "thế", "nào", "được", "đã",
+}
+
+
+def _question_base(question: str) -> str:
+    """Câu hỏi bỏ nhãn "Câu hỏi:" và dấu câu."""
+    base = _strip_question_label(question)
+    return _clean_text(re.sub(r"[?!.;:]+", " ", base))
+
+
+def _clause_parts(base: str) -> list[str]:
+    """Tách theo dấu phẩy / từ nối (và, hoặc, nhưng, đồng thời, ngoài ra), giữ vế >= 5 từ."""
+    return [
+        piece
+        for piece in (_clean_text(piece) for piece in _CONNECTOR_PATTERN.split(base))
+        if len(piece.split()) >= 5
+    ]
+
+
+def _keyword_query(base: str) -> str:
+    """Truy vấn từ khóa (bỏ từ để hỏi), rỗng nếu còn ít hơn 5 từ."""
+    keyword_words = [
+        word
+        for word in re.sub(r"[^\w\s]", " ", base.lower()).split()
+        if word not in _KEYWORD_STOPWORDS
+    ]
+    return " ".join(keyword_words) if len(keyword_words) >= 5 else ""
+
+
+def _finalize_query_parts(
+    question: str,
+    parts: list[str],
+    max_parts: int,
+    include_original: bool,
+    min_query_vectors: int,
+) -> list[str]:
+    """Lọc parts xấu, bù fallback và thêm câu hỏi gốc (dùng chung cho mọi splitter)."""
+    parts = [
+        part
+        for part in _dedupe_keep_order(parts[:max_parts])
+        if not _is_bad_query_part(part)
+    ]
+    if len(parts) < max_parts:
+        parts = _dedupe_keep_order(
+            [*parts, *_fallback_query_parts(question, max_parts)]
+        )
+
+    if include_original:
+        parts = [question, *parts]
+
+    parts = _dedupe_keep_order(parts) or [question]
+    if len(parts) < min_query_vectors:
+        parts = _dedupe_keep_order(
+            [*parts, f"Tìm thông tin liên quan đến {question}"]
+        )
+
+    max_total_parts = max_parts + (1 if include_original else 0)
+    return parts[:max_total_parts]
+
+
 class LLMQuerySplitter:
     """
     Dùng LLM để tách câu hỏi dài/phức tạp thành nhiều query nhỏ hơn.
@@ -116,6 +171,8 @@ class LLMQuerySplitter:
     lọc context và sinh câu trả lời để không mất ý định ban đầu.
     """
 
+    name = "llm"
+
     PROMPT_TEMPLATE = """Bạn hãy tách câu hỏi sau thành các truy vấn con để tìm đúng đoạn văn trong vector database.
 Yêu cầu:
 - Giữ nguyên ý nghĩa gốc, không tự thêm thông tin.
@@ -136,58 +193,127 @@ Câu hỏi: {question}
         max_parts: int = 4,
         include_original: bool = True,
         min_query_vectors: int = 2,
+        cache: Any | None = None,
     ) -> None:
+        """
+        Args:
+            cache: Cache kết quả tách (get/set, xem ingestion/split_cache.py).
+                None = tạo theo env QUERY_SPLIT_CACHE.
+        """
         self.llm = llm
         self.include_original = include_original
         self.min_query_vectors = max(1, min_query_vectors)
         min_sub_parts = self.min_query_vectors - 1 if include_original else self.min_query_vectors
         self.max_parts = max(1, max_parts, min_sub_parts)
-        self._cache: dict[str, list[str]] = {}
+        self.cache = cache if cache is not None else build_split_cache()
+        model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+        # Đổi model / prompt / cấu hình splitter thì key đổi theo (cache SQLite dùng chung nhiều process)
+        self._cache_namespace = json.dumps(
+            {
+                "model": str(model_name),
+                "prompt": hashlib.md5(self.PROMPT_TEMPLATE.encode("utf-8")).hexdigest(),
+                "max_parts": self.max_parts,
+                "include_original": self.include_original,
+                "min_query_vectors": self.min_query_vectors,
+            },
+            sort_keys=True,
+        )
 
     def split(self, question: str) -> list[str]:
         question = _clean_text(question)
         if not question:
             return []
 
-        if question in self._cache:
-            return list(self._cache[question])
+        cached = self._cache_get(question)
+        if cached is not None:
+            return cached
 
         try:
-            response = self.llm.invoke(
-                self.PROMPT_TEMPLATE.format(
-                    question=question,
-                    max_parts=self.max_parts,
-                )
-            )
+            response = self.llm.invoke(self._build_prompt(question))
             content = getattr(response, "content", response)
             parts = self._parse_response(str(content))
         except Exception as exc:
             print(f"⚠️ LLM query split lỗi, fallback về query gốc: {exc}")
-            parts = []
+            # Không cache kết quả fallback để lỗi tạm thời của LLM không bị nhớ lại
+            return self._finalize_parts(question, [])
 
-        parts = [
-            part
-            for part in _dedupe_keep_order(parts[: self.max_parts])
-            if not _is_bad_query_part(part)
-        ]
-        if len(parts) < self.max_parts:
-            parts = _dedupe_keep_order(
-                [*parts, *_fallback_query_parts(question, self.max_parts)]
-            )
+        parts = self._finalize_parts(question, parts)
+        self._cache_set(question, parts)
+        return parts
+
+    async def asplit(self, question: str) -> list[str]:
+        """Như split() nhưng gọi LLM bằng ainvoke (không chặn event loop)."""
+        question = _clean_text(question)
+        if not question:
+            return []
 
+        cached = self._cache_get(question)
+        if cached is not None:
+            return cached
+
+        try:
+            response = await self.llm.ainvoke(self._build_prompt(question))
+            content = getattr(response, "content", response)
+            parts = self._parse_response(str(content))
+        except Exception as exc:
+            print(f"⚠️ LLM query split lỗi, fallback về query gốc: {exc}")
+            # Không cache kết quả fallback để lỗi tạm thời của LLM không bị nhớ lại
+            return self._finalize_parts(question, [])
+
+        parts = self._finalize_parts(question, parts)
+        self._cache_set(question, parts)
+        return parts
+
+    def cached_split(self, question: str) -> list[str] | None:
+        """Kết quả tách đã có trong cache (không gọi LLM), None nếu chưa có."""
+        question = _clean_text(question)
+        return self._cache_get(question) if question else None
+
+    def speculative_parts(self, question: str) -> list[str]:
+        """
+        Query parts có ngay không cần LLM (câu hỏi gốc + fallback), dùng để
+        retrieval chạy trước trong lúc chờ LLM tách câu hỏi.
+        """
+        question = _clean_text(question)
+        if not question:
+            return []
+        parts = _fallback_query_parts(question, self.max_parts)
         if self.include_original:
             parts = [question, *parts]
+        return _dedupe_keep_order(parts)
 
-        parts = _dedupe_keep_order(parts) or [question]
-        if len(parts) < self.min_query_vectors:
-            parts = _dedupe_keep_order(
-                [*parts, f"Tìm thông tin liên quan đến {question}"]
-            )
+    def _build_prompt(self, question: str) -> str:
+        return self.PROMPT_TEMPLATE.format(
+            question=question,
+            max_parts=self.max_parts,
+        )
+
+    def cache_key(self, question: str) -> str:
+        """Key cache = câu hỏi đã chuẩn hóa + model/prompt/cấu hình splitter."""
+        payload = f"{self._cache_namespace}\0{_clean_text(question)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _cache_get(self, question: str) -> list[str] | None:
+        if self.cache is None:
+            return None
+        try:
+            return self.cache.get(self.cache_key(question))
+        except Exception as exc:
+            print(f"⚠️ Lỗi đọc cache query split: {exc}")
+            return None
 
-        max_total_parts = self.max_parts + (1 if self.include_original else 0)
-        parts = parts[:max_total_parts]
-        self._cache[question] = parts
-        return list(parts)
+    def _cache_set(self, question: str, parts: list[str]) -> None:
+        if self.cache is None:
+            return
+        try:
+            self.cache.set(self.cache_key(question), parts)
+        except Exception as exc:
+            print(f"⚠️ Lỗi ghi cache query split: {exc}")
+
+    def _finalize_parts(self, question: str, parts: list[str]) -> list[str]:
+        return _finalize_query_parts(
+            question, parts, self.max_parts, self.include_original, self.min_query_vectors
+        )
 
     def _parse_response(self, text: str) -> list[str]:
         json_match = re.search(r"\[[\s\S]*\]", text)
@@ -209,6 +335,135 @@ Câu hỏi: {question}
         return _dedupe_keep_order(cleaned)
 
 
+class LocalQuerySplitter:
+    """
+    Tách câu hỏi không cần LLM (nhanh, không tốn round trip mạng).
+
+    Phân phối query gồm:
+        - các vế câu tách theo dấu phẩy / từ nối,
+        - câu hỏi gốc mở rộng bằng thuật ngữ gần nhất trong term index
+          (lân cận trong không gian embedding, xem ingestion/term_index.py),
+        - truy vấn từ khóa đã bỏ từ để hỏi,
+        - biến thể "Tìm đoạn văn chứa thông tin: ...".
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        embeddings: Any | None = None,
+        term_index: Any | None = None,
+        max_parts: int = 4,
+        include_original: bool = True,
+        min_query_vectors: int = 2,
+        expansion_terms: int | None = None,
+    ) -> None:
+        """
+        Args:
+            embeddings: Model embedding để embed câu hỏi khi tra term index.
+            term_index: QueryTermIndex; None = bỏ qua biến thể mở rộng thuật ngữ.
+            expansion_terms: Số thuật ngữ thêm vào câu hỏi (env QUERY_SPLIT_EXPANSION_TERMS, mặc định 4).
+        """
+        self.embeddings = embeddings
+        self.term_index = term_index
+        self.include_original = include_original
+        self.min_query_vectors = max(1, min_query_vectors)
+        min_sub_parts = self.min_query_vectors - 1 if include_original else self.min_query_vectors
+        self.max_parts = max(1, max_parts, min_sub_parts)
+        self.expansion_terms = (
+            expansion_terms if expansion_terms is not None
+            else int(os.getenv("QUERY_SPLIT_EXPANSION_TERMS", "4"))
+        )
+
+    def split(self, question: str) -> list[str]:
+        question = _clean_text(question)
+        if not question:
+            return []
+
+        base = _question_base(question)
+        parts = _clause_parts(base)
+        if len(parts) < 2:
+            parts = []  # Chỉ có 1 vế = chính câu hỏi, không tạo thêm vector trùng
+        expansion = self._expansion_query(question, base)
+        if expansion:
+            parts.append(expansion)
+        keyword_query = _keyword_query(base)
+        if keyword_query:
+            parts.append(keyword_query)
+        return _finalize_query_parts(
+            question, parts, self.max_parts, self.include_original, self.min_query_vectors
+        )
+
+    async def asplit(self, question: str) -> list[str]:
+        # Embed câu hỏi chạy CPU, không chạy trực tiếp trên event loop
+        return await asyncio.to_thread(self.split, question)
+
+    def cached_split(self, question: str) -> list[str] | None:
+        return None
+
+    def _expansion_query(self, question: str, base: str) -> str:
+        if self.term_index is None or self.embeddings is None or self.expansion_terms <= 0:
+            return ""
+        try:
+            query_vector = self.embeddings.embed_query(question)
+            terms = self.term_index.nearest_terms(query_vector, k=self.expansion_terms, exclude_text=base)
+        except Exception as exc:
+            print(f"⚠️ Lỗi mở rộng thuật ngữ, bỏ qua biến thể mở rộng: {exc}")
+            return ""
+        return f"{base} {' '.join(terms)}" if terms else ""
+
+
+class QuerySplitRouter:
+    """
+    Chọn splitter cho từng câu hỏi.
+
+    mode (env QUERY_SPLIT_MODE, có thể ghi đè theo từng request):
+        llm   : luôn dùng LLMQuerySplitter (mặc định).
+        local : luôn dùng LocalQuerySplitter.
+        auto  : câu hỏi ngắn (<= QUERY_SPLIT_LOCAL_MAX_WORDS từ, không có từ nối) dùng local,
+                câu hỏi dài / nhiều vế dùng LLM.
+    """
+
+    MODES = ("auto", "llm", "local")
+
+    def __init__(
+        self,
+        llm_splitter: LLMQuerySplitter,
+        local_splitter: LocalQuerySplitter,
+        mode: str | None = None,
+        local_max_words: int | None = None,
+    ) -> None:
+        self.llm_splitter = llm_splitter
+        self.local_splitter = local_splitter
+        self.mode = self._normalize_mode(mode or os.getenv("QUERY_SPLIT_MODE", "llm")) or "llm"
+        self.local_max_words = local_max_words or int(os.getenv("QUERY_SPLIT_LOCAL_MAX_WORDS", "12"))
+
+    def select(self, question: str, mode: str | None = None) -> LLMQuerySplitter | LocalQuerySplitter:
+        mode = self._normalize_mode(mode) or self.mode
+        if mode == "local":
+            return self.local_splitter
+        if mode == "auto":
+            base = _question_base(question)
+            if len(base.split()) <= self.local_max_words and len(_CONNECTOR_PATTERN.split(base)) == 1:
+                return self.local_splitter
+        return self.llm_splitter
+
+    def split(self, question: str, mode: str | None = None) -> list[str]:
+        return self.select(question, mode).split(question)
+
+    async def asplit(self, question: str, mode: str | None = None) -> list[str]:
+        return await self.select(question, mode).asplit(question)
+
+    def _normalize_mode(self, mode: str | None) -> str | None:
+        mode = (mode or "").strip().lower()
+        if not mode:
+            return None
+        if mode not in self.MODES:
+            print(f"⚠️ split_mode '{mode}' không hợp lệ, dùng '{getattr(self, 'mode', 'llm')}'.")
+            return None
+        return mode
+
+
 class SplitQueryEnergyRetriever:
     """
     Dùng toàn bộ query parts như một phân phối query để tính Energy Distance.
@@ -223,31 +478,166 @@ class SplitQueryEnergyRetriever:
     def __init__(
         self,
         energy_retriever: Any,
-        query_splitter: LLMQuerySplitter,
+        query_splitter: LLMQuerySplitter | LocalQuerySplitter | QuerySplitRouter,
         max_final_docs: int = 0,
+        cluster_index: CorpusClusterIndex | None = None,
+        retrieval_mode: str | None = None,
     ) -> None:
         self.energy_retriever = energy_retriever
         self.query_splitter = query_splitter
         self.max_final_docs = max_final_docs if max_final_docs > 0 else None
+        self.kmeans_selector = KMeansSelector()
+        # "kmeans": gom cụm top-k candidates theo từng câu hỏi (mặc định)
+        # "cluster_index": xếp hạng cụm tiền tính của toàn corpus (xem ingestion/cluster_index.py)
+        self.retrieval_mode = (retrieval_mode or os.getenv("ENERGY_RETRIEVAL_MODE", "kmeans")).strip().lower()
+        self.cluster_index = cluster_index
+        self.cluster_index_shortlist = int(os.getenv("CLUSTER_INDEX_SHORTLIST", "8"))
+        self.cluster_index_max_docs = int(os.getenv("CLUSTER_INDEX_MAX_DOCS", "40"))
         self.last_query_parts: list[str] = []
         self.last_retrieval_debug: list[dict[str, Any]] = []
         self.last_algorithm = "llm_query_split_energy_kmeans"
         self.debug_top_per_query = int(os.getenv("QUERY_SPLIT_DEBUG_TOP_PER_QUERY", "5"))
         self.debug_max_entries = int(os.getenv("QUERY_SPLIT_DEBUG_MAX_ENTRIES", "40"))
         self.debug_preview_chars = int(os.getenv("QUERY_SPLIT_DEBUG_PREVIEW_CHARS", "120"))
+        # Retrieval suy đoán: tìm kiếm câu hỏi gốc + fallback parts trong lúc chờ LLM tách câu hỏi
+        self.speculative = os.getenv("QUERY_SPLIT_SPECULATIVE", "true").lower() == "true"
+
+    def retrieve(self, query: str, split_mode: str | None = None) -> list[Any]:
+        result = self.retrieve_result(query, split_mode=split_mode)
+        # Giữ last_* cho code cũ (scoring/debug); khi chạy đồng thời hãy dùng retrieve_result()
+        self.last_query_parts = result["query_parts"]
+        self.last_retrieval_debug = result["retrieval_debug"]
+        self.last_algorithm = result["algorithm"]
+        return result["documents"]
+
+    async def aretrieve_result(
+        self,
+        query: str,
+        run_blocking: Callable[..., Awaitable[Any]] | None = None,
+        split_mode: str | None = None,
+    ) -> dict[str, Any]:
+        """
+        Phiên bản async của retrieve_result(): gọi LLM tách câu hỏi bằng asplit.
+
+        Ở chế độ speculative (env QUERY_SPLIT_SPECULATIVE, chỉ với retrieval kmeans),
+        embedding + tìm kiếm Chroma cho câu hỏi gốc và fallback parts chạy song song
+        với lời gọi LLM; khi có query parts thật chỉ tìm thêm các part chưa tìm.
+        Kết quả giống hệt chế độ tuần tự vì vẫn chọn cụm trên đúng query parts cuối cùng.
+
+        Args:
+            run_blocking: Hàm async chạy hàm đồng bộ trên executor
+                (vd: run_cpu_bound). Mặc định: asyncio.to_thread.
+            split_mode: auto | llm | local (xem QuerySplitRouter); None = mặc định.
+        """
+        run_blocking = run_blocking or asyncio.to_thread
+        splitter = self._select_splitter(query, split_mode)
+        if not isinstance(splitter, LLMQuerySplitter):
+            # Tách local không có round trip mạng: chạy cả split lẫn retrieval trên executor
+            return await run_blocking(self.retrieve_result, query, None, None, split_mode)
+        if not self.speculative or self.retrieval_mode != "kmeans" \
+                or splitter.cached_split(query) is not None:
+            query_parts = await splitter.asplit(query)
+            return await run_blocking(self.retrieve_result, query, query_parts, None, split_mode)
+
+        split_task = asyncio.create_task(splitter.asplit(query))
+        try:
+            try:
+                searched = await run_blocking(self.search_parts, splitter.speculative_parts(query))
+            except Exception as exc:
+                print(f"⚠️ Retrieval suy đoán lỗi, chờ query parts từ LLM: {exc}")
+                searched = {}
+            query_parts = await split_task
+        finally:
+            # Request bị hủy giữa chừng: không để lời gọi LLM chạy mồ côi
+            if not split_task.done():
+                split_task.cancel()
+
+        reused = sum(1 for part in query_parts if part in searched)
+        print(f"   -> ⚡ Retrieval suy đoán: dùng lại {reused}/{len(query_parts)} query parts đã tìm trước")
+        return await run_blocking(self.retrieve_result, query, query_parts, searched, split_mode)
+
+    def search_parts(self, query_parts: list[str]) -> dict[str, tuple[list[float], list[Any]]]:
+        """Embed + tìm top-k trong Chroma cho từng query part: {part: (vector, hits)}."""
+        if not query_parts:
+            return {}
+        query_vectors_list = embed_queries(self.energy_retriever.embeddings, query_parts)
+        hits_per_part = search_many_with_embeddings(
+            self.energy_retriever.vector_store,
+            query_vectors_list,
+            k=self.energy_retriever.k_retrieve,
+        )
+        return {
+            part: (vector, hits)
+            for part, vector, hits in zip(query_parts, query_vectors_list, hits_per_part)
+        }
 
-    def retrieve(self, query: str) -> list[Any]:
-        query_parts = self.query_splitter.split(query)
-        self.last_query_parts = list(query_parts)
-        self.last_retrieval_debug = []
-        print(f"\n🔎 [LLM Query Split] {len(query_parts)} query parts: {query_parts}")
+    def retrieve_result(
+        self,
+        query: str,
+        query_parts: list[str] | None = None,
+        searched: dict[str, tuple[list[float], list[Any]]] | None = None,
+        split_mode: str | None = None,
+    ) -> dict[str, Any]:
+        """
+        Truy xuất và trả về kết quả của RIÊNG lần gọi này (không dùng state chung của instance).
+
+        Args:
+            query: Câu hỏi gốc.
+            query_parts: Query parts đã tách sẵn (vd: từ asplit); None = gọi split().
+            searched: Kết quả search_parts() đã có cho một số part (chế độ speculative).
+            split_mode: auto | llm | local (xem QuerySplitRouter); None = mặc định.
+
+        Returns:
+            dict: documents, query_parts, retrieval_debug, algorithm
+        """
+        splitter = self._select_splitter(query, split_mode)
+        if query_parts is None:
+            query_parts = splitter.split(query)
+        query_parts = list(query_parts)
+        print(f"\n🔎 [{splitter.name.upper()} Query Split] {len(query_parts)} query parts: {query_parts}")
+
+        if self.retrieval_mode == "cluster_index":
+            if self.cluster_index is not None:
+                documents, debug = self._retrieve_from_cluster_index(query_parts)
+                return self._result(documents, query_parts, debug, f"{splitter.name}_query_split_energy_cluster_index")
+            print("   -> ⚠️ Chưa có cluster index, fallback về K-Means theo câu hỏi.")
+
+        documents, debug = self._retrieve_kmeans(query_parts, searched)
+        return self._result(documents, query_parts, debug, f"{splitter.name}_query_split_energy_kmeans")
+
+    def _select_splitter(self, query: str, split_mode: str | None) -> LLMQuerySplitter | LocalQuerySplitter:
+        select = getattr(self.query_splitter, "select", None)
+        return select(query, split_mode) if callable(select) else self.query_splitter
+
+    @staticmethod
+    def _result(documents, query_parts, debug, algorithm) -> dict[str, Any]:
+        return {
+            "documents": documents,
+            "query_parts": query_parts,
+            "retrieval_debug": debug,
+            "algorithm": algorithm,
+        }
+
+    def _retrieve_kmeans(
+        self,
+        query_parts: list[str],
+        searched: dict[str, tuple[list[float], list[Any]]] | None = None,
+    ) -> tuple[list[Any], list[dict[str, Any]]]:
+        """Gom cụm top-k candidates của các query parts rồi chọn cụm theo Energy Distance."""
+        embeddings = self.energy_retriever.embeddings
+        # Embed các query parts chưa tìm trong 1 batch và gửi 1 lần query Chroma cho tất cả;
+        # các vector này dùng lại ở bước Energy Distance.
+        searched = dict(searched or {})
+        searched.update(self.search_parts([part for part in query_parts if part not in searched]))
+        query_vectors_list = [searched[part][0] for part in query_parts]
+        hits_per_part = [searched[part][1] for part in query_parts]
 
         candidate_docs: list[Any] = []
+        candidate_vectors: list[np.ndarray | None] = []
         seen_docs: set[str] = set()
         debug_entries: list[dict[str, Any]] = []
-        for part_index, part in enumerate(query_parts, start=1):
-            docs = self.energy_retriever.retriever.invoke(part)
-            for rank, doc in enumerate(docs, start=1):
+        for part_index, (part, hits) in enumerate(zip(query_parts, hits_per_part), start=1):
+            for rank, (doc, stored_vector, _) in enumerate(hits, start=1):
                 key = self._doc_key(doc)
                 metadata = getattr(doc, "metadata", {}) or {}
                 debug_entries.append(
@@ -266,17 +656,15 @@ class SplitQueryEnergyRetriever:
                     continue
                 seen_docs.add(key)
                 candidate_docs.append(doc)
+                candidate_vectors.append(stored_vector)
 
         if not candidate_docs:
             print("   -> ⚠️ Không tìm thấy tài liệu thô nào.")
-            self.last_retrieval_debug = self._compact_debug_entries(debug_entries)
-            return []
+            return [], self._compact_debug_entries(debug_entries)
 
-        context = [doc.page_content for doc in candidate_docs]
-        doc_vectors = np.array(self.energy_retriever.embeddings.embed_documents(context))
-        query_vectors = np.array(
-            [self.energy_retriever.embeddings.embed_query(part) for part in query_parts]
-        )
+        # Vector của chunk lấy thẳng từ Chroma, không embed lại page_content
+        doc_vectors = fill_missing_embeddings(embeddings, candidate_docs, candidate_vectors)
+        query_vectors = np.array(query_vectors_list)
 
         sims = cosine_similarity(query_vectors, doc_vectors)
         doc_index_by_key = {
@@ -294,48 +682,29 @@ class SplitQueryEnergyRetriever:
         print(f"   -> Max Cosine Similarity: {np.max(sims):.4f}")
 
         n_samples = len(doc_vectors)
+        energy_batch = EnergyDistanceBatch(query_vectors, doc_vectors)
         print(
             f"   -> 📋 Đưa {len(query_vectors)} query vectors và "
             f"{n_samples} doc vectors vào Energy Distance"
         )
 
-        max_possible_k = min(10, n_samples - 1)
         if n_samples > 2:
-            best_score = -1.0
-            best_k = 2
-            best_labels = None
-
-            for k in range(2, max_possible_k + 1):
-                kmeans_temp = KMeans(n_clusters=k, random_state=42, n_init="auto")
-                labels_temp = kmeans_temp.fit_predict(doc_vectors)
-                score = silhouette_score(doc_vectors, labels_temp)
-                if score > best_score:
-                    best_score = score
-                    best_k = k
-                    best_labels = labels_temp
-
-            labels = best_labels
-            actual_k = best_k
+            # Silhouette dùng lại ma trận doc×doc của energy_batch, K-Means warm-start theo k
+            labels, actual_k, best_score = self.kmeans_selector.fit(
+                doc_vectors, distances=energy_batch.doc_distances
+            )
+            score_text = f"{best_score:.4f}" if best_score is not None else "N/A"
             print(
-                f"   -> 🤖 Tự động chọn K tối ưu = {best_k} "
-                f"(Silhouette Score cao nhất: {best_score:.4f})"
+                f"   -> 🤖 Tự động chọn K tối ưu = {actual_k} "
+                f"(Silhouette Score cao nhất: {score_text})"
             )
         else:
             labels = np.zeros(n_samples, dtype=int)
             actual_k = 1
             print(f"   -> ⚠️ Số lượng docs quá ít ({n_samples}), tự động gom thành 1 cụm.")
 
-        cluster_energies = []
-        for i in range(actual_k):
-            cluster_mask = labels == i
-            if not np.any(cluster_mask):
-                continue
-
-            cluster_vectors = doc_vectors[cluster_mask]
-            energy = energy_base_distance(query_vectors, cluster_vectors)
-            cluster_energies.append((i, energy))
-
-        cluster_energies.sort(key=lambda item: item[1])
+        # Ma trận khoảng cách [query ∪ docs] tính 1 lần, chấm mọi cụm trong 1 lượt
+        cluster_energies = energy_batch.rank_clusters(labels, actual_k)
         n_select = min(self.energy_retriever.n_top_clusters, len(cluster_energies))
         selected_clusters = cluster_energies[:n_select]
 
@@ -364,10 +733,60 @@ class SplitQueryEnergyRetriever:
                 entry["cluster"] = int(labels[doc_index])
                 entry["selected_by_energy_cluster"] = doc_index in seen_indices
 
-        self.last_retrieval_debug = self._compact_debug_entries(debug_entries)
-
         print(f"   -> ✅ Truy xuất {len(final_docs)} documents từ phân phối query")
-        return final_docs
+        return final_docs, self._compact_debug_entries(debug_entries)
+
+    def _retrieve_from_cluster_index(self, query_parts: list[str]) -> tuple[list[Any], list[dict[str, Any]]]:
+        """Energy Distance giữa phân phối query và các cụm tiền tính của toàn corpus."""
+        embeddings = self.energy_retriever.embeddings
+        vector_store = self.energy_retriever.vector_store
+        query_vectors = np.array(embed_queries(embeddings, query_parts))
+
+        cluster_energies = self.cluster_index.rank_clusters(
+            query_vectors,
+            vector_store,
+            n_shortlist=self.cluster_index_shortlist,
+        )
+        if not cluster_energies:
+            print("   -> ⚠️ Không tìm thấy cụm nào trong cluster index.")
+            return [], []
+
+        n_select = min(self.energy_retriever.n_top_clusters, len(cluster_energies))
+        selected_clusters = cluster_energies[:n_select]
+
+        final_docs = []
+        debug_entries: list[dict[str, Any]] = []
+        max_docs = self.max_final_docs or self.cluster_index_max_docs
+        for idx, (cluster_id, energy) in enumerate(selected_clusters):
+            icon = "🏆" if idx == 0 else "📌"
+            print(f"   -> {icon} Cụm {cluster_id} (index) - Energy Distance = {energy:.4f}")
+
+            remaining = max_docs - len(final_docs)
+            if remaining <= 0:
+                break
+            cluster_docs = self.cluster_index.get_cluster_documents(
+                cluster_id, query_vectors, vector_store, max_docs=remaining
+            )
+            for rank, (doc, _) in enumerate(cluster_docs, start=1):
+                metadata = getattr(doc, "metadata", {}) or {}
+                debug_entries.append(
+                    {
+                        "query_part_index": 0,
+                        "query_part": "",
+                        "rank": rank,
+                        "source": metadata.get("source", ""),
+                        "filename": metadata.get("filename", ""),
+                        "page": metadata.get("page", ""),
+                        "content_preview": _clean_text(doc.page_content)[: self.debug_preview_chars],
+                        "cluster": cluster_id,
+                        "energy_distance": energy,
+                        "selected_by_energy_cluster": True,
+                    }
+                )
+                final_docs.append(doc)
+
+        print(f"   -> ✅ Truy xuất {len(final_docs)} documents từ cluster index")
+        return final_docs, self._compact_debug_entries(debug_entries)
 
     def _compact_debug_entries(self, entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
         kept = [
@@ -0,0 +1,251 @@
+"""
+Cache kết quả tách câu hỏi (LLMQuerySplitter) có giới hạn.
+
+    MemorySplitCache : LRU + TTL trong process, giới hạn số entry và tổng số ký tự.
+    SQLiteSplitCache : lưu trên đĩa, dùng chung giữa các worker uvicorn và giữa các lần restart.
+    TieredSplitCache : memory phía trước SQLite (hit memory không chạm đĩa).
+
+Chọn backend bằng env QUERY_SPLIT_CACHE = memory (mặc định) | sqlite | none.
+Key do LLMQuerySplitter tạo (câu hỏi đã chuẩn hóa + cấu hình splitter), cache chỉ lưu list[str].
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+
+DEFAULT_SPLIT_CACHE_PATH = Path(__file__).parent.parent / "embedding_cache" / "query_splits.sqlite3"
+
+
+class MemorySplitCache:
+    """
+    Args:
+        max_entries: Số câu hỏi tối đa giữ lại (LRU).
+        ttl_seconds: Thời gian sống của entry, <= 0 = không hết hạn.
+        max_chars: Tổng số ký tự tối đa của các query parts (giới hạn bộ nhớ).
+    """
+
+    def __init__(self, max_entries: int = 2000, ttl_seconds: float = 0, max_chars: int = 2_000_000) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.max_chars = max_chars
+        self._lock = Lock()
+        self._items: OrderedDict[str, tuple[float, list[str], int]] = OrderedDict()
+        self._chars = 0
+
+    def get(self, key: str) -> list[str] | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            created_at, parts, _ = item
+            if self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds:
+                self._pop_locked(key)
+                return None
+            self._items.move_to_end(key)
+            return list(parts)
+
+    def set(self, key: str, parts: list[str], created_at: float | None = None) -> None:
+        size = sum(len(part) for part in parts)
+        with self._lock:
+            if key in self._items:
+                self._pop_locked(key)
+            self._items[key] = (created_at or time.time(), list(parts), size)
+            self._chars += size
+            while self._items and (len(self._items) > self.max_entries or self._chars > self.max_chars):
+                self._pop_locked(next(iter(self._items)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._chars = 0
+
+    def _pop_locked(self, key: str) -> None:
+        _, _, size = self._items.pop(key)
+        self._chars -= size
+
+
+class SQLiteSplitCache:
+    """
+    Cache trên đĩa (SQLite, WAL) dùng chung giữa nhiều process.
+
+    Args:
+        path: File SQLite. Mặc định: embedding_cache/query_splits.sqlite3
+        max_entries: Số entry tối đa, vượt quá thì xóa theo LRU (last_access cũ nhất).
+        ttl_seconds: Thời gian sống của entry, <= 0 = không hết hạn.
+
+    last_access không ghi mỗi lần đọc (như EmbeddingCache): gom trong RAM, ghi theo lô khi đủ
+    ACCESS_FLUSH_EVERY key hoặc sau ACCESS_FLUSH_SECONDS giây, trước eviction và khi close.
+    """
+
+    # Chỉ kiểm tra eviction sau mỗi N lần ghi để không COUNT(*) liên tục
+    EVICT_CHECK_EVERY = 200
+    # Ghi last_access đã gom khi đủ N key hoặc sau N giây
+    ACCESS_FLUSH_EVERY = 200
+    ACCESS_FLUSH_SECONDS = 60.0
+
+    def __init__(self, path: str | os.PathLike | None = None, max_entries: int = 50000, ttl_seconds: float = 0) -> None:
+        self.path = str(path or DEFAULT_SPLIT_CACHE_PATH)
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._writes_since_check = 0
+        # key -> last_access chưa ghi xuống DB
+        self._pending_access: dict[str, float] = {}
+        self._last_access_flush = time.time()
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_splits (
+                key TEXT PRIMARY KEY,
+                parts TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_query_splits_last_access ON query_splits(last_access)")
+        self.conn.commit()
+
+    def get(self, key: str) -> list[str] | None:
+        return (self.get_with_time(key) or (None, None))[1]
+
+    def get_with_time(self, key: str) -> tuple[float, list[str]] | None:
+        """Như get() nhưng trả thêm created_at (để tầng memory giữ đúng TTL)."""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT parts, created_at FROM query_splits WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl_seconds > 0 and now - row[1] > self.ttl_seconds:
+                self._pending_access.pop(key, None)
+                self.conn.execute("DELETE FROM query_splits WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self._pending_access[key] = now
+            if (
+                len(self._pending_access) >= self.ACCESS_FLUSH_EVERY
+                or now - self._last_access_flush >= self.ACCESS_FLUSH_SECONDS
+            ):
+                self._flush_access_locked()
+        return row[1], json.loads(row[0])
+
+    def set(self, key: str, parts: list[str], created_at: float | None = None) -> None:
+        now = time.time()
+        with self._lock:
+            self._pending_access.pop(key, None)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO query_splits (key, parts, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(list(parts), ensure_ascii=False), created_at or now, now),
+            )
+            self.conn.commit()
+            self._writes_since_check += 1
+            if self._writes_since_check >= self.EVICT_CHECK_EVERY:
+                self._writes_since_check = 0
+                self._evict_locked()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending_access.clear()
+            self.conn.execute("DELETE FROM query_splits")
+            self.conn.commit()
+
+    def _flush_access_locked(self) -> None:
+        self._last_access_flush = time.time()
+        if not self._pending_access:
+            return
+        self.conn.executemany(
+            "UPDATE query_splits SET last_access = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._pending_access.items()],
+        )
+        self.conn.commit()
+        self._pending_access.clear()
+
+    def _evict_locked(self) -> None:
+        # LRU phải thấy các lần đọc gần nhất
+        self._flush_access_locked()
+        if self.ttl_seconds > 0:
+            self.conn.execute("DELETE FROM query_splits WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        count = self.conn.execute("SELECT COUNT(*) FROM query_splits").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute("""
+                DELETE FROM query_splits WHERE key IN (
+                    SELECT key FROM query_splits ORDER BY last_access ASC LIMIT ?
+                )
+            """, (overflow,))
+        self.conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_access_locked()
+            self.conn.close()
+
+
+class TieredSplitCache:
+    """Memory (L1) phía trước SQLite (L2): hit L2 được chép lên L1."""
+
+    def __init__(self, memory: MemorySplitCache, disk: SQLiteSplitCache) -> None:
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str) -> list[str] | None:
+        parts = self.memory.get(key)
+        if parts is not None:
+            return parts
+        found = self.disk.get_with_time(key)
+        if found is None:
+            return None
+        created_at, parts = found
+        self.memory.set(key, parts, created_at=created_at)
+        return list(parts)
+
+    def set(self, key: str, parts: list[str]) -> None:
+        self.memory.set(key, parts)
+        self.disk.set(key, parts)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        self.disk.clear()
+
+
+def build_split_cache(backend: str | None = None):
+    """
+    Tạo cache theo env:
+        QUERY_SPLIT_CACHE              memory | sqlite | none (mặc định: memory)
+        QUERY_SPLIT_CACHE_MAX_ENTRIES  số câu hỏi giữ trong RAM (mặc định: 2000)
+        QUERY_SPLIT_CACHE_TTL_SECONDS  thời gian sống, 0 = không hết hạn (mặc định: 86400)
+        QUERY_SPLIT_CACHE_PATH         file SQLite khi backend = sqlite
+
+    Returns:
+        Cache có get/set, hoặc None nếu tắt cache.
+    """
+    backend = (backend or os.getenv("QUERY_SPLIT_CACHE", "memory")).strip().lower()
+    if backend in ("none", "off", "false", ""):
+        return None
+
+    max_entries = int(os.getenv("QUERY_SPLIT_CACHE_MAX_ENTRIES", "2000"))
+    ttl_seconds = float(os.getenv("QUERY_SPLIT_CACHE_TTL_SECONDS", "86400"))
+    memory = MemorySplitCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+    if backend == "memory":
+        return memory
+    if backend == "sqlite":
+        disk = SQLiteSplitCache(
+            path=os.getenv("QUERY_SPLIT_CACHE_PATH", "") or None,
+            max_entries=int(os.getenv("QUERY_SPLIT_CACHE_DISK_MAX_ENTRIES", "50000")),
+            ttl_seconds=ttl_seconds,
+        )
+        return TieredSplitCache(memory, disk)
+
+    print(f"⚠️ QUERY_SPLIT_CACHE='{backend}' không hợp lệ, dùng cache memory.")
+    return memory
@@ -0,0 +1,169 @@
+"""
+Chỉ mục thuật ngữ (term index) cho LocalQuerySplitter.
+
+Offline (ingestion/vector_data_builder.py):
+    toàn bộ chunks trong Chroma -> đếm document frequency của từ đơn / cụm 2 từ
+    -> giữ các thuật ngữ phổ biến vừa phải -> embed (E5 "passage: ") -> lưu npz.
+
+Online (LocalQuerySplitter):
+    vector câu hỏi -> các thuật ngữ gần nhất trong không gian embedding
+    -> thêm vào truy vấn để tạo biến thể mở rộng mà không cần gọi LLM.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+
+TERM_INDEX_FILENAME = "query_term_index.npz"
+
+# Từ chức năng không mang nghĩa tìm kiếm (không dùng làm thuật ngữ mở rộng)
+STOPWORDS = {
+    "và", "của", "là", "có", "các", "những", "được", "cho", "trong", "với", "một",
+    "này", "đã", "để", "không", "theo", "từ", "khi", "về", "như", "thì", "ra",
+    "nào", "gì", "bao", "nhiêu", "đâu", "hãy", "biết", "câu", "hỏi", "ở", "tại",
+    "do", "bởi", "nên", "mà", "vì", "sẽ", "đang", "cũng", "còn", "hay", "hoặc",
+    "nhưng", "đó", "đến", "lên", "trên", "dưới", "sau", "trước", "thế", "rằng",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """Tách chữ thường, bỏ số thuần và ký tự đơn."""
+    return [
+        token
+        for token in re.findall(r"\w+", str(text or "").lower())
+        if len(token) > 1 and not token.isdigit()
+    ]
+
+
+def extract_terms(text: str) -> set[str]:
+    """Từ đơn + cụm 2 từ liên tiếp (từ ghép tiếng Việt thường gồm 2 âm tiết)."""
+    tokens = tokenize(text)
+    terms = {token for token in tokens if token not in STOPWORDS}
+    for left, right in zip(tokens, tokens[1:]):
+        if left not in STOPWORDS and right not in STOPWORDS:
+            terms.add(f"{left} {right}")
+    return terms
+
+
+class QueryTermIndex:
+    """
+    Attributes:
+        terms (list[str]): Thuật ngữ của corpus.
+        vectors (np.ndarray): Embedding đã chuẩn hóa L2 (n_terms × dim).
+    """
+
+    def __init__(self, terms: list[str], vectors) -> None:
+        self.terms = list(terms)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.where(norms > 0, norms, 1.0)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    @classmethod
+    def build(
+        cls,
+        vector_store,
+        embeddings,
+        max_terms: int | None = None,
+        min_df: int | None = None,
+        max_df_ratio: float = 0.2,
+        batch_size: int = 1024,
+    ) -> "QueryTermIndex":
+        """
+        Args:
+            vector_store: Chroma vector store đã có dữ liệu.
+            embeddings: Model embedding (embed_documents).
+            max_terms: Số thuật ngữ tối đa. Mặc định: env TERM_INDEX_MAX_TERMS (20000).
+            min_df: Số chunk tối thiểu chứa thuật ngữ. Mặc định: env TERM_INDEX_MIN_DF (3).
+            max_df_ratio: Bỏ thuật ngữ xuất hiện trong quá nhiều chunks (không phân biệt được).
+        """
+        max_terms = max_terms or int(os.getenv("TERM_INDEX_MAX_TERMS", "20000"))
+        min_df = min_df or int(os.getenv("TERM_INDEX_MIN_DF", "3"))
+
+        collection = vector_store._collection
+        total = collection.count()
+        if total == 0:
+            raise ValueError("❌ Collection rỗng, không thể xây term index.")
+
+        document_frequency: Counter[str] = Counter()
+        for offset in range(0, total, batch_size):
+            page = collection.get(include=["documents"], limit=batch_size, offset=offset)
+            for content in page["documents"]:
+                document_frequency.update(extract_terms(content))
+
+        max_df = max(min_df, int(total * max_df_ratio))
+        candidates = [
+            (term, count)
+            for term, count in document_frequency.items()
+            if min_df <= count <= max_df
+        ]
+        candidates.sort(key=lambda item: (-item[1], item[0]))
+        terms = [term for term, _ in candidates[:max_terms]]
+        if not terms:
+            raise ValueError("❌ Không có thuật ngữ nào đạt ngưỡng document frequency.")
+
+        print(f"🔤 Đang embed {len(terms)} thuật ngữ cho term index...")
+        vectors = []
+        for start in range(0, len(terms), batch_size):
+            vectors.extend(embeddings.embed_documents(terms[start:start + batch_size]))
+
+        print(f"✅ Term index: {len(terms)} thuật ngữ từ {total} chunks.")
+        return cls(terms, vectors)
+
+    def save(self, persist_dir: str) -> str:
+        """Lưu index vào <persist_dir>/query_term_index.npz."""
+        os.makedirs(persist_dir, exist_ok=True)
+        path = os.path.join(persist_dir, TERM_INDEX_FILENAME)
+        np.savez_compressed(path, terms=np.array(self.terms, dtype=str), vectors=self.vectors)
+        print(f"💾 Đã lưu term index tại '{path}'")
+        return path
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "QueryTermIndex | None":
+        """Đọc index nếu đã được build, ngược lại trả về None."""
+        path = os.path.join(persist_dir, TERM_INDEX_FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["terms"].tolist(), data["vectors"])
+
+    def nearest_terms(self, query_vector, k: int = 4, exclude_text: str = "") -> list[str]:
+        """
+        Các thuật ngữ gần vector câu hỏi nhất, bỏ thuật ngữ đã có sẵn trong exclude_text.
+
+        Args:
+            query_vector: Vector câu hỏi (E5 "query: ").
+            k: Số thuật ngữ trả về.
+        """
+        if k <= 0 or not self.terms:
+            return []
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm > 0:
+            query_vector = query_vector / norm
+        similarity = self.vectors @ query_vector
+
+        existing = set(tokenize(exclude_text))
+        n_candidates = min(len(self.terms), k * 8)
+        top = np.argpartition(-similarity, n_candidates - 1)[:n_candidates]
+
+        results: list[str] = []
+        for index in top[np.argsort(-similarity[top])]:
+            term = self.terms[index]
+            if set(term.split()) <= existing:
+                continue
+            if any(term in chosen or chosen in term for chosen in results):
+                continue
+            results.append(term)
+            if len(results) >= k:
+                break
+        return results
@@ -1,38 +1,72 @@
+import argparse
+import os
 import sys
 from pathlib import Path
 
 # Entry point: thêm project root vào path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from ingestion.load_document import load_documents_from_dir
 from ingestion.model_embedding import vn_embedder
 from ingestion.chunks_document import ChromaDBManager
+from ingestion.cluster_index import CorpusClusterIndex, INDEX_FILENAME, VECTORS_FILENAME
+from ingestion.term_index import QueryTermIndex, TERM_INDEX_FILENAME
 
-def build_database():
-    print("🚀 BẮT ĐẦU QUÁ TRÌNH XÂY DỰNG VECTOR DATABASE...")
+def build_database(full_rebuild=False):
+    """
+    Xây / cập nhật Vector DB từ ./Dataset_economy.
 
-    # BƯỚC 1: Đọc dữ liệu thô
-    print("\n--- BƯỚC 1: LOAD DỮ LIỆU ---")
-    docs = load_documents_from_dir('./Dataset_economy')
-    
-    if not docs:
-        print("❌ Không có văn bản nào để xử lý. Dừng chương trình.")
-        return
+    Args:
+        full_rebuild: True = xóa DB và embed lại toàn bộ; False (mặc định) = chỉ
+            xử lý file mới / đã sửa / đã xóa dựa trên manifest trong persist_dir.
+    """
+    print("🚀 BẮT ĐẦU QUÁ TRÌNH XÂY DỰNG VECTOR DATABASE...")
 
-    # BƯỚC 2: Lấy model Embedding đã khởi tạo sẵn
-    print("\n--- BƯỚC 2: KHỞI TẠO MODEL ---")
+    # BƯỚC 1: Lấy model Embedding đã khởi tạo sẵn
+    print("\n--- BƯỚC 1: KHỞI TẠO MODEL ---")
     embeddings = vn_embedder.get_model()
 
-    # BƯỚC 3: Cắt và Lưu trữ vào ChromaDB
-    print("\n--- BƯỚC 3: CHUNKING & BUILDING DB ---")
+    # BƯỚC 2-3: Đọc, cắt (song song) và lưu vào ChromaDB theo từng batch
+    print("\n--- BƯỚC 2-3: LOAD, CHUNKING & BUILDING DB (STREAMING) ---")
     db_manager = ChromaDBManager(embeddings_model=embeddings, persist_dir='./chroma_economy_db')
     # ./chroma_economy_db
-    
-    # ĐÂY LÀ LÚC TRUYỀN DỮ LIỆU VÀO NÀY:
-    db_manager.process_and_store(raw_documents=docs, chunk_size=600, chunk_overlap=80, force_rebuild=True)
+
+    stats = db_manager.ingest_directory(
+        './Dataset_economy',
+        chunk_size=600,
+        chunk_overlap=80,
+        force_rebuild=full_rebuild,
+    )
+    if not db_manager.vector_store._collection.count():
+        print("❌ Không có văn bản nào để xử lý. Dừng chương trình.")
+        return
+
+    # BƯỚC 4: Gom cụm toàn corpus cho Energy Retriever (ENERGY_RETRIEVAL_MODE=cluster_index)
+    print("\n--- BƯỚC 4: BUILDING CLUSTER INDEX ---")
+    chunks_changed = not stats or bool(stats["added"] or stats["deleted"])
+    index_path = os.path.join(db_manager.persist_dir, INDEX_FILENAME)
+    vectors_path = os.path.join(db_manager.persist_dir, VECTORS_FILENAME)
+    # Index cũ chưa lưu vectors cụm thì build lại một lần
+    if not chunks_changed and os.path.exists(index_path) and os.path.exists(vectors_path):
+        print("⏭️ Không có chunk thay đổi → giữ nguyên cluster index.")
+    else:
+        cluster_index = CorpusClusterIndex.build(db_manager.vector_store)
+        cluster_index.save(db_manager.persist_dir)
+
+    # BƯỚC 5: Term index cho tách câu hỏi local (QUERY_SPLIT_MODE=local|auto)
+    print("\n--- BƯỚC 5: BUILDING TERM INDEX ---")
+    term_index_path = os.path.join(db_manager.persist_dir, TERM_INDEX_FILENAME)
+    if not chunks_changed and os.path.exists(term_index_path):
+        print("⏭️ Không có chunk thay đổi → giữ nguyên term index.")
+    else:
+        term_index = QueryTermIndex.build(db_manager.vector_store, embeddings)
+        term_index.save(db_manager.persist_dir)
 
     print("\n🎉 HOÀN THÀNH QUÁ TRÌNH XÂY DỰNG DATABASE!")
 
 # Lệnh này giúp code chỉ chạy khi bạn bấm Run trực tiếp file này
 if __name__ == "__main__":
-    build_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Xây dựng Vector DB cho chatbot kinh tế")
+    parser.add_argument("--full-rebuild", action="store_true",
+                        help="Xóa DB cũ và embed lại toàn bộ corpus (mặc định: cập nhật incremental)")
+    args = parser.parse_args()
+    build_database(full_rebuild=args.full_rebuild)
\ No newline at end of file
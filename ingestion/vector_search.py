@@ -0,0 +1,99 @@
+"""
+Truy vấn Chroma kèm embedding đã lưu của từng chunk.
+
+vector_store.as_retriever().invoke() chỉ trả về Document, nên trước đây
+retriever phải gọi embeddings.embed_documents() lại cho toàn bộ candidates
+dù Chroma đã lưu đúng vector đó. Hàm ở đây gọi thẳng collection.query với
+include=["embeddings"] để lấy vector cùng lúc với document.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+def search_with_embeddings(
+    vector_store: Any,
+    query_embedding: list[float],
+    k: int = 40,
+) -> list[tuple[Document, np.ndarray | None, float]]:
+    """
+    Tìm top-k chunks gần query_embedding và trả về kèm vector đã lưu.
+
+    Args:
+        vector_store: Chroma vector store (langchain_chroma.Chroma).
+        query_embedding: Vector của câu hỏi (đã thêm prefix "query: ").
+        k: Số kết quả.
+
+    Returns:
+        list (Document, stored_embedding, distance) theo thứ tự gần nhất trước.
+        stored_embedding là None nếu collection không lưu vector cho chunk đó.
+    """
+    return search_many_with_embeddings(vector_store, [query_embedding], k=k)[0]
+
+
+def search_many_with_embeddings(
+    vector_store: Any,
+    query_embeddings: list[list[float]],
+    k: int = 40,
+) -> list[list[tuple[Document, np.ndarray | None, float]]]:
+    """
+    Như search_with_embeddings nhưng cho nhiều query trong MỘT lần gọi Chroma.
+
+    Returns:
+        Danh sách hits, phần tử thứ i tương ứng query_embeddings[i].
+    """
+    if len(query_embeddings) == 0:
+        return []
+
+    result = vector_store._collection.query(
+        query_embeddings=[list(vector) for vector in query_embeddings],
+        n_results=k,
+        include=["documents", "metadatas", "embeddings", "distances"],
+    )
+    return [_hits_from_result(result, index) for index in range(len(query_embeddings))]
+
+
+def embed_queries(embeddings_model: Any, texts: list[str]) -> list[list[float]]:
+    """Embed nhiều query trong 1 batch nếu model hỗ trợ (E5EmbeddingsWrapper.embed_queries)."""
+    batch_embed = getattr(embeddings_model, "embed_queries", None)
+    if callable(batch_embed):
+        return batch_embed(texts)
+    return [embeddings_model.embed_query(text) for text in texts]
+
+
+def _hits_from_result(result: dict, query_index: int) -> list[tuple[Document, np.ndarray | None, float]]:
+    documents = (result.get("documents") or [[]])[query_index] or []
+    metadatas = (result.get("metadatas") or [[]])[query_index] or []
+    distances = (result.get("distances") or [[]])[query_index] or []
+    embeddings = result.get("embeddings")
+    embeddings = embeddings[query_index] if embeddings is not None else None
+
+    hits = []
+    for row, content in enumerate(documents):
+        metadata = metadatas[row] if row < len(metadatas) else None
+        vector = None
+        if embeddings is not None and row < len(embeddings) and embeddings[row] is not None:
+            vector = np.asarray(embeddings[row], dtype=np.float64)
+        distance = float(distances[row]) if row < len(distances) else 0.0
+        hits.append((Document(page_content=content or "", metadata=metadata or {}), vector, distance))
+    return hits
+
+
+def fill_missing_embeddings(
+    embeddings_model: Any,
+    docs: list[Document],
+    vectors: list[np.ndarray | None],
+) -> np.ndarray:
+    """Chỉ embed lại những doc không có vector lưu sẵn, trả về ma trận đầy đủ."""
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    if missing:
+        print(f"   -> ⚠️ {len(missing)} docs không có embedding lưu sẵn, đang embed lại...")
+        fresh = embeddings_model.embed_documents([docs[index].page_content for index in missing])
+        vectors = list(vectors)
+        for index, vector in zip(missing, fresh):
+            vectors[index] = np.asarray(vector, dtype=np.float64)
+    return np.array(vectors)
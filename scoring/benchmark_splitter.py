@@ -0,0 +1,138 @@
+"""
+So sánh LLMQuerySplitter và LocalQuerySplitter trên bộ câu hỏi evaluation.
+
+Với mỗi câu hỏi và mỗi mode (llm, local, auto):
+    - thời gian tách câu hỏi,
+    - thời gian tách + retrieval (Energy Distance, chưa grade),
+    - Hit@k: ground_truth có nằm trong top-k documents truy xuất được không.
+
+Chạy:
+    python scoring/benchmark_splitter.py --max 1000 --modes llm local auto
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+SCORING_DIR = Path(__file__).resolve().parent
+
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from chatbot.main import ChatbotRunner
+from scoring.create_eval_data import DEFAULT_INPUT_FILE, DEFAULT_VECTOR_STORE, load_questions_from_excel
+from scoring.evaluation_metric.hit_rate import hit_rate
+
+
+DEFAULT_OUTPUT_FILE = SCORING_DIR / "benchmark_splitter.xlsx"
+
+
+def benchmark_splitters(
+    qa_list: list[dict[str, str]],
+    modes: list[str],
+    vector_store: str | Path = DEFAULT_VECTOR_STORE,
+    llm_provider: str = "openai",
+    k: int = 5,
+    use_cache: bool = False,
+) -> pd.DataFrame:
+    print("🚀 Đang khởi tạo chatbot...")
+    chatbot = ChatbotRunner(path_vector_store=str(vector_store), llm_provider=llm_provider)
+    retriever = chatbot.agent.split_query_retriever
+    router = chatbot.agent.query_splitter
+    if not use_cache:
+        # Đo đúng độ trễ gọi LLM, không để câu hỏi lặp lại trúng cache
+        router.llm_splitter.cache = None
+
+    rows = []
+    for mode in modes:
+        print(f"\n{'=' * 60}\n⚙️ Mode: {mode}\n{'=' * 60}")
+        for index, item in enumerate(qa_list, 1):
+            question = item["question"]
+            splitter = router.select(question, mode)
+            try:
+                start = time.perf_counter()
+                query_parts = splitter.split(question)
+                split_seconds = time.perf_counter() - start
+                result = retriever.retrieve_result(question, query_parts, split_mode=mode)
+                total_seconds = time.perf_counter() - start
+                contents = [doc.page_content for doc in result["documents"]]
+                error = ""
+            except Exception as exc:
+                print(f"❌ [{index}] Lỗi: {exc}")
+                query_parts, contents, error = [], [], str(exc)
+                split_seconds = total_seconds = float("nan")
+
+            rows.append({
+                "mode": mode,
+                "splitter": splitter.name,
+                "question": question,
+                "n_query_parts": len(query_parts),
+                "query_parts": str(query_parts),
+                "split_seconds": split_seconds,
+                "retrieval_seconds": total_seconds,
+                f"Hit@{k}": hit_rate(item["ground_truth"], contents, k=k),
+                "num_docs": len(contents),
+                "error": error,
+            })
+            if index % 50 == 0:
+                print(f"   -> {mode}: {index}/{len(qa_list)} câu hỏi")
+
+    return pd.DataFrame(rows)
+
+
+def summarize(df: pd.DataFrame, k: int = 5) -> pd.DataFrame:
+    summary = df.groupby("mode").agg(
+        questions=("question", "count"),
+        local_share=("splitter", lambda values: float(np.mean(values == "local"))),
+        query_parts=("n_query_parts", "mean"),
+        split_mean_s=("split_seconds", "mean"),
+        split_p95_s=("split_seconds", lambda values: float(np.nanpercentile(values, 95))),
+        retrieval_mean_s=("retrieval_seconds", "mean"),
+        retrieval_p95_s=("retrieval_seconds", lambda values: float(np.nanpercentile(values, 95))),
+        hit_rate=(f"Hit@{k}", "mean"),
+    )
+    return summary.round(4)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark tách câu hỏi LLM vs local")
+    parser.add_argument("--input", default=str(DEFAULT_INPUT_FILE))
+    parser.add_argument("--output", default=str(DEFAULT_OUTPUT_FILE))
+    parser.add_argument("--max", type=int, default=None)
+    parser.add_argument("--modes", nargs="+", default=["llm", "local", "auto"], choices=["llm", "local", "auto"])
+    parser.add_argument("--vector-store", default=str(DEFAULT_VECTOR_STORE))
+    parser.add_argument("--llm-provider", default="openai")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--use-cache", action="store_true", help="Cho phép dùng cache kết quả tách câu hỏi")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"❌ Không tìm thấy file: {args.input}")
+        sys.exit(1)
+
+    qa_list = load_questions_from_excel(args.input, max_questions=args.max)
+    df = benchmark_splitters(
+        qa_list,
+        modes=args.modes,
+        vector_store=args.vector_store,
+        llm_provider=args.llm_provider,
+        k=args.k,
+        use_cache=args.use_cache,
+    )
+    summary = summarize(df, k=args.k)
+
+    with pd.ExcelWriter(args.output) as writer:
+        summary.to_excel(writer, sheet_name="summary")
+        df.to_excel(writer, sheet_name="questions", index=False)
+
+    print(f"\n{summary.to_string()}")
+    print(f"\n📁 Kết quả lưu tại: {args.output}")
+
+
+if __name__ == "__main__":
+    main()